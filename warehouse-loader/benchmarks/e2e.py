@@ -0,0 +1,219 @@
+"""End-to-end throughput benchmark of the pipelines.
+
+Generates a synthetic warehouse of a given size in a moto-backed bucket
+(see `synthetic.py`), then runs the pipelines on it one after the other, as
+they are deployed: `warehouseloader` on the raw uploads, `submittingcentres`
+on the clinical data files, and (with the inventory updated to list the
+processed files) `dataprocess` on the training and validation groups.
+
+For each pipeline it reports the objects handled per second, the S3
+requests made per object, and the peak resident memory of the process so
+far. The bucket is kept in memory by moto, so the memory figures are only
+comparable between runs of the same size. The local caches and stores of
+the services are kept in a fresh temporary folder, so each run starts from
+scratch.
+
+Run from the `warehouse-loader` folder:
+
+    python benchmarks/e2e.py --patients 500 --output baseline.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+BUCKET_NAME = "benchmark-bucket"
+WORK_DIR = tempfile.mkdtemp(prefix="warehouse-benchmark-")
+# The pipelines read their settings on import
+os.environ.update(
+    {
+        "WAREHOUSE_BUCKET": BUCKET_NAME,
+        "INVENTORY_CACHE_DIR": os.path.join(WORK_DIR, "inventory"),
+        "PATIENT_CACHE_DIR": os.path.join(WORK_DIR, "patients"),
+        "SUBMITTING_CENTRE_STORE": os.path.join(WORK_DIR, "centres.sqlite"),
+        "HEADER_CACHE_STORE": os.path.join(WORK_DIR, "headers.sqlite"),
+        "RUN_JOURNAL_DIR": os.path.join(WORK_DIR, "journal"),
+        "METADATA_MANIFEST_DIR": os.path.join(WORK_DIR, "manifests"),
+        "NO_OUTPUT_FILE": "1",
+    }
+)
+
+import bonobo  # noqa: E402
+import boto3  # noqa: E402
+from moto import mock_s3  # noqa: E402
+from synthetic import generate, write_inventory  # noqa: E402
+
+import warehouse.dataprocess as dataprocess  # noqa: E402
+import warehouse.submittingcentres as submittingcentres  # noqa: E402
+import warehouse.warehouseloader as warehouseloader  # noqa: E402
+from warehouse.components import helpers  # noqa: E402
+from warehouse.components.services import S3Client, StageMetrics  # noqa: E402
+
+
+def peak_rss_mb():
+    """The peak resident memory of the process so far, in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def count_objects(conn, prefixes):
+    paginator = conn.meta.client.get_paginator("list_objects_v2")
+    return sum(
+        len(page.get("Contents", []))
+        for prefix in prefixes
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix)
+    )
+
+
+def run_pipeline(module, objects, queue_size, **options):
+    """Run a pipeline with its own services, as its `main` does.
+
+    Parameters
+    ----------
+    module : module
+        The pipeline module (with `get_graph` and `get_services`).
+    objects : int
+        The number of objects the pipeline takes, for the rates.
+    queue_size : int
+        The number of items that can wait at the input of each step.
+    **options : dict
+        The options of the pipeline's graph and services.
+
+    Returns
+    -------
+    dict
+        The objects, time, rates, S3 requests, errors and peak memory of
+        the run, and the summary of its steps.
+    """
+    name = module.__name__.rsplit(".", 1)[-1]
+    metrics = StageMetrics(name)
+    pipeline_services = module.get_services(**options)
+    start = time.perf_counter()
+    bonobo.run(
+        module.get_graph(**options),
+        services=pipeline_services,
+        strategy=helpers.pipeline_strategy(queue_size, metrics=metrics),
+    )
+    seconds = time.perf_counter() - start
+    summary = metrics.summary()
+    requests = sum(
+        service.counters["requests"]
+        for service in pipeline_services.values()
+        if isinstance(service, S3Client)
+    )
+    return {
+        "pipeline": name,
+        "objects": objects,
+        "seconds": seconds,
+        "objects_per_second": objects / seconds,
+        "s3_requests": requests,
+        "requests_per_object": requests / max(objects, 1),
+        "errors": sum(stage["errors"] for stage in summary["stages"].values()),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": summary["stages"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=500)
+    parser.add_argument("--images-per-patient", type=int, default=4)
+    parser.add_argument("--fragments", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=128)
+    parser.add_argument(
+        "--metadata-layout", choices=["image", "series"], default="image"
+    )
+    parser.add_argument(
+        "--output", help="JSON file to save the results in, to compare with"
+    )
+    args = parser.parse_args()
+
+    results = []
+    with mock_s3():
+        conn = boto3.resource("s3", region_name="us-east-1")
+        start = time.perf_counter()
+        counts = generate(
+            conn,
+            bucket=BUCKET_NAME,
+            patients=args.patients,
+            images_per_patient=args.images_per_patient,
+        )
+        conn.create_bucket(Bucket=f"{BUCKET_NAME}-processed")
+        write_inventory(
+            conn,
+            bucket=BUCKET_NAME,
+            fragments=args.fragments,
+            date=datetime.datetime(2021, 3, 8),
+        )
+        print(
+            f"Generated {counts['clinical']} clinical data files and "
+            f"{counts['images']} images "
+            f"({counts['bytes'] / 1024 / 1024:.1f} MB) in "
+            f"{time.perf_counter() - start:.1f}s, peak RSS "
+            f"{peak_rss_mb():.0f} MB"
+        )
+
+        results += [
+            run_pipeline(
+                warehouseloader,
+                counts["clinical"] + counts["images"],
+                args.queue_size,
+                metadata_layout=args.metadata_layout,
+            )
+        ]
+        copied = count_objects(
+            conn,
+            [
+                f"{group}/{modality}/"
+                for group in ["training", "validation"]
+                for modality in ["xray", "ct"]
+            ],
+        )
+        expected = counts["images"] - counts["orphan_images"]
+        if copied != expected:
+            print(f"Warning: copied {copied} images, expected {expected}")
+
+        results += [
+            run_pipeline(
+                submittingcentres, counts["clinical"], args.queue_size
+            )
+        ]
+
+        # The next daily inventory lists the processed files too
+        write_inventory(
+            conn,
+            bucket=BUCKET_NAME,
+            fragments=args.fragments,
+            date=datetime.datetime(2021, 3, 9),
+        )
+        processed = count_objects(conn, ["training/", "validation/"])
+        # The output files are written to the working directory
+        cwd = os.getcwd()
+        os.chdir(WORK_DIR)
+        try:
+            results += [run_pipeline(dataprocess, processed, args.queue_size)]
+        finally:
+            os.chdir(cwd)
+
+    for result in results:
+        print(
+            f"{result['pipeline']:>18}: {result['objects']:6d} objects in "
+            f"{result['seconds']:7.1f}s, "
+            f"{result['objects_per_second']:7.1f} objects/s, "
+            f"{result['requests_per_object']:5.2f} requests/object, "
+            f"{result['errors']} errors, "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"options": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
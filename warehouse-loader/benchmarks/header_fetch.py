@@ -0,0 +1,104 @@
+"""Throughput benchmark of the image header fetching stage.
+
+Uploads copies of a test DICOM file into a moto-backed bucket, and then
+downloads their headers one after another (as `process_image` does on its
+own), and through `ImageHeaderFetcher` with various worker counts.
+
+As moto responds instantly, an artificial per-request latency is added to
+get numbers closer to what the pipeline sees against S3.
+
+Run from the `warehouse-loader` folder:
+
+    python benchmarks/header_fetch.py --images 200 --latency-ms 30
+"""
+
+import argparse
+import os
+import pathlib
+import time
+
+import bonobo
+import boto3
+from moto import mock_s3
+
+from warehouse.components.services import HeaderSizeStats, S3Client
+from warehouse.warehouseloader import ImageHeaderFetcher, PartialDicom
+
+TEST_FILE = str(
+    pathlib.Path(__file__).parent.parent.absolute()
+    / "tests"
+    / "test_data"
+    / "sample.dcm"
+)
+BUCKET_NAME = "benchmark-bucket"
+
+
+class SlowS3Client(S3Client):
+    """S3 client adding a fixed latency to each ranged download."""
+
+    def __init__(self, bucket, latency):
+        super().__init__(bucket)
+        self.latency = latency
+
+    def object_content(self, key, content_range=None):
+        time.sleep(self.latency)
+        return super().object_content(key, content_range=content_range)
+
+
+def run_sequential(s3client, keys):
+    for key in keys:
+        PartialDicom(s3client, key).download_header()
+
+
+def discard(*args):
+    pass
+
+
+def run_concurrent(s3client, keys, workers):
+    graph = bonobo.Graph()
+    graph.add_chain(
+        [("process", key, None) for key in keys],
+        ImageHeaderFetcher(workers=workers),
+        discard,
+    )
+    bonobo.run(
+        graph,
+        services={"s3client": s3client, "headerstats": HeaderSizeStats()},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 4, 8, 16, 32]
+    )
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_s3():
+        conn = boto3.resource("s3", region_name="us-east-1")
+        conn.create_bucket(Bucket=BUCKET_NAME)
+        keys = [
+            f"raw-benchmark/2021-01-01/images/{i}.dcm"
+            for i in range(args.images)
+        ]
+        for key in keys:
+            conn.meta.client.upload_file(TEST_FILE, BUCKET_NAME, key)
+        s3client = SlowS3Client(BUCKET_NAME, args.latency_ms / 1000)
+
+        start = time.perf_counter()
+        run_sequential(s3client, keys)
+        elapsed = time.perf_counter() - start
+        print(f"sequential: {len(keys) / elapsed:8.1f} images/s")
+
+        for workers in args.workers:
+            start = time.perf_counter()
+            run_concurrent(s3client, keys, workers)
+            elapsed = time.perf_counter() - start
+            print(f"workers={workers:<3} {len(keys) / elapsed:8.1f} images/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Benchmark of reading the inventory for the warehouse loader.
+
+Generates a synthetic inventory (raw uploads, and the processed files for
+most of them) in a moto-backed bucket, then compares answering the loader's
+inventory queries with a separate scan for each of them (as the services did
+before the single-pass `InventoryIndex`), and from one pass through the
+inventory with `InventoryIndex` (also with fragments downloaded ahead).
+
+Keep the fragments below the multipart threshold of boto3 (8 MB compressed,
+about 50000 rows), as moto can serve the larger ones truncated.
+
+Run from the `warehouse-loader` folder:
+
+    python benchmarks/inventory_scan.py --rows 2000000 --fragments 50
+"""
+
+import argparse
+import csv
+import gzip
+import os
+import random
+import re
+import tempfile
+import time
+from io import BytesIO, StringIO
+
+import boto3
+from moto import mock_s3
+
+from warehouse.components.services import InventoryDownloader
+
+BUCKET_NAME = "benchmark-bucket"
+RAW_PREFIXES = {"raw-nhs-upload", "raw-acme-upload"}
+
+
+def synthetic_keys(rows, processed_ratio=0.9, seed=42):
+    """Generate inventory keys of a warehouse with a given number of objects.
+
+    Each patient has a couple of clinical files and a series of images
+    uploaded, and most of them are processed into the training/validation
+    groups (with an image and a metadata file for each raw image).
+    """
+    rng = random.Random(seed)
+    count = 0
+    patient = 0
+    while count < rows:
+        patient += 1
+        raw_prefix = rng.choice(sorted(RAW_PREFIXES))
+        date = f"2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        group = rng.choice(["training", "validation"])
+        modality = rng.choice(["xray", "ct", "mri"])
+        processed = rng.random() < processed_ratio
+        pseudonym = f"Covid{patient:08d}"
+        yield f"{raw_prefix}/{date}/data/{pseudonym}_data.json", 100
+        count += 1
+        if processed:
+            yield f"{group}/data/{pseudonym}/data_{date}.json", 100
+            count += 1
+        for image in range(rng.randint(1, 10)):
+            uid = f"1.2.826.0.1.{patient}.{image}"
+            yield f"{raw_prefix}/{date}/images/{uid}.dcm", 500000
+            count += 1
+            if processed:
+                series = f"{group}/{modality}/{pseudonym}/1.2.{patient}/1.3.{patient}"
+                yield f"{series}/{uid}.dcm", 500000
+                yield (
+                    f"{group}/{modality}-metadata/{pseudonym}/1.2.{patient}"
+                    f"/1.3.{patient}/{uid}.json",
+                    2000,
+                )
+                count += 2
+
+
+def upload_inventory(rows, fragments):
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=BUCKET_NAME)
+    inventory_bucket = f"{BUCKET_NAME}-inventory"
+    conn.create_bucket(Bucket=inventory_bucket)
+
+    keys = list(synthetic_keys(rows))
+    random.Random(0).shuffle(keys)
+    fragment_size = -(-len(keys) // fragments)
+    fragment_names = []
+    for start in range(0, len(keys), fragment_size):
+        buff = StringIO()
+        writer = csv.writer(buff)
+        for key, size in keys[start : start + fragment_size]:
+            writer.writerow([BUCKET_NAME, key, size])
+        name = f"data/fragment-{start}.csv.gz"
+        conn.meta.client.upload_fileobj(
+            BytesIO(gzip.compress(buff.getvalue().encode())),
+            inventory_bucket,
+            name,
+        )
+        fragment_names += [f"s3://{inventory_bucket}/{name}"]
+    conn.meta.client.upload_fileobj(
+        BytesIO("\n".join(fragment_names).encode()),
+        inventory_bucket,
+        f"{BUCKET_NAME}/daily-full-inventory/hive/symlink.txt",
+    )
+    return len(keys)
+
+
+def scan_separately(downloader):
+    """The inventory queries of the loader, each with its own scan."""
+    results = dict()
+
+    pattern = re.compile(
+        r"^(?P<group>training|validation)/data/(?P<pseudonym>[^/]*)/[^/]*$"
+    )
+    patients = dict()
+    for _, fragment_reader in downloader.get_inventory():
+        for row in fragment_reader:
+            key_match = pattern.match(row[1])
+            if key_match:
+                patients[key_match.group("pseudonym")] = key_match.group(
+                    "group"
+                )
+    results["patients"] = len(patients)
+
+    pattern = re.compile(
+        r"^(?P<raw_prefix>raw-.*)/(\d{4}-\d{2}-\d{2})/data/(?P<filename>[^/]*)$"
+    )
+    raw_data = 0
+    for _, fragment_reader in downloader.get_inventory():
+        for row in fragment_reader:
+            key_match = pattern.match(row[1])
+            if key_match and key_match.group("raw_prefix") in RAW_PREFIXES:
+                raw_data += 1
+    results["raw_data"] = raw_data
+    results["pending"] = count_pending_separately(downloader)
+    return results
+
+
+def count_pending_separately(downloader):
+    """The pending raw image count, as the services did before the single
+    pass, re-reading the inventory for each fragment with raw images."""
+    raw_pattern = re.compile(
+        r"^(?P<raw_prefix>raw-.*)/\d{4}-\d{2}-\d{2}/images/(?P<filename>[^/]*)$"
+    )
+    processed_pattern = re.compile(
+        r"^(training|validation)/(xray|ct|mri).*/(?P<filename>[^/]*)$"
+    )
+    pending = 0
+    fragment_excludelist = set()
+    for _, fragment_reader in downloader.get_inventory():
+        raw_list = dict()
+        for row in fragment_reader:
+            key_match = raw_pattern.match(row[1])
+            if key_match and key_match.group("raw_prefix") in RAW_PREFIXES:
+                raw_list[key_match.group("filename")] = row[1]
+        unprocessed = set(raw_list.keys())
+        unprocessed_json = {
+            key.replace(".dcm", ".json") for key in unprocessed
+        }
+        if len(unprocessed) == 0:
+            continue
+        for f, fragment_reader2 in downloader.get_inventory(
+            fragment_excludelist
+        ):
+            filenames = set()
+            for row in fragment_reader2:
+                item = processed_pattern.match(row[1])
+                if item:
+                    filenames.add(item.group("filename"))
+            if len(filenames) == 0:
+                fragment_excludelist.add(f)
+            unprocessed = unprocessed - filenames
+            unprocessed_json = unprocessed_json - filenames
+            if len(unprocessed) == 0 and len(unprocessed_json) == 0:
+                break
+        unprocessed |= {
+            key.replace(".json", ".dcm") for key in unprocessed_json
+        }
+        pending += len(unprocessed)
+    return pending
+
+
+def scan_once(downloader):
+    """The inventory queries of the loader, answered from a single pass."""
+    index = downloader.get_index()
+    processed = index.processed_filenames
+    return {
+        "patients": len(dict(index.patient_groups)),
+        "raw_data": sum(
+            1 for prefix, _ in index.raw_data if prefix in RAW_PREFIXES
+        ),
+        "pending": sum(
+            1
+            for prefix, key, _ in index.raw_images
+            if prefix in RAW_PREFIXES
+            and (
+                key.rsplit("/", 1)[-1] not in processed
+                or key.rsplit("/", 1)[-1].replace(".dcm", ".json")
+                not in processed
+            )
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--fragments", type=int, default=50)
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        nargs="*",
+        default=[4],
+        help="fragments to download ahead in the single pass runs",
+    )
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_s3():
+        rows = upload_inventory(args.rows, args.fragments)
+        print(f"inventory: {rows} rows in {args.fragments} fragments")
+
+        runs = [("separate scans", scan_separately, 0)]
+        runs += [
+            (f"single pass, prefetch={prefetch}", scan_once, prefetch)
+            for prefetch in [0] + args.prefetch
+        ]
+        for name, scan, prefetch in runs:
+            # Start each run with an empty local inventory cache
+            with tempfile.TemporaryDirectory() as cache_dir:
+                downloader = InventoryDownloader(
+                    main_bucket=BUCKET_NAME,
+                    cache_dir=cache_dir,
+                    prefetch=prefetch,
+                )
+                start = time.perf_counter()
+                results = scan(downloader)
+                elapsed = time.perf_counter() - start
+            print(f"{name:<28} {elapsed:8.2f} s  {results}")
+
+
+if __name__ == "__main__":
+    main()
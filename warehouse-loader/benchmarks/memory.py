@@ -0,0 +1,258 @@
+"""Memory benchmark of the loader's in-memory key sets and services.
+
+Compares the memory used per entry by the patient group cache and the
+processed key/filename sets as plain Python dicts and sets (as the services
+kept them before), and in their compact form (`PatientCache` and
+`HashedKeySet` with sorted hashes in numpy arrays). Each of them is built
+from scratch in the measured region (the patient group list too, as the
+inventory index builds it), with the memory kept afterwards and the peak
+while building reported.
+
+With `--rows`, it also measures the peak resident memory of the services of
+each pipeline, as its `get_services()` sets them up with the inventory index
+built, on a synthetic inventory (see `inventory_scan.py`) of that many rows
+in a moto-backed bucket. Each pipeline is measured in its own process, so
+their peaks don't hide each other.
+
+Run from the `warehouse-loader` folder:
+
+    python benchmarks/memory.py --entries 1000000 --rows 2000000
+"""
+
+import argparse
+import csv
+import gc
+import gzip
+import importlib
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from io import StringIO
+
+WORK_DIR = tempfile.mkdtemp(prefix="warehouse-benchmark-")
+# The pipelines read their settings on import
+os.environ.update(
+    {
+        "WAREHOUSE_BUCKET": "benchmark-bucket",
+        "INVENTORY_CACHE_DIR": os.path.join(WORK_DIR, "inventory"),
+        "PATIENT_CACHE_DIR": os.path.join(WORK_DIR, "patients"),
+        "SUBMITTING_CENTRE_STORE": os.path.join(WORK_DIR, "centres.sqlite"),
+        "HEADER_CACHE_STORE": os.path.join(WORK_DIR, "headers.sqlite"),
+        "RUN_JOURNAL_DIR": os.path.join(WORK_DIR, "journal"),
+        "METADATA_MANIFEST_DIR": os.path.join(WORK_DIR, "manifests"),
+    }
+)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import boto3  # noqa: E402
+from inventory_scan import BUCKET_NAME, synthetic_keys  # noqa: E402
+from moto import mock_s3  # noqa: E402
+
+from warehouse.components.services import (  # noqa: E402
+    FileList,
+    HashedKeySet,
+    PatientCache,
+)
+
+PIPELINES = ["warehouseloader", "submittingcentres", "dataprocess"]
+
+
+class SyntheticIndex:
+    """The parts of an inventory index that the patient cache uses."""
+
+    def __init__(self, patient_groups):
+        self.patient_groups = patient_groups
+
+    def take_patient_groups(self):
+        patient_groups, self.patient_groups = self.patient_groups, None
+        return patient_groups, None
+
+
+class SyntheticDownloader:
+    def __init__(self, patient_groups):
+        self.index = SyntheticIndex(patient_groups)
+        self.inventory_date = None
+
+    def get_index(self):
+        return self.index
+
+
+def patient_ids(entries):
+    return (f"Covid{patient:08d}" for patient in range(entries))
+
+
+def filenames(entries):
+    return (
+        f"1.2.826.0.1.3680043.{patient}.{image}.dcm"
+        for patient in range(entries // 10 + 1)
+        for image in range(10)
+    )
+
+
+def measure(build):
+    """The memory held by the result of `build`, and the peak while
+    building it, in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size, peak
+
+
+def peak_rss_mb():
+    """The peak resident memory of the process so far, in megabytes."""
+    # Where available, as the peak of the parent process carries over to
+    # `ru_maxrss` of the processes it starts
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def upload_inventory(rows, fragments):
+    """Upload a synthetic inventory one fragment at a time, so that
+    generating it doesn't raise the peak memory measured afterwards."""
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=BUCKET_NAME)
+    inventory_bucket = f"{BUCKET_NAME}-inventory"
+    conn.create_bucket(Bucket=inventory_bucket)
+
+    keys = synthetic_keys(rows)
+    fragment_size = -(-rows // fragments)
+    fragment_names = []
+    for start in itertools.count(0, fragment_size):
+        fragment = list(itertools.islice(keys, fragment_size))
+        if not fragment:
+            break
+        buff = StringIO()
+        csv.writer(buff).writerows(
+            [BUCKET_NAME, key, size] for key, size in fragment
+        )
+        name = f"data/fragment-{start}.csv.gz"
+        conn.meta.client.put_object(
+            Bucket=inventory_bucket,
+            Key=name,
+            Body=gzip.compress(buff.getvalue().encode()),
+        )
+        fragment_names += [f"s3://{inventory_bucket}/{name}"]
+    conn.meta.client.put_object(
+        Bucket=inventory_bucket,
+        Key=f"{BUCKET_NAME}/daily-full-inventory/hive/symlink.txt",
+        Body="\n".join(fragment_names).encode(),
+    )
+
+
+def measure_services(pipeline, rows, fragments):
+    """The peak resident memory of a pipeline's services with the inventory
+    index built, before and after setting them up, in megabytes."""
+    module = importlib.import_module(f"warehouse.{pipeline}")
+    with mock_s3():
+        upload_inventory(rows, fragments)
+        gc.collect()
+        before = peak_rss_mb()
+        pipeline_services = module.get_services()
+        for service in pipeline_services.values():
+            # Those listing the files build the index on first use only
+            if isinstance(service, FileList):
+                service.downloader.get_index()
+        return before, peak_rss_mb()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=0,
+        help="inventory rows to measure the pipeline services with",
+    )
+    parser.add_argument("--fragments", type=int, default=50)
+    parser.add_argument(
+        "--services", choices=PIPELINES, help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.services:
+        # Run in a process of its own by the main benchmark
+        before, peak = measure_services(
+            args.services, args.rows, args.fragments
+        )
+        print(json.dumps({"before": before, "peak": peak}))
+        return
+
+    entries = args.entries
+    rng = random.Random(42)
+    groups = [rng.choice(["training", "validation"]) for _ in range(entries)]
+    filename_list = list(filenames(entries))[:entries]
+    filename_hashes = [HashedKeySet.hash(name) for name in filename_list]
+
+    runs = [
+        (
+            "patients, dict",
+            lambda: {
+                patient_id: group == "training"
+                for patient_id, group in zip(patient_ids(entries), groups)
+            },
+        ),
+        (
+            "patients, PatientCache",
+            lambda: PatientCache(
+                SyntheticDownloader(list(zip(patient_ids(entries), groups)))
+            ),
+        ),
+        ("filenames, set of str", lambda: set(filenames(entries))),
+        ("keys, set of hashes", lambda: set(filename_hashes)),
+        ("filenames, HashedKeySet", lambda: HashedKeySet(filename_list)),
+    ]
+    print(f"entries: {entries}")
+    for name, build in runs:
+        size, peak = measure(build)
+        print(
+            f"{name:<26} {size / entries:8.1f} bytes/entry kept, "
+            f"{peak / entries:8.1f} at peak"
+        )
+
+    if args.rows <= 0:
+        return
+    print(f"inventory: {args.rows} rows in {args.fragments} fragments")
+    for pipeline in PIPELINES:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--services",
+                pipeline,
+                "--rows",
+                str(args.rows),
+                "--fragments",
+                str(args.fragments),
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        print(
+            f"{pipeline:<26} peak RSS {result['peak']:8.0f} MB "
+            f"(+{result['peak'] - result['before']:.0f} MB for the services)"
+        )
+
+
+if __name__ == "__main__":
+    main()
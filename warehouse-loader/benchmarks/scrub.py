@@ -0,0 +1,103 @@
+"""CPU benchmark of the DICOM metadata scrubbing.
+
+Builds representative CT and CR headers from the test images, with the
+parts that make scrubbing expensive in real data: private binary elements
+(such as vendor headers of tens of kilobytes), and VOI LUT sequences with
+their LUT data. Then times converting them to JSON as `scrub_dicom` did
+before (`to_json_dict`, encoding all binary data, then two passes of
+`inplace_nullify` over the result), and with the single pass `scrub_dicom`,
+checking that the JSON is the same.
+
+Run from the `warehouse-loader` folder:
+
+    python benchmarks/scrub.py --images 500
+"""
+
+import argparse
+import json
+import pathlib
+import time
+
+import pydicom
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from warehouse.warehouseloader import inplace_nullify, scrub_dicom
+
+TEST_DATA = (
+    pathlib.Path(__file__).parent.parent.absolute() / "tests" / "test_data"
+)
+CR_FILE = TEST_DATA / "sample.dcm"
+CT_FILE = (
+    TEST_DATA
+    / "1.3.6.1.4.1.11129.5.5.110503645592756492463169821050252582267888.dcm"
+)
+
+
+def voi_lut(entries):
+    item = Dataset()
+    item.LUTDescriptor = [entries, 0, 12]
+    item.LUTExplanation = "NORMAL"
+    item.LUTData = bytes(2 * entries)
+    return item
+
+
+def ct_header():
+    """A CT slice header, with vendor binary headers and a small VOI LUT."""
+    ds = pydicom.dcmread(str(CT_FILE), stop_before_pixels=True)
+    ds.Modality = "CT"
+    ds.RescaleIntercept = "-1024"
+    ds.RescaleSlope = "1"
+    ds.WindowCenter = ["40", "400"]
+    ds.WindowWidth = ["400", "1500"]
+    ds.add_new(0x00291010, "OB", bytes(12 * 1024))
+    ds.add_new(0x00291020, "OB", bytes(48 * 1024))
+    ds.add_new(0x70051012, "OB", bytes(2 * 1024))
+    ds.VOILUTSequence = Sequence([voi_lut(256)])
+    return ds
+
+
+def cr_header():
+    """A CR image header, with VOI LUTs and a vendor binary header."""
+    ds = pydicom.dcmread(str(CR_FILE), stop_before_pixels=True)
+    ds.Modality = "CR"
+    ds.VOILUTSequence = Sequence([voi_lut(4096), voi_lut(4096)])
+    item = Dataset()
+    item.add_new(0x00191010, "OB", bytes(8 * 1024))
+    item.VOILUTSequence = Sequence([voi_lut(4096)])
+    ds.add_new(0x00191000, "SQ", Sequence([item]))
+    return ds
+
+
+def scrub_before(fd):
+    out = fd.to_json_dict(bulk_data_threshold=1e20)
+    inplace_nullify(out, "InlineBinary")
+    inplace_nullify(out, "00283010")
+    return out
+
+
+def run(scrub, headers):
+    start = time.perf_counter()
+    results = [json.dumps(scrub(header)) for header in headers]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=500)
+    args = parser.parse_args()
+
+    for name, make_header in [("CT", ct_header), ("CR", cr_header)]:
+        headers = [make_header() for _ in range(args.images)]
+        before, expected = run(scrub_before, headers)
+        after, results = run(scrub_dicom, headers)
+        assert results == expected, "Scrubbed JSON differs"
+        print(
+            f"{name}: before {len(headers) / before:8.1f} images/s, "
+            f"single pass {len(headers) / after:8.1f} images/s "
+            f"({before / after:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
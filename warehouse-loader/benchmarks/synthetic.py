@@ -0,0 +1,351 @@
+"""Synthetic warehouse for the end-to-end benchmarks.
+
+Fills a (moto-backed) bucket with what the submitting centres upload: the
+pipeline configuration, clinical data files (a `data` file for the COVID
+positive patients, `status` files for the others) and small DICOM images
+with realistic headers (X-ray studies of a couple of images, and CT series
+of more slices, with vendor binary elements and VOI LUTs). Some of the
+images belong to patients whose clinical data has not arrived yet, as in
+the real uploads.
+
+The S3 inventory of the bucket (gzipped CSV fragments and the manifest
+symlink) is written from the listing of the bucket, so it can be updated
+after running a pipeline, as the daily inventory would be.
+
+Used by `e2e.py`, e.g. to generate a warehouse without running anything:
+
+    python benchmarks/synthetic.py --patients 1000
+"""
+
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import random
+from io import BytesIO, StringIO
+
+import boto3
+from moto import mock_s3
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, PYDICOM_ROOT_UID
+
+from warehouse.components.constants import CONFIG_KEY
+
+BUCKET_NAME = "benchmark-bucket"
+RAW_PREFIX = "raw-nhs-upload"
+SITES = {
+    "split": ["Centre A", "Centre B"],
+    "training": ["Centre C"],
+    "validation": ["Centre D"],
+}
+SOP_CLASSES = {
+    "CR": "1.2.840.10008.5.1.4.1.1.1",
+    "DX": "1.2.840.10008.5.1.4.1.1.1.1",
+    "CT": "1.2.840.10008.5.1.4.1.1.2",
+}
+# Side length of the (blank) images, in pixels
+IMAGE_PIXELS = 64
+
+
+class UIDs:
+    """Unique, repeatable UIDs for the generated images."""
+
+    def __init__(self, seed):
+        self.prefix = f"{PYDICOM_ROOT_UID}{seed}."
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return f"{self.prefix}{self.count}"
+
+
+def voi_lut(entries):
+    item = Dataset()
+    item.LUTDescriptor = [entries, 0, 12]
+    item.LUTExplanation = "NORMAL"
+    item.LUTData = bytes(2 * entries)
+    return item
+
+
+def dicom_image(patient, study, series, modality, instance, uid):
+    """A small DICOM image of a patient, as uploaded.
+
+    Parameters
+    ----------
+    patient : dict
+        The pseudonym, sex and age of the patient.
+    study : dict
+        The UID and date of the study.
+    series : str
+        The UID of the series.
+    modality : str
+        "CR", "DX" or "CT".
+    instance : int
+        The number of the image within the series.
+    uid : str
+        The SOP instance UID of the image.
+
+    Returns
+    -------
+    bytes
+        The DICOM file.
+    """
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = SOP_CLASSES[modality]
+    file_meta.MediaStorageSOPInstanceUID = uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.ImageType = ["ORIGINAL", "PRIMARY"] + (
+        ["AXIAL"] if modality == "CT" else []
+    )
+    ds.SOPClassUID = SOP_CLASSES[modality]
+    ds.SOPInstanceUID = uid
+    ds.StudyDate = study["date"]
+    ds.SeriesDate = study["date"]
+    ds.StudyTime = "101500"
+    ds.Modality = modality
+    ds.Manufacturer = "ACME Medical"
+    ds.InstitutionName = "Anonymized"
+    ds.StudyDescription = "CT CHEST" if modality == "CT" else "XR CHEST"
+    ds.SeriesDescription = "Thorax 1.0 B31f" if modality == "CT" else "PA"
+    ds.ManufacturerModelName = "Imager 3000"
+    ds.PatientName = "Anonymized"
+    ds.PatientID = patient["pseudonym"]
+    ds.PatientSex = patient["sex"]
+    ds.PatientAge = f"{patient['age']:03d}Y"
+    ds.BodyPartExamined = "CHEST"
+    if modality == "CT":
+        ds.SliceThickness = "1.0"
+        ds.KVP = "120"
+    else:
+        ds.ViewPosition = "PA"
+    ds.StudyInstanceUID = study["uid"]
+    ds.SeriesInstanceUID = series
+    ds.SeriesNumber = 1
+    ds.InstanceNumber = instance
+    ds.PatientOrientation = ""
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.Rows = IMAGE_PIXELS
+    ds.Columns = IMAGE_PIXELS
+    ds.PixelSpacing = ["0.7", "0.7"]
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    if modality == "CT":
+        ds.WindowCenter = ["40", "400"]
+        ds.WindowWidth = ["400", "1500"]
+        ds.RescaleIntercept = "-1024"
+        ds.RescaleSlope = "1"
+        # Vendor headers
+        ds.add_new(0x00291010, "OB", bytes(12 * 1024))
+        ds.add_new(0x00291020, "OB", bytes(24 * 1024))
+    else:
+        ds.VOILUTSequence = Sequence([voi_lut(4096)])
+        ds.add_new(0x00191010, "OB", bytes(8 * 1024))
+    ds.PixelData = bytes(2 * IMAGE_PIXELS * IMAGE_PIXELS)
+
+    with BytesIO() as f:
+        ds.save_as(f, write_like_original=False)
+        return f.getvalue()
+
+
+def clinical_record(patient, centre, date, positive):
+    """The clinical data of a patient, as in the uploaded files."""
+    record = {
+        "Pseudonym": patient["pseudonym"],
+        "SubmittingCentre": centre,
+        "Sex": "Male" if patient["sex"] == "M" else "Female",
+        "Age": patient["age"],
+        "SwabDate": date,
+        "SwabStatus": 1 if positive else 0,
+    }
+    if positive:
+        record.update(
+            {
+                "DateOfAdmission": date,
+                "Covid19": "Y",
+                "Temperature": 38.1,
+                "PaO2": 9.4,
+                "Fibrinogen": 4.2,
+                "Comorbidities": ["Hypertension"],
+                "Notes": "x" * 500,
+            }
+        )
+    return record
+
+
+def generate(
+    conn,
+    bucket=BUCKET_NAME,
+    patients=100,
+    images_per_patient=4,
+    orphan_ratio=0.05,
+    seed=42,
+):
+    """Upload the raw files of a synthetic warehouse into a bucket.
+
+    Parameters
+    ----------
+    conn : boto3.resources.base.ServiceResource
+        The S3 resource to create and fill the bucket with.
+    bucket : str, default=BUCKET_NAME
+        The warehouse bucket to create.
+    patients : int, default=100
+        The number of patients.
+    images_per_patient : int, default=4
+        The average number of images of a patient.
+    orphan_ratio : float, default=0.05
+        The ratio of patients with images, but no clinical data.
+    seed : int, default=42
+        The seed of the random choices (of the centres, dates, modalities).
+
+    Returns
+    -------
+    dict
+        The number of clinical data files, images (and of those, images
+        without clinical data) and bytes uploaded.
+    """
+    rng = random.Random(seed)
+    make_uid = UIDs(seed)
+    conn.create_bucket(Bucket=bucket)
+    config = {
+        "raw_prefixes": [f"{RAW_PREFIX}/"],
+        "training_percentage": 50,
+        "sites": SITES,
+    }
+    conn.meta.client.put_object(
+        Bucket=bucket, Key=CONFIG_KEY, Body=json.dumps(config)
+    )
+    centres = sum(SITES.values(), [])
+    start = datetime.date(2021, 1, 4)
+    counts = {"clinical": 0, "images": 0, "orphan_images": 0, "bytes": 0}
+
+    def upload(key, content):
+        conn.meta.client.put_object(Bucket=bucket, Key=key, Body=content)
+        counts["bytes"] += len(content)
+
+    for number in range(patients):
+        patient = {
+            "pseudonym": f"Covid{number:08d}",
+            "sex": rng.choice("MF"),
+            "age": rng.randint(18, 95),
+        }
+        date = start + datetime.timedelta(days=rng.randrange(60))
+        folder = f"{RAW_PREFIX}/{date.isoformat()}"
+        orphan = rng.random() < orphan_ratio
+        if not orphan:
+            positive = rng.random() < 0.7
+            record = clinical_record(
+                patient, rng.choice(centres), date.isoformat(), positive
+            )
+            filename = f"{patient['pseudonym']}_" + (
+                "data" if positive else "status"
+            )
+            upload(
+                f"{folder}/data/{filename}.json",
+                json.dumps(record).encode("utf-8"),
+            )
+            counts["clinical"] += 1
+
+        images = rng.randint(1, 2 * images_per_patient - 1)
+        modality = (
+            "CT" if images > images_per_patient else rng.choice(["CR", "DX"])
+        )
+        study = {"uid": make_uid(), "date": date.strftime("%Y%m%d")}
+        series = make_uid()
+        for instance in range(1, images + 1):
+            if modality != "CT" and instance > 1:
+                # X-ray images are in their own series
+                series = make_uid()
+            uid = make_uid()
+            upload(
+                f"{folder}/images/{uid}.dcm",
+                dicom_image(patient, study, series, modality, instance, uid),
+            )
+            counts["images"] += 1
+            counts["orphan_images"] += orphan
+    return counts
+
+
+def write_inventory(conn, bucket=BUCKET_NAME, fragments=4, date=None):
+    """Write the S3 inventory of a bucket from its current listing.
+
+    Parameters
+    ----------
+    conn : boto3.resources.base.ServiceResource
+        The S3 resource to use.
+    bucket : str, default=BUCKET_NAME
+        The warehouse bucket.
+    fragments : int, default=4
+        The number of gzipped CSV fragments to split the inventory into.
+    date : datetime.datetime, default=None
+        The date of the inventory (now if not given), later inventories are
+        taken over earlier ones.
+
+    Returns
+    -------
+    int
+        The number of objects listed.
+    """
+    date = date or datetime.datetime.utcnow()
+    inventory_bucket = f"{bucket}-inventory"
+    conn.create_bucket(Bucket=inventory_bucket)
+    rows = []
+    paginator = conn.meta.client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket):
+        for obj in page.get("Contents", []):
+            rows += [[bucket, obj["Key"], obj["Size"]]]
+
+    folder = f"data/{date:%Y-%m-%dT%H-%M-%S}"
+    fragment_size = max(1, -(-len(rows) // fragments))
+    fragment_names = []
+    for start in range(0, len(rows), fragment_size):
+        buff = StringIO()
+        csv.writer(buff).writerows(rows[start : start + fragment_size])
+        name = f"{folder}/fragment-{start}.csv.gz"
+        conn.meta.client.put_object(
+            Bucket=inventory_bucket,
+            Key=name,
+            Body=gzip.compress(buff.getvalue().encode()),
+        )
+        fragment_names += [f"s3://{inventory_bucket}/{name}"]
+    conn.meta.client.put_object(
+        Bucket=inventory_bucket,
+        Key=f"{bucket}/daily-full-inventory/hive/"
+        f"dt={date:%Y-%m-%d-%H-%M-%S}/symlink.txt",
+        Body="\n".join(fragment_names).encode(),
+    )
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--images-per-patient", type=int, default=4)
+    parser.add_argument("--fragments", type=int, default=4)
+    args = parser.parse_args()
+
+    with mock_s3():
+        conn = boto3.resource("s3", region_name="us-east-1")
+        counts = generate(
+            conn,
+            patients=args.patients,
+            images_per_patient=args.images_per_patient,
+        )
+        rows = write_inventory(conn, fragments=args.fragments)
+    print(
+        f"{counts['clinical']} clinical data files, {counts['images']} "
+        f"images ({counts['bytes'] / 1024 / 1024:.1f} MB), "
+        f"{rows} objects in the inventory"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,12 @@ setup(
         "pydicom==1.4.2",
         # internal data management
         "pandas==1.1.5",
+        # compact key sets
+        "numpy==1.19.5",
         "nccid_cleaning",
     ],
+    extras_require={
+        # Parquet/ORC inventory support
+        "columnar": ["pyarrow"],
+    },
 )
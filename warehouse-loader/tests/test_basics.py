@@ -1,15 +1,22 @@
+import json
 import pathlib
 
+import bonobo
 import pydicom
 import pytest
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
 
 import warehouse.components.constants as constants
 import warehouse.components.helpers as helpers
 import warehouse.components.services as services
 from warehouse.dataprocess import dicom_age_in_years
 from warehouse.warehouseloader import (
+    ImageHeader,
+    inplace_nullify,
     patient_in_training_set,
     process_dicom_data,
+    scrub_dicom,
 )
 
 
@@ -66,14 +73,126 @@ def test_process_dicom_data(input_file):
 
     test_file_json = test_file_name.replace(".dcm", ".json")
     image_data = pydicom.dcmread(test_file_name, stop_before_pixels=True)
+    header = ImageHeader.from_dataset(image_data)
+    assert header.patient_id == image_data.PatientID
+    assert header.study_id == image_data.StudyInstanceUID
+    assert header.series_id == image_data.SeriesInstanceUID
+    assert header.modality == image_data.Modality
     task, metadata_key, processed_image_data = next(
-        process_dicom_data("metadata", test_file_name, image_data)
+        process_dicom_data("metadata", test_file_name, header)
     )
     assert task == "upload"
     assert metadata_key == test_file_name
     with open(test_file_json, "r") as f:
         test_json = f.read().replace("\n", "")
-    assert test_json == processed_image_data
+    assert test_json.encode("utf-8") == processed_image_data
+
+
+@pytest.mark.parametrize(
+    "input_file",
+    [
+        "sample.dcm",
+        "1.3.6.1.4.1.11129.5.5.110503645592756492463169821050252582267888.dcm",
+    ],
+)
+def test_scrub_dicom(input_file):
+    """The single pass scrubber gives the same JSON as nullifying the
+    binary data and the VOI LUT sequences after the conversion."""
+    test_file_name = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / input_file
+    )
+    image_data = pydicom.dcmread(test_file_name, stop_before_pixels=True)
+    voi_lut = Dataset()
+    voi_lut.LUTDescriptor = [4096, 0, 12]
+    voi_lut.LUTData = b"\x01\x02" * 4096
+    image_data.VOILUTSequence = Sequence([voi_lut])
+    item = Dataset()
+    item.CodeValue = "CODE"
+    item.VOILUTSequence = Sequence([voi_lut])
+    item.add_new(0x00091010, "OB", b"binary")
+    item.add_new(0x00091011, "OB", b"")
+    image_data.add_new(0x00400275, "SQ", Sequence([item, Dataset()]))
+    image_data.add_new(0x00291010, "OB", bytes(1000))
+    image_data.add_new(0x00291020, "UN", b"")
+
+    expected = image_data.to_json_dict(bulk_data_threshold=1e20)
+    inplace_nullify(expected, "InlineBinary")
+    inplace_nullify(expected, "00283010")
+    scrubbed = scrub_dicom(image_data)
+    assert json.dumps(scrubbed) == json.dumps(expected)
+    assert scrubbed["00283010"] is None
+    assert scrubbed["00291010"] == {"vr": "OB", "InlineBinary": None}
+    assert scrubbed["00291020"] == {"vr": "UN"}
+
+
+@pytest.mark.parametrize("queue_size", [2, 10])
+def test_pipeline_strategy_queue_size(queue_size):
+    """The items sent on wait for the next step, instead of piling up."""
+    produced = []
+    ahead = []
+
+    def produce():
+        for item in range(200):
+            produced.append(item)
+            yield item
+
+    def consume(item):
+        ahead.append(len(produced) - item)
+
+    graph = bonobo.Graph()
+    graph.add_chain(produce, consume)
+    bonobo.run(graph, strategy=helpers.pipeline_strategy(queue_size))
+    assert len(ahead) == 200
+    # The queue, the item being consumed and the one waiting to be queued
+    assert max(ahead) <= queue_size + 2
+
+
+def test_stage_metrics(tmp_path):
+    """The calls, items and errors of each step are recorded."""
+
+    def produce():
+        yield from range(10)
+
+    def check(item):
+        if item == 3:
+            raise ValueError("Invalid item")
+        yield item
+
+    def discard(item):
+        pass
+
+    graph = bonobo.Graph()
+    graph.add_chain(produce, check, discard)
+    graph.add_chain(discard, _input=produce)
+    metrics = services.StageMetrics("test", buckets=(0.5, 1.0))
+    bonobo.run(graph, strategy=helpers.pipeline_strategy(metrics=metrics))
+
+    summary = metrics.save(
+        summary_file=str(tmp_path / "summary.json"),
+        prometheus_file=str(tmp_path / "metrics.prom"),
+    )
+    stages = summary["stages"]
+    assert set(stages) == {"produce", "check", "discard", "discard_2"}
+    assert stages["produce"]["items_out"] == 10
+    assert stages["check"]["calls"] == 10
+    assert stages["check"]["items_in"] == 10
+    assert stages["check"]["items_out"] == 9
+    assert stages["check"]["errors"] == 1
+    assert sum(stages["check"]["wall_histogram"]) == 10
+    assert stages["check"]["wall_histogram"][0] == 10
+    assert sorted(
+        [stages["discard"]["items_in"], stages["discard_2"]["items_in"]]
+    ) == [9, 10]
+    with open(tmp_path / "summary.json") as f:
+        assert json.load(f)["stages"] == stages
+    with open(tmp_path / "metrics.prom") as f:
+        prometheus = f.read().splitlines()
+    labels = 'pipeline="test",stage="check"'
+    assert f'warehouse_stage_wall_seconds_bucket{{{labels},le="+Inf"}} 10' in (
+        prometheus
+    )
+    assert f"warehouse_stage_wall_seconds_count{{{labels}}} 10" in prometheus
+    assert f"warehouse_stage_errors_total{{{labels}}} 1" in prometheus
 
 
 @pytest.mark.parametrize(
@@ -140,3 +259,35 @@ def test_pipeline_config_training_percent(value, expected):
     pipelineconfig.set_config(input_config)
 
     assert pipelineconfig.get_training_percentage() == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 8])
+def test_shard_partition(count):
+    """Each patient falls into exactly one shard, whatever the case and
+    surrounding whitespace of its ID."""
+    shards = [services.Shard(index, count) for index in range(count)]
+    patient_ids = [f"Covid{i}" for i in range(200)]
+    taken = [
+        [patient for patient in patient_ids if shard.includes(patient)]
+        for shard in shards
+    ]
+    assert sorted(sum(taken, [])) == sorted(patient_ids)
+    for shard in shards:
+        assert shard.includes(" Covid1") == shard.includes("COVID1")
+    if count > 1:
+        assert all(len(patients) < len(patient_ids) for patients in taken)
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [(None, None), ("", None), ("0/1", "0/1"), (" 3 / 4 ", "3/4")],
+)
+def test_shard_parse(value, expected):
+    shard = services.Shard.parse(value)
+    assert (None if shard is None else str(shard)) == expected
+
+
+@pytest.mark.parametrize("value", ["1", "4/4", "-1/4", "0/0", "a/b"])
+def test_shard_parse_invalid(value):
+    with pytest.raises(ValueError):
+        services.Shard.parse(value)
@@ -3,8 +3,16 @@ import datetime
 import gzip
 import json
 import math
+import os
 import pathlib
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO, StringIO
 
 import bonobo
@@ -12,24 +20,52 @@ import boto3
 import pydicom
 import pytest
 from botocore.exceptions import ClientError
-from moto import mock_s3
+from moto import mock_s3, mock_sqs
+
+try:
+    import pyarrow
+    import pyarrow.orc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 import warehouse.components.helpers as helpers
+import warehouse.components.services as services
 import warehouse.dataprocess as dataprocess
+import warehouse.events as events
 import warehouse.submittingcentres as submittingcentres
 import warehouse.warehouseloader as warehouseloader
 from warehouse.components.constants import (
     CONFIG_KEY,
     TRAINING_PREFIX,
     VALIDATION_PREFIX,
+    WATERMARK_KEY,
+    WRITE_MARKER_KEY,
 )
 from warehouse.components.services import (
+    AdaptiveLimiter,
     CacheContradiction,
+    ExistenceIndex,
     FileList,
+    HashedKeySet,
+    HeaderCache,
+    HeaderSizeStats,
     InventoryDownloader,
+    InventoryIndex,
+    MetadataManifests,
     PatientCache,
     PipelineConfig,
+    RawWatermarks,
+    RunForecast,
+    RunJournal,
     S3Client,
+    SQLiteQueue,
+    SQSQueue,
+    SeriesMetadataWriter,
+    Shard,
+    StageMetrics,
+    SubmittingCentreLookup,
+    pending_raw_images,
 )
 from warehouse.warehouseloader import PartialDicom
 
@@ -37,7 +73,15 @@ from warehouse.warehouseloader import PartialDicom
 ###
 # Helper
 ###
-def create_inventory(file_name_list, main_bucket_name, batches=1):
+def create_inventory(
+    file_name_list,
+    main_bucket_name,
+    batches=1,
+    sizes={},
+    fragment_format="csv",
+    modified={},
+    columns=("bucket", "key", "size", "last_modified_date"),
+):
     """Helper creating a (mock) inventory from a given file list
     and upload them to the relevant S3 bucket.
 
@@ -49,6 +93,15 @@ def create_inventory(file_name_list, main_bucket_name, batches=1):
         The main warehouse bucket, against which the inventory is created
     batches : int, default=1
         The (approximate) number of batches to break up the inventory (this many uploaded files)
+    sizes : dict, default={}
+        Object sizes to list for the given filenames (others are listed as 0)
+    fragment_format : str, default="csv"
+        The inventory format, "csv" (gzipped), "parquet", or "orc"
+    modified : dict, default={}
+        Last modified dates to list for the given filenames (a date column
+        is only added to CSV fragments if any is given)
+    columns : tuple, default=("bucket", "key", "size", "last_modified_date")
+        The order of the columns in Parquet and ORC fragments
     """
     batch_size = math.ceil(len(file_name_list) / batches)
 
@@ -63,14 +116,44 @@ def create_inventory(file_name_list, main_bucket_name, batches=1):
     chunk_names = []
     for chunk in chunks:
         mem_file = BytesIO()
-        with gzip.GzipFile(fileobj=mem_file, mode="wb") as gz:
-            buff = StringIO()
-            writer = csv.writer(buff, delimiter=",")
-            for test_file_name in chunk:
-                writer.writerow([main_bucket_name, test_file_name, 0])
-            gz.write(buff.getvalue().encode())
+        if fragment_format == "csv":
+            with gzip.GzipFile(fileobj=mem_file, mode="wb") as gz:
+                buff = StringIO()
+                writer = csv.writer(buff, delimiter=",")
+                for test_file_name in chunk:
+                    row = [
+                        main_bucket_name,
+                        test_file_name,
+                        sizes.get(test_file_name, 0),
+                    ]
+                    if modified:
+                        date = modified.get(test_file_name)
+                        row += [
+                            date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+                            if date
+                            else ""
+                        ]
+                    writer.writerow(row)
+                gz.write(buff.getvalue().encode())
+            suffix = "csv.gz"
+        else:
+            values = {
+                "bucket": [main_bucket_name] * len(chunk),
+                "key": chunk,
+                "size": [sizes.get(name, 0) for name in chunk],
+                "last_modified_date": pyarrow.array(
+                    [modified.get(name) for name in chunk],
+                    type=pyarrow.timestamp("ms", tz="UTC"),
+                ),
+            }
+            table = pyarrow.table({name: values[name] for name in columns})
+            if fragment_format == "parquet":
+                pyarrow.parquet.write_table(table, mem_file)
+            else:
+                pyarrow.orc.write_table(table, mem_file)
+            suffix = fragment_format
         mem_file.seek(0)
-        inventory_fragment_filename = f"{uuid.uuid4()}.csv.gz"
+        inventory_fragment_filename = f"{uuid.uuid4()}.{suffix}"
         conn.meta.client.upload_fileobj(
             mem_file, inventory_bucket_name, inventory_fragment_filename
         )
@@ -84,6 +167,78 @@ def create_inventory(file_name_list, main_bucket_name, batches=1):
     )
 
 
+def legacy_pending_raw_images(downloader, raw_prefixes):
+    """The pending raw image computation of FileList before it was answered
+    from the inventory index, re-reading the inventory for each fragment,
+    kept here to check that the results stay the same."""
+    raw_pattern = re.compile(
+        r"^(?P<raw_prefix>raw-.*)/\d{4}-\d{2}-\d{2}/images/(?P<filename>[^/]*)$"
+    )
+    processed_pattern = re.compile(
+        r"^(training|validation)/(xray|ct|mri).*/(?P<filename>[^/]*)$"
+    )
+    fragment_excludelist = set()
+    for _, fragment_reader in downloader.get_inventory():
+        raw_list = dict()
+        for row in fragment_reader:
+            key_match = raw_pattern.match(row[1])
+            if key_match and key_match.group("raw_prefix") in raw_prefixes:
+                raw_list[key_match.group("filename")] = row[1]
+        unprocessed = set(raw_list.keys())
+        unprocessed_json = {
+            key.replace(".dcm", ".json") for key in unprocessed
+        }
+        if len(unprocessed) == 0:
+            continue
+        for f, fragment_reader2 in downloader.get_inventory(
+            fragment_excludelist
+        ):
+            filenames = set()
+            for row in fragment_reader2:
+                item = processed_pattern.match(row[1])
+                if item:
+                    filenames.add(item.group("filename"))
+            if len(filenames) == 0:
+                fragment_excludelist.add(f)
+            unprocessed = unprocessed - filenames
+            unprocessed_json = unprocessed_json - filenames
+            if len(unprocessed) == 0 and len(unprocessed_json) == 0:
+                break
+        unprocessed |= {
+            key.replace(".json", ".dcm") for key in unprocessed_json
+        }
+        for unproc in unprocessed:
+            yield raw_list[unproc]
+
+
+def generate_warehouse_keys(images, seed):
+    """Helper generating a random mix of raw and processed image keys,
+    with images in each state of processing."""
+    rng = random.Random(seed)
+    keys = []
+    for i in range(images):
+        uid = f"1.2.826.0.{seed}.{i}"
+        raw_prefix = rng.choice(["raw-nhs-upload", "raw-acme-upload"])
+        date = f"2021-0{rng.randint(1, 9)}-{rng.randint(10, 28)}"
+        keys += [f"{raw_prefix}/{date}/images/{uid}.dcm"]
+        if rng.random() < 0.1:
+            # Uploaded again later
+            keys += [
+                f"{raw_prefix}/2021-10-{rng.randint(10, 28)}/images/{uid}.dcm"
+            ]
+        group = rng.choice([TRAINING_PREFIX, VALIDATION_PREFIX])
+        modality = rng.choice(["xray", "ct", "mri"])
+        state = rng.choice(["none", "image", "metadata", "both", "both"])
+        if state in ["image", "both"]:
+            keys += [f"{group}{modality}/Covid{i}/1.1/1.2/{uid}.dcm"]
+        if state in ["metadata", "both"]:
+            keys += [f"{group}{modality}-metadata/Covid{i}/1.1/1.2/{uid}.json"]
+        if rng.random() < 0.2:
+            keys += [f"{group}data/Covid{i}/data_{date}.json"]
+    rng.shuffle(keys)
+    return keys
+
+
 # Tests
 
 
@@ -125,6 +280,469 @@ def test_partial_dicom_download(initial_range_kb):
     assert k1 ^ k2 == set()
 
 
+@pytest.mark.parametrize(
+    "initial_range_kb",
+    [1, 5, 20, 50, 100, 500],
+)
+@mock_s3
+def test_partial_dicom_download_counters(initial_range_kb):
+    """Partial downloads only fetch each byte of the file once"""
+    test_file_name = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / "sample.dcm"
+    )
+    file_size = pathlib.Path(test_file_name).stat().st_size
+    bucket_name = "testbucket-12345"
+
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    conn.meta.client.upload_file(test_file_name, bucket_name, "sample.dcm")
+    s3client = S3Client(bucket=bucket_name)
+
+    partial = PartialDicom(
+        s3client, "sample.dcm", initial_range_kb=initial_range_kb
+    )
+    partial.download()
+
+    # Each request doubled the range, and only the new part was fetched
+    assert partial.range_kb == initial_range_kb * 2 ** (partial.requests - 1)
+    assert partial.bytes_fetched == min(file_size, partial.range_kb * 1024)
+
+
+@pytest.mark.parametrize("size", [1500, 2048])
+@mock_s3
+def test_partial_dicom_download_truncated(size):
+    """A file truncated within the header is downloaded in full once,
+    without asking for ranges beyond its end.
+    """
+    test_file_name = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / "sample.dcm"
+    )
+    # Make the header longer than the sizes tested
+    image_data = pydicom.dcmread(test_file_name)
+    image_data.ImageComments = "x" * 3000
+    with BytesIO() as f:
+        image_data.save_as(f)
+        content = f.getvalue()[:size]
+
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    conn.meta.client.put_object(
+        Bucket=bucket_name, Key="truncated.dcm", Body=content
+    )
+    s3client = S3Client(bucket=bucket_name)
+
+    partial = PartialDicom(s3client, "truncated.dcm", initial_range_kb=1)
+    image_data = partial.download()
+    assert image_data.PatientID == "0"
+    assert partial.bytes_fetched == size
+    assert partial.requests == math.ceil((size + 1) / 1024)
+
+
+@pytest.mark.parametrize(
+    "size,whole_file_kb,bytes_fetched",
+    [
+        # Unknown sizes, partial download
+        (None, 64, 1024),
+        (0, 64, 1024),
+        # Small file, downloaded whole
+        (263032, 512, 263032),
+        # Large file, partial download
+        (263032, 64, 1024),
+    ],
+)
+@mock_s3
+def test_partial_dicom_download_size(size, whole_file_kb, bytes_fetched):
+    """Known sizes let small files be downloaded at once"""
+    test_file_name = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / "sample.dcm"
+    )
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    conn.meta.client.upload_file(test_file_name, bucket_name, "sample.dcm")
+    s3client = S3Client(bucket=bucket_name)
+
+    partial = PartialDicom(
+        s3client,
+        "sample.dcm",
+        initial_range_kb=1,
+        size=size,
+        whole_file_kb=whole_file_kb,
+    )
+    image_data = partial.download()
+    assert image_data.PatientID == "0"
+    assert partial.requests == 1
+    assert partial.bytes_fetched == bytes_fetched
+    assert partial.header_length == 880
+
+
+@mock_s3
+def test_header_size_stats():
+    """Initial ranges are learned per prefix and persisted"""
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+
+    headerstats = HeaderSizeStats(
+        s3client, percentile=90, default_range_kb=20, min_samples=10
+    )
+    key_a = "raw-a/2021-01-01/images/1.dcm"
+    key_b = "raw-b/2021-01-01/images/1.dcm"
+    assert headerstats.initial_range_kb(key_a) == 20
+
+    # Not enough samples yet
+    for _ in range(9):
+        headerstats.record(key_a, 1000)
+    headerstats.record(key_a, None)
+    assert headerstats.initial_range_kb(key_a) == 20
+
+    # 90% of the images have short headers
+    headerstats.record(key_a, 3000)
+    assert headerstats.initial_range_kb(key_a) == 1
+    for _ in range(10):
+        headerstats.record(key_a, 100 * 1024)
+    assert headerstats.initial_range_kb(key_a) == 101
+    # Other prefixes are unaffected
+    assert headerstats.initial_range_kb(key_b) == 20
+
+    # Persisting between runs
+    headerstats.save()
+    loaded_stats = HeaderSizeStats(s3client)
+    assert loaded_stats.initial_range_kb(key_a) == 101
+    assert loaded_stats.initial_range_kb(key_b) == 20
+
+
+def test_header_cache(tmp_path):
+    """Deferred header records are kept between runs until resolved"""
+    store_path = str(tmp_path / "cache" / "headers.sqlite")
+    key = "raw-a/2021-01-01/images/1.dcm"
+    header = warehouseloader.ImageHeader(
+        "Covid1", "1.2.3", "1.2.3.4", "CR", b'{"00100020": {}}', 880
+    )
+    headercache = HeaderCache(store_path=store_path)
+    assert headercache.get(key) is None
+    headercache.defer(key, header)
+    assert key in headercache
+
+    # Kept between runs, and read without the pixel data position
+    loaded_cache = HeaderCache(store_path=store_path)
+    assert len(loaded_cache) == 1
+    assert list(loaded_cache.deferred()) == [(key, "Covid1")]
+    record = loaded_cache.get(key)
+    assert record == {
+        "patient_id": "Covid1",
+        "study_id": "1.2.3",
+        "series_id": "1.2.3.4",
+        "modality": "CR",
+        "metadata": b'{"00100020": {}}',
+        "header_length": 880,
+    }
+    assert loaded_cache.counters["hits"] == 1
+
+    # Dry runs only read the records
+    readonly_cache = HeaderCache(store_path=store_path, track_writes=False)
+    readonly_cache.resolve(key)
+    readonly_cache.defer("raw-a/2021-01-01/images/2.dcm", header)
+    assert len(HeaderCache(store_path=store_path)) == 1
+
+    loaded_cache.resolve(key)
+    assert loaded_cache.get(key) is None
+    assert loaded_cache.counters["resolved"] == 1
+    assert len(HeaderCache(store_path=store_path)) == 0
+
+
+@mock_s3
+def test_header_cache_bucket(tmp_path):
+    """Deferred header records are kept in the bucket for the runs without
+    the local store"""
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+    keys = [f"raw-a/2021-01-01/images/{index}.dcm" for index in range(3)]
+    header = warehouseloader.ImageHeader(
+        "Covid1", "1.2.3", "1.2.3.4", "CR", b'{"00100020": {}}', 880
+    )
+    headercache = HeaderCache(s3client=s3client)
+    assert len(headercache) == 0
+    for key in keys:
+        headercache.defer(key, header)
+    headercache.resolve(keys[0])
+    headercache.save()
+
+    # Loaded into an empty store, without any request for the images
+    loaded_cache = HeaderCache(
+        store_path=str(tmp_path / "headers.sqlite"), s3client=s3client
+    )
+    assert len(loaded_cache) == 2
+    assert loaded_cache.get(keys[0]) is None
+    assert loaded_cache.get(keys[1]) == {
+        "patient_id": "Covid1",
+        "study_id": "1.2.3",
+        "series_id": "1.2.3.4",
+        "modality": "CR",
+        "metadata": b'{"00100020": {}}',
+        "header_length": 880,
+    }
+    assert list(loaded_cache.deferred()) == [
+        (keys[1], "Covid1"),
+        (keys[2], "Covid1"),
+    ]
+
+    # A local store with records is not merged with the bucket's
+    loaded_cache.resolve(keys[1])
+    HeaderCache(track_writes=False, s3client=s3client).save()
+    assert (
+        len(
+            HeaderCache(
+                store_path=str(tmp_path / "headers.sqlite"), s3client=s3client
+            )
+        )
+        == 1
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 3, 20])
+@mock_s3
+def test_image_header_fetcher(workers):
+    """Concurrent image header downloads are passed on in the input
+    order, with the other items passed on unchanged, except the copies of
+    clinical data files that are already sent to the copy step, and the
+    images whose downloads failed.
+    """
+    test_file_name = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / "sample.dcm"
+    )
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+
+    image_keys = [
+        f"raw-nhs-upload/2021-03-01/images/{pydicom.uid.generate_uid()}.dcm"
+        for _ in range(10)
+    ]
+    for key in image_keys:
+        conn.meta.client.upload_file(test_file_name, bucket_name, key)
+    other_items = [
+        ("process", "raw-nhs-upload/2021-03-01/data/Covid1_data.json", None),
+        ("copy", "raw-nhs-upload/2021-03-01/data/Covid1_data.json", "x"),
+    ]
+    missing_key = "raw-nhs-upload/2021-03-01/images/missing.dcm"
+    inputs = other_items[:1] + [("process", key, None) for key in image_keys]
+    inputs += [("process", missing_key, None)] + other_items[1:]
+
+    results = []
+
+    def collect(*args):
+        results.append(args)
+
+    graph = bonobo.Graph()
+    graph.add_chain(
+        inputs, warehouseloader.ImageHeaderFetcher(workers=workers), collect
+    )
+    headerstats = HeaderSizeStats()
+    watermarks = RawWatermarks()
+    bonobo.run(
+        graph,
+        services={
+            "s3client": s3client,
+            "headerstats": headerstats,
+            "headercache": None,
+            "watermarks": watermarks,
+            "shard": None,
+        },
+    )
+
+    image_results = [item for item in results if item[1] in image_keys]
+    assert [key for _, key, _ in image_results] == image_keys
+    for task, _, header in image_results:
+        assert task == "process"
+        assert header.patient_id == "0"
+    assert [item for item in results if item[1] not in image_keys] == (
+        other_items[:1]
+    )
+    # The header lengths are collected
+    assert list(headerstats.samples["raw-nhs-upload"]) == [880] * 10
+    # The failed downloads are retried in later runs
+    watermarks.save()
+    assert watermarks.retries == {missing_key: None}
+
+
+@mock_s3
+def test_image_header_fetcher_shard():
+    """The images taken again from earlier runs, whose patients are known,
+    are only fetched and passed on by the shard of their patients."""
+    test_file_name = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / "sample.dcm"
+    )
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+
+    shard = Shard(0, 2)
+    patients = [f"Covid{index}" for index in range(20)]
+    inside = next(patient for patient in patients if shard.includes(patient))
+    outside = next(
+        patient for patient in patients if not shard.includes(patient)
+    )
+    keys = {
+        name: f"raw-nhs-upload/2021-03-01/images/{name}.dcm"
+        for name in ("retry_in", "retry_out", "cached_in", "cached_out", "new")
+    }
+    for key in keys.values():
+        conn.meta.client.upload_file(test_file_name, bucket_name, key)
+    watermarks = RawWatermarks()
+    watermarks.retries = {
+        keys["retry_in"]: inside,
+        keys["retry_out"]: outside,
+    }
+    headercache = HeaderCache()
+    for name, patient_id in (("cached_in", inside), ("cached_out", outside)):
+        headercache.defer(
+            keys[name],
+            warehouseloader.ImageHeader(
+                patient_id, "1.2.3", "1.2.3.4", "CR", b"{}", 880
+            ),
+        )
+
+    results = []
+
+    def collect(*args):
+        results.append(args)
+
+    graph = bonobo.Graph()
+    graph.add_chain(
+        [("process", key, None) for key in keys.values()],
+        warehouseloader.ImageHeaderFetcher(workers=2),
+        collect,
+    )
+    bonobo.run(
+        graph,
+        services={
+            "s3client": s3client,
+            "headerstats": HeaderSizeStats(),
+            "headercache": headercache,
+            "watermarks": watermarks,
+            "shard": shard,
+        },
+    )
+
+    # The new image's patient is only known from its header
+    assert {key for _, key, _ in results} == {
+        keys["retry_in"],
+        keys["cached_in"],
+        keys["new"],
+    }
+    # Only the headers of the images not in the header cache are downloaded
+    assert s3client.operations["GET"]["requests"] == 2
+
+
+@mock_s3
+def test_inventory_index():
+    """Test the classification of inventory keys in the InventoryIndex"""
+    main_bucket_name = "testbucket-12345"
+    raw_data = [
+        "raw-nhs-upload/2021-01-01/data/Covid1_data.json",
+        "raw-acme-upload/2021-01-02/data/Covid2_status.json",
+    ]
+    raw_images = [
+        "raw-nhs-upload/2021-01-01/images/1.2.3.dcm",
+        "raw-nhs-upload/2021-01-03/images/1.2.4.dcm",
+    ]
+    processed_data = [
+        "training/data/Covid1/data_2021-01-01.json",
+        "validation/data/Covid2/status_2021-01-02.json",
+    ]
+    processed_images = [
+        "training/xray/Covid1/1.1/1.2/1.2.3.dcm",
+        "training/xray-metadata/Covid1/1.1/1.2/1.2.3.json",
+        "validation/ct/Covid2/2.1/2.2/1.2.5.dcm",
+    ]
+    ignored = [
+        "config.json",
+        "raw-nhs-upload/2021-01-01/other/file.txt",
+        "training/readme.txt",
+    ]
+    sizes = {
+        "training/xray/Covid1/1.1/1.2/1.2.3.dcm": 1000,
+        "training/data/Covid1/data_2021-01-01.json": 10,
+        "validation/ct/Covid2/2.1/2.2/1.2.5.dcm": 500,
+        "raw-nhs-upload/2021-01-01/images/1.2.3.dcm": 1000,
+    }
+    create_inventory(
+        raw_data + raw_images + processed_data + processed_images + ignored,
+        main_bucket_name,
+        batches=3,
+        sizes=sizes,
+    )
+
+    inv_downloader = InventoryDownloader(
+        main_bucket=main_bucket_name, index_lists=InventoryIndex.LISTS
+    )
+    index = inv_downloader.get_index()
+    assert isinstance(index, InventoryIndex)
+    # The index is only built once
+    assert inv_downloader.get_index() is index
+
+    assert index.raw_data == [
+        ("raw-nhs-upload", raw_data[0]),
+        ("raw-acme-upload", raw_data[1]),
+    ]
+    assert sorted(index.raw_images) == [
+        ("raw-nhs-upload", raw_images[0], 1000),
+        ("raw-nhs-upload", raw_images[1], 0),
+    ]
+    assert index.processed_data == processed_data
+    assert index.processed_images == processed_images
+    assert len(index.processed_filenames) == 3
+    for filename in ["1.2.3.dcm", "1.2.3.json", "1.2.5.dcm"]:
+        assert filename in index.processed_filenames
+    assert "1.2.4.dcm" not in index.processed_filenames
+    assert len(index.processed_keys) == 5
+    for key in processed_data + processed_images:
+        assert key in index.processed_keys
+    assert raw_images[0] not in index.processed_keys
+    assert index.patient_groups == [
+        ("Covid1", "training"),
+        ("Covid2", "validation"),
+    ]
+    assert index.storage_sizes == {
+        "training/": 1010,
+        "training/data/": 10,
+        "training/xray/": 1000,
+        "training/xray-metadata/": 0,
+        "validation/": 500,
+        "validation/data/": 0,
+        "validation/ct/": 500,
+    }
+
+    # The patient groups are released once taken, and read again if needed
+    patient_groups, patient_modified = index.take_patient_groups()
+    assert patient_groups == [("Covid1", "training"), ("Covid2", "validation")]
+    assert len(patient_modified) == 2
+    assert index.patient_groups is None
+    assert index.patient_modified is None
+    assert index.take_patient_groups()[0] == patient_groups
+
+    # Only the lists asked for are kept, the processed ones are read from
+    # the inventory instead
+    index = InventoryIndex(inv_downloader, lists=("raw_data",))
+    assert len(index.raw_data) == 2
+    assert index.raw_images is None
+    assert index.processed_data is None
+    assert index.processed_images is None
+    assert index.patient_groups is None
+    assert len(index.processed_keys) == 5
+    assert list(index.iter_processed("data")) == processed_data
+    assert list(index.iter_processed("images")) == processed_images
+    with pytest.raises(ValueError):
+        InventoryIndex(inv_downloader, lists=("unknown",))
+
+
 @mock_s3
 def test_patientcache():
     """Test behaviour of the PatientCache for preloading cache
@@ -170,6 +788,531 @@ def test_patientcache():
     with pytest.raises(CacheContradiction, match=rf".* {patient_id}.*"):
         patientcache.add(patient_id, "training")
 
+    # Contradicting the patients from the inventory
+    patientcache.add("Covid1", "training")
+    with pytest.raises(CacheContradiction, match=r".* Covid1.*"):
+        patientcache.add("Covid1", "validation")
+    with pytest.raises(CacheContradiction, match=r".* Covid2.*"):
+        patientcache.add("Covid2", "training")
+    assert "Covid1" not in patientcache.store
+
+
+@mock_s3
+def test_patientcache_many():
+    """Test the PatientCache with many patients, some of them listed more
+    than once in the inventory, and with contradicting groups."""
+    main_bucket_name = "testbucket-12345"
+    rng = random.Random(0)
+    groups = {
+        f"Covid{i}": rng.choice(["training", "validation"]) for i in range(200)
+    }
+    test_file_names = [
+        f"{group}/data/{patient_id}/data_2020-09-0{day}.json"
+        for patient_id, group in groups.items()
+        for day in range(1, 3)
+    ]
+    create_inventory(test_file_names, main_bucket_name, batches=4)
+
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    patientcache = PatientCache(inv_downloader)
+    for patient_id, group in groups.items():
+        assert patientcache.get_group(patient_id) == group
+    assert patientcache.get_group("Covid200") is None
+    assert patientcache.store == dict()
+
+    # The same patient listed in both groups
+    other_group = (
+        "training" if groups["Covid7"] == "validation" else "validation"
+    )
+    main_bucket_name = "testbucket-67890"
+    create_inventory(
+        test_file_names
+        + [f"{other_group}/data/Covid7/status_2020-09-03.json"],
+        main_bucket_name,
+        batches=4,
+    )
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    with pytest.raises(CacheContradiction, match=r".* Covid7$"):
+        PatientCache(inv_downloader)
+
+
+@pytest.mark.parametrize("fragment_format", ["csv", "parquet"])
+@mock_s3
+def test_patientcache_snapshot(tmp_path, fragment_format):
+    """Test saving the PatientCache as a snapshot, and loading it with only
+    the inventory rows modified since the snapshot."""
+    if fragment_format != "csv" and pyarrow is None:
+        pytest.skip("pyarrow is not installed")
+    main_bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=main_bucket_name)
+    s3client = S3Client(bucket=main_bucket_name)
+    test_file_names = [
+        f"{TRAINING_PREFIX}data/Covid1/data_2020-09-01.json",
+        f"{VALIDATION_PREFIX}data/Covid2/status_2020-09-01.json",
+    ]
+    create_inventory(
+        test_file_names, main_bucket_name, fragment_format=fragment_format
+    )
+
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    patientcache = PatientCache(
+        inv_downloader, s3client, snapshot_dir=str(tmp_path)
+    )
+    patientcache.add("Covid10", "training")
+    assert (tmp_path / f"patients-{main_bucket_name}.npz").exists()
+    assert (tmp_path / f"patients-{main_bucket_name}.log").read_text() == (
+        "Covid10,training\n"
+    )
+
+    # Same inventory: only the snapshot and the journal are read
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    patientcache = PatientCache(inv_downloader, snapshot_dir=str(tmp_path))
+    assert inv_downloader._index is None
+    assert patientcache.get_group("Covid1") == "training"
+    assert patientcache.get_group("Covid2") == "validation"
+    assert patientcache.get_group("Covid10") == "training"
+    assert patientcache.store == dict()
+    # The journal is merged into the new snapshot
+    assert (tmp_path / f"patients-{main_bucket_name}.log").read_text() == ""
+
+    # Newer inventory: only the rows modified since the snapshot are taken
+    watermark = inv_downloader.inventory_date
+    test_file_names += [
+        f"{TRAINING_PREFIX}data/Covid3/data_2020-09-01.json",
+        f"{VALIDATION_PREFIX}data/Covid4/data_2020-09-01.json",
+        f"{VALIDATION_PREFIX}data/Covid5/data_2020-09-01.json",
+    ]
+    modified = {
+        test_file_names[2]: watermark - datetime.timedelta(days=3),
+        test_file_names[3]: watermark + datetime.timedelta(hours=1),
+    }
+    create_inventory(
+        test_file_names,
+        main_bucket_name,
+        fragment_format=fragment_format,
+        modified=modified,
+    )
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    inv_downloader.inventory_date = watermark + datetime.timedelta(days=1)
+    patientcache = PatientCache(inv_downloader, snapshot_dir=str(tmp_path))
+    assert patientcache.get_group("Covid1") == "training"
+    assert patientcache.get_group("Covid3") is None
+    assert patientcache.get_group("Covid4") == "validation"
+    assert patientcache.get_group("Covid5") == "validation"
+
+    # The snapshot in the bucket is used without a local one (the journal
+    # is only kept locally, those patients come with the next inventory)
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    patientcache = PatientCache(inv_downloader, s3client)
+    assert patientcache.get_group("Covid1") == "training"
+    assert patientcache.get_group("Covid3") is None
+    assert patientcache.get_group("Covid10") is None
+
+
+@mock_s3
+def test_patientcache_snapshot_contradiction(tmp_path):
+    main_bucket_name = "testbucket-12345"
+    create_inventory(
+        [f"{TRAINING_PREFIX}data/Covid1/data_2020-09-01.json"],
+        main_bucket_name,
+    )
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    patientcache = PatientCache(inv_downloader, snapshot_dir=str(tmp_path))
+    patientcache.add("Covid2", "validation")
+
+    # Not journaled without tracking the writes
+    patientcache = PatientCache(
+        inv_downloader, snapshot_dir=str(tmp_path), track_writes=False
+    )
+    assert patientcache.get_group("Covid2") == "validation"
+    patientcache.add("Covid3", "validation")
+    patientcache = PatientCache(inv_downloader, snapshot_dir=str(tmp_path))
+    assert patientcache.get_group("Covid3") is None
+
+    # A newer inventory contradicting the snapshot
+    create_inventory(
+        [f"{TRAINING_PREFIX}data/Covid2/data_2020-09-01.json"],
+        main_bucket_name,
+    )
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    inv_downloader.inventory_date += datetime.timedelta(days=1)
+    with pytest.raises(CacheContradiction, match=r".* Covid2$"):
+        PatientCache(inv_downloader, snapshot_dir=str(tmp_path))
+
+
+def test_hashed_key_set():
+    keys = [f"training/xray/Covid{i}/1.{i}.dcm" for i in range(1000)]
+    key_set = HashedKeySet(keys + keys[:10])
+    assert len(key_set) == 1000
+    assert all(key in key_set for key in keys)
+    assert "training/xray/Covid1000/1.1000.dcm" not in key_set
+
+    copied = key_set.copy()
+    copied.add("new-key")
+    copied.add(keys[0])
+    assert "new-key" in copied
+    assert len(copied) == 1001
+    assert "new-key" not in key_set
+    assert len(key_set) == 1000
+
+    assert len(HashedKeySet()) == 0
+    assert "key" not in HashedKeySet()
+
+
+class CountingS3Client(S3Client):
+    """S3 client counting the existence checks made."""
+
+    def __init__(self, bucket):
+        super().__init__(bucket)
+        self.head_requests = 0
+
+    def object_exists(self, key):
+        self.head_requests += 1
+        return super().object_exists(key)
+
+
+@pytest.mark.parametrize(
+    "marker_age_hours,verify_missing",
+    [(None, True), (0, True), (48, False)],
+)
+@mock_s3
+def test_existence_index(marker_age_hours, verify_missing):
+    """Test the ExistenceIndex answering from the inventory, and only
+    checking missing keys in S3 when writes might have happened since
+    the inventory was generated.
+    """
+    main_bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=main_bucket_name)
+    s3client = CountingS3Client(bucket=main_bucket_name)
+
+    inventory_keys = [
+        f"{TRAINING_PREFIX}data/Covid1/data_2020-09-01.json",
+        f"{VALIDATION_PREFIX}xray/Covid2/1.2.3/4.5.6/7.8.9.dcm",
+        "raw-nhs-upload/2020-09-01/data/Covid1_data.json",
+    ]
+    create_inventory(inventory_keys, main_bucket_name)
+    # Written after the inventory
+    late_key = f"{TRAINING_PREFIX}data/Covid3/data_2020-09-02.json"
+    s3client.put_object(late_key, "{}")
+    if marker_age_hours is not None:
+        last_write = datetime.datetime.now(
+            datetime.timezone.utc
+        ) - datetime.timedelta(hours=marker_age_hours)
+        s3client.put_object(
+            WRITE_MARKER_KEY,
+            json.dumps({"last_write": last_write.timestamp()}),
+        )
+
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    index = ExistenceIndex(inv_downloader, s3client)
+    assert index.verify_missing == verify_missing
+
+    # Processed keys in the inventory are answered locally
+    for key in inventory_keys[:2]:
+        assert index.exists(key)
+    assert s3client.head_requests == 0
+
+    # Raw keys are not indexed
+    assert not index.exists(inventory_keys[2])
+    # Missing keys are only checked when the inventory might be stale
+    assert index.exists(late_key) == verify_missing
+    assert s3client.head_requests == (2 if verify_missing else 0)
+
+    # Added keys are found, and the write marker is updated
+    new_key = f"{VALIDATION_PREFIX}data/Covid4/status_2020-09-02.json"
+    index.add(new_key)
+    assert index.exists(new_key)
+    marker = json.loads(s3client.object_content(WRITE_MARKER_KEY))
+    assert marker["last_write"] >= inv_downloader.inventory_date.timestamp()
+
+    # Without a client, missing keys are not checked
+    assert ExistenceIndex(inv_downloader).verify_missing is False
+
+
+@mock_s3
+def test_run_journal(tmp_path):
+    """Test the RunJournal recording the completed raw files, continuing
+    from the local or the bucket copy, and removing them at the end."""
+    main_bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=main_bucket_name)
+    s3client = S3Client(bucket=main_bucket_name)
+
+    def make_journal(**kwargs):
+        return RunJournal(
+            "journal-test",
+            s3client,
+            journal_dir=str(tmp_path),
+            sync_interval=datetime.timedelta(0),
+            **kwargs,
+        )
+
+    journal = make_journal()
+    journal.expect("raw/data.json", {"training/data.json": "copy"})
+    journal.expect("raw/image.dcm", {"image.dcm": "copy", "image.json": "x"})
+    journal.expect("raw/existing.dcm", {})
+    journal.written("training/data.json")
+    journal.written("image.dcm")
+    # Outputs not expected are ignored
+    journal.written("unknown.dcm")
+    assert journal.done("raw/data.json")
+    assert journal.done("raw/existing.dcm")
+    assert not journal.done("raw/image.dcm")
+    assert journal.completed["raw/image.dcm"] == {"copy"}
+    # The task is stopped here, halfway through writing a line
+    with open(journal.path, "a", encoding="utf-8") as f:
+        f.write("do")
+
+    # Continued from the local copy
+    journal = make_journal()
+    assert journal.done("raw/data.json")
+    assert journal.done("raw/existing.dcm")
+    assert not journal.done("raw/image.dcm")
+    assert len(journal.completed) == 3
+    journal.interrupted = True
+    journal.close()
+
+    # Continued from the bucket copy, on another machine
+    os.remove(journal.path)
+    journal = make_journal()
+    assert journal.done("raw/existing.dcm")
+    assert not journal.done("raw/image.dcm")
+
+    # Not written in dry runs
+    os.remove(journal.path)
+    journal = make_journal(track_writes=False)
+    journal.expect("raw/new.dcm", {})
+    assert journal.done("raw/new.dcm")
+    journal.close()
+    assert not os.path.exists(journal.path)
+    assert "raw/new.dcm" not in make_journal().completed
+
+    # Removed at the end of a complete run
+    journal = make_journal()
+    journal.close()
+    assert not os.path.exists(journal.path)
+    assert not s3client.object_exists(journal.key)
+    assert not make_journal().completed
+
+
+@mock_s3
+def test_series_metadata(tmp_path):
+    """Test writing the image metadata into per-series files, finding the
+    images in their manifests, and reading the files in dataprocess."""
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+    with open(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / "sample.json"
+    ) as f:
+        content = f.read().replace("\n", "")
+
+    series = [
+        f"{TRAINING_PREFIX}ct-metadata/Covid1/1.1/1.2",
+        f"{VALIDATION_PREFIX}xray-metadata/Covid2/2.1/2.2",
+    ]
+    metadata_keys = [
+        f"{series[0]}/{uid}.json" for uid in ["1.3.1", "1.3.2", "1.3.3"]
+    ] + [f"{series[1]}/2.3.1.json"]
+    manifests = MetadataManifests()
+    journal = RunJournal("test")
+    for key in metadata_keys:
+        journal.expect(key.replace("json", "dcm"), {key: "metadata"})
+    writer = SeriesMetadataWriter(
+        s3client, manifests=manifests, journal=journal, max_rows=2
+    )
+    # Only metadata files are collected
+    assert not writer.add(f"{TRAINING_PREFIX}data/Covid1/data.json", b"{}")
+    for key in metadata_keys:
+        assert writer.add(key, content.encode("utf-8"))
+    # The first series is written once it has enough images
+    assert writer.counters == {"images": 2, "series_files": 1, "manifests": 1}
+    assert journal.done(metadata_keys[0].replace("json", "dcm"))
+    assert not journal.done(metadata_keys[2].replace("json", "dcm"))
+    writer.flush()
+    assert writer.counters == {"images": 4, "series_files": 3, "manifests": 2}
+    assert all(
+        journal.done(key.replace("json", "dcm")) for key in metadata_keys
+    )
+    assert all(key in manifests for key in metadata_keys)
+
+    series_files = list(s3client.list_keys(series[0]))
+    assert len(series_files) == 2
+    assert all(key.endswith(".ndjson.gz") for key in series_files)
+    rows = [
+        gzip.decompress(s3client.object_content(key))
+        .decode("utf-8")
+        .splitlines()
+        for key in series_files
+    ]
+    assert sorted(len(file_rows) for file_rows in rows) == [1, 2]
+    assert all(row == content for file_rows in rows for row in file_rows)
+
+    # The manifests are loaded in the next run, and kept locally
+    for _ in range(2):
+        manifests = MetadataManifests(s3client, cache_dir=str(tmp_path))
+        assert manifests.manifests == 2
+        assert all(key in manifests for key in metadata_keys)
+        assert f"{series[0]}/1.3.4.json" not in manifests
+    assert len(os.listdir(tmp_path)) == 2
+
+    # Existence checks and pending images take the manifests into account
+    raw_images = [
+        f"raw-nhs-upload/2021-03-01/images/{uid}.dcm"
+        for uid in ["1.3.1", "1.3.4"]
+    ]
+    processed_images = [
+        f"{TRAINING_PREFIX}ct/Covid1/1.1/1.2/{uid}.dcm"
+        for uid in ["1.3.1", "1.3.4"]
+    ]
+    create_inventory(raw_images + processed_images, bucket_name)
+    inv_downloader = InventoryDownloader(main_bucket=bucket_name)
+    existenceindex = ExistenceIndex(
+        inv_downloader, s3client, manifests=manifests
+    )
+    assert existenceindex.exists(metadata_keys[0])
+    assert not existenceindex.exists(f"{series[0]}/1.3.4.json")
+    for filelist, pending in [
+        (FileList(inv_downloader, manifests=manifests), raw_images[1:]),
+        (FileList(inv_downloader), raw_images),
+    ]:
+        assert sorted(
+            filelist.get_pending_raw_images_list(
+                raw_prefixes={"raw-nhs-upload"}
+            )
+        ) == sorted(pending)
+
+    # dataprocess reads the first image of the series files
+    modality, record = next(
+        dataprocess.load_image_metadata_files(
+            "training", "ct", series_files[0], s3client=s3client
+        )
+    )
+    assert modality == "ct"
+    assert record["group"] == "training"
+    assert record["Pseudonym"] == "0"
+
+
+def test_adaptive_limiter():
+    """Test the AdaptiveLimiter halving its limit once per generation of
+    throttled requests, and ramping it up on success."""
+    limiter = AdaptiveLimiter(8, minimum=2, initial=8)
+    with limiter.slot() as generation:
+        assert limiter.in_flight == 1
+        # Requests started under the same limit only halve it once
+        limiter.throttled(generation)
+        limiter.throttled(generation)
+    assert limiter.in_flight == 0
+    assert limiter.limit == 4
+    for _ in range(3):
+        with limiter.slot() as generation:
+            limiter.throttled(generation)
+    assert limiter.limit == 2
+
+    for _ in range(100):
+        with limiter.slot():
+            limiter.succeeded()
+    assert limiter.limit == 8
+
+
+class FlakyClient:
+    """Wrapper of a boto3 client, failing the first calls of each method
+    with the given error code."""
+
+    def __init__(self, client, code, status, failures):
+        self._client = client
+        self.code = code
+        self.status = status
+        self.failures = failures
+        self.calls = 0
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise ClientError(
+                    {
+                        "Error": {"Code": self.code, "Message": "Test"},
+                        "ResponseMetadata": {"HTTPStatusCode": self.status},
+                    },
+                    name,
+                )
+            return method(*args, **kwargs)
+
+        return call
+
+
+@pytest.mark.parametrize(
+    "code,status,retried",
+    [("SlowDown", 503, "throttle"), ("InternalError", 500, "transient")],
+)
+@mock_s3
+def test_s3client_retries(code, status, retried):
+    """Test the S3Client retrying throttled and transient errors, and
+    counting the requests."""
+    main_bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=main_bucket_name)
+    s3client = S3Client(bucket=main_bucket_name, max_attempts=3, backoff=0)
+    s3client.put_object("key", "content")
+    assert s3client.counters == {
+        "requests": 1,
+        "retries": 0,
+        "throttles": 0,
+        "bytes": 7,
+    }
+
+    s3client._client = FlakyClient(s3client.client, code, status, 2)
+    assert s3client.object_content("key") == b"content"
+    assert s3client.counters == {
+        "requests": 4,
+        "retries": 2,
+        "throttles": 2 if retried == "throttle" else 0,
+        "bytes": 14,
+    }
+    limit = s3client.limiter.limit
+    if retried == "throttle":
+        assert limit < s3client.limiter.maximum
+    else:
+        assert limit == s3client.limiter.maximum
+
+    # Failing on all the attempts raises the last error
+    s3client._client = FlakyClient(s3client._client._client, code, status, 3)
+    with pytest.raises(ClientError) as error:
+        s3client.object_content("key")
+    assert error.value.response["Error"]["Code"] == code
+    assert s3client.counters["requests"] == 7
+
+
+@mock_s3
+def test_s3client_errors():
+    """Test the S3Client passing on the errors not to retry."""
+    main_bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=main_bucket_name)
+    s3client = S3Client(bucket=main_bucket_name, backoff=0)
+
+    assert not s3client.object_exists("missing")
+    with pytest.raises(ClientError) as error:
+        s3client.object_content("missing")
+    assert error.value.response["Error"]["Code"] == "NoSuchKey"
+
+    s3client._client = FlakyClient(s3client.client, "AccessDenied", 403, 1)
+    with pytest.raises(ClientError) as error:
+        s3client.object_exists("missing")
+    # The error of the request is passed on as it is
+    assert error.value.response["Error"]["Code"] == "AccessDenied"
+    assert s3client.counters["retries"] == 0
+
+    # At least one attempt has to be made of each request
+    with pytest.raises(ValueError):
+        S3Client(bucket=main_bucket_name, max_attempts=0)
+
 
 @mock_s3
 def test_filelist_raw_data():
@@ -269,6 +1412,76 @@ def test_pending_raw_images_list():
     assert nhs_pending_list == sorted(target_response)
 
 
+@mock_s3
+def test_pending_raw_images_list_other_prefix():
+    """Images of raw prefixes that are not configured don't shadow those
+    with the same filename in the configured prefixes."""
+    uid = pydicom.uid.generate_uid()
+    nhs_key = f"raw-nhs-upload/2021-02-28/images/{uid}.dcm"
+    main_bucket_name = "testbucket-12345"
+    create_inventory(
+        [nhs_key, f"raw-other-upload/2021-02-28/images/{uid}.dcm"],
+        main_bucket_name,
+        batches=1,
+    )
+
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    filelist = FileList(inv_downloader)
+    assert list(
+        filelist.get_pending_raw_images_list(raw_prefixes={"raw-nhs-upload"})
+    ) == [nhs_key]
+    assert list(
+        legacy_pending_raw_images(inv_downloader, {"raw-nhs-upload"})
+    ) == [nhs_key]
+
+
+@pytest.mark.parametrize("batches", [1, 3, 10])
+@pytest.mark.parametrize("seed", [1, 2, 3])
+@mock_s3
+def test_pending_raw_images_list_generated(batches, seed):
+    """The pending raw images are the same as with the previous,
+    per-fragment computation, on generated inventories."""
+    main_bucket_name = "testbucket-12345"
+    create_inventory(
+        generate_warehouse_keys(300, seed), main_bucket_name, batches=batches
+    )
+
+    inv_downloader = InventoryDownloader(main_bucket=main_bucket_name)
+    filelist = FileList(inv_downloader)
+    for raw_prefixes in [
+        set(),
+        {"raw-nhs-upload"},
+        {"raw-nhs-upload", "raw-acme-upload"},
+    ]:
+        pending = sorted(
+            filelist.get_pending_raw_images_list(raw_prefixes=raw_prefixes)
+        )
+        assert pending == sorted(
+            legacy_pending_raw_images(inv_downloader, raw_prefixes)
+        )
+        if raw_prefixes:
+            assert len(pending) > 0
+
+
+def test_pending_raw_images():
+    raw_images = [
+        ("raw-a", "raw-a/2021-01-01/images/1.dcm", 10),
+        ("raw-a", "raw-a/2021-01-01/images/2.dcm", None),
+        ("raw-a", "raw-a/2021-01-01/images/3.dcm", 30),
+        ("raw-a", "raw-a/2021-01-01/images/4.dcm", 40),
+        ("raw-b", "raw-b/2021-01-01/images/5.dcm", 50),
+    ]
+    processed_filenames = {"2.dcm", "2.json", "3.dcm", "4.json", "5.json"}
+    pending = list(
+        pending_raw_images(raw_images, processed_filenames, {"raw-a"})
+    )
+    assert pending == [
+        ("raw-a/2021-01-01/images/1.dcm", 10),
+        ("raw-a/2021-01-01/images/3.dcm", 30),
+        ("raw-a/2021-01-01/images/4.dcm", 40),
+    ]
+
+
 @mock_s3
 def test_processed_data_list():
 
@@ -333,6 +1546,240 @@ def test_inventory_downloader():
     assert set(some_fragments) == (set(range(batches)) - excludeline)
 
 
+@pytest.mark.parametrize(
+    "fragment_format",
+    [
+        "csv",
+        pytest.param(
+            "parquet",
+            marks=pytest.mark.skipif(pyarrow is None, reason="needs pyarrow"),
+        ),
+        pytest.param(
+            "orc",
+            marks=pytest.mark.skipif(pyarrow is None, reason="needs pyarrow"),
+        ),
+    ],
+)
+@mock_s3
+def test_inventory_downloader_formats(fragment_format, tmp_path):
+    """Reading the inventory rows from the supported formats"""
+    main_bucket_name = "test-bucket-1234"
+    test_file_names = [f"{pydicom.uid.generate_uid()}.dcm" for i in range(100)]
+    sizes = {name: i * 1000 for i, name in enumerate(test_file_names)}
+    create_inventory(
+        test_file_names,
+        main_bucket_name,
+        batches=3,
+        sizes=sizes,
+        fragment_format=fragment_format,
+    )
+
+    inv_downloader = InventoryDownloader(
+        main_bucket=main_bucket_name, cache_dir=str(tmp_path)
+    )
+    for _ in range(2):
+        # Read both from the bucket and from the local cache
+        rows = [
+            (row[0], row[1], int(row[2]))
+            for _, reader in inv_downloader.get_inventory()
+            for row in reader
+        ]
+        assert rows == [
+            (main_bucket_name, name, sizes[name]) for name in test_file_names
+        ]
+
+
+@pytest.mark.skipif(pyarrow is None, reason="needs pyarrow")
+@pytest.mark.parametrize("fragment_format", ["parquet", "orc"])
+@mock_s3
+def test_inventory_downloader_column_order(fragment_format, tmp_path):
+    """The inventory columns are read by name, whatever their order in
+    the fragments"""
+    main_bucket_name = "test-bucket-1234"
+    test_file_names = [f"{pydicom.uid.generate_uid()}.dcm" for i in range(10)]
+    sizes = {name: i * 1000 for i, name in enumerate(test_file_names)}
+    create_inventory(
+        test_file_names,
+        main_bucket_name,
+        sizes=sizes,
+        fragment_format=fragment_format,
+        columns=("size", "last_modified_date", "key", "bucket"),
+    )
+
+    inv_downloader = InventoryDownloader(
+        main_bucket=main_bucket_name, cache_dir=str(tmp_path)
+    )
+    rows = [
+        (row[1], int(row[2]))
+        for _, reader in inv_downloader.get_inventory()
+        for row in reader
+    ]
+    assert rows == [(name, sizes[name]) for name in test_file_names]
+
+
+@pytest.mark.skipif(pyarrow is None, reason="needs pyarrow")
+@mock_s3
+def test_inventory_downloader_parquet_without_orc(monkeypatch):
+    """Parquet inventories are read with a pyarrow built without ORC"""
+    main_bucket_name = "test-bucket-1234"
+    test_file_names = [f"{pydicom.uid.generate_uid()}.dcm" for i in range(10)]
+    create_inventory(
+        test_file_names, main_bucket_name, fragment_format="parquet"
+    )
+    monkeypatch.setitem(sys.modules, "pyarrow.orc", None)
+
+    inv_downloader = InventoryDownloader(
+        main_bucket=main_bucket_name, cache_dir=None
+    )
+    keys = [
+        row[1]
+        for _, reader in inv_downloader.get_inventory()
+        for row in reader
+    ]
+    assert keys == test_file_names
+
+
+@pytest.mark.parametrize("prefetch", [1, 3, 20])
+@pytest.mark.parametrize("ordered", [True, False])
+@mock_s3
+def test_inventory_downloader_prefetch(prefetch, ordered, tmp_path):
+    """Fragments downloaded ahead in the background give the same rows,
+    with at most the set number of fragments loaded ahead.
+    """
+    main_bucket_name = "test-bucket-1234"
+    test_file_names = [f"{pydicom.uid.generate_uid()}.dcm" for i in range(100)]
+    batches = 10
+    create_inventory(test_file_names, main_bucket_name, batches=batches)
+
+    inv_downloader = InventoryDownloader(
+        main_bucket=main_bucket_name,
+        cache_dir=str(tmp_path),
+        prefetch=prefetch,
+    )
+    loaded = []
+    load_fragment = inv_downloader._load_fragment
+
+    def counting_load_fragment(*args):
+        loaded.append(args[1])
+        return load_fragment(*args)
+
+    inv_downloader._load_fragment = counting_load_fragment
+
+    excludeline = {2, 3}
+    fragments = []
+    rows = []
+    for index, reader in inv_downloader.get_inventory(
+        excludeline=excludeline, ordered=ordered
+    ):
+        assert len(loaded) <= len(fragments) + 1 + prefetch
+        fragments.append(index)
+        rows += [row[1] for row in reader]
+
+    expected_fragments = [f for f in range(batches) if f not in excludeline]
+    expected_rows = [
+        name
+        for i, name in enumerate(test_file_names)
+        if i // 10 not in excludeline
+    ]
+    if ordered:
+        assert fragments == expected_fragments
+        assert rows == expected_rows
+    else:
+        assert sorted(fragments) == expected_fragments
+        assert sorted(rows) == sorted(expected_rows)
+
+
+@mock_s3
+def test_inventory_downloader_cache(tmp_path):
+    """Inventory fragments are downloaded once, and older inventories
+    are removed from the cache when it's full.
+    """
+    main_bucket_name = "test-bucket-1234"
+    test_file_names = [f"{pydicom.uid.generate_uid()}.dcm" for i in range(100)]
+    batches = 4
+    create_inventory(test_file_names, main_bucket_name, batches=batches)
+
+    # An older inventory in the cache
+    old_inventory = tmp_path / "old-inventory"
+    old_inventory.mkdir()
+    (old_inventory / "fragment.csv.gz").write_bytes(b"0" * 1024 * 1024)
+
+    inv_downloader = InventoryDownloader(
+        main_bucket=main_bucket_name, cache_dir=str(tmp_path), cache_size_mb=1
+    )
+    keys = [
+        row[1]
+        for _, reader in inv_downloader.get_inventory()
+        for row in reader
+    ]
+    assert keys == test_file_names
+    assert not old_inventory.exists()
+    cached = list(tmp_path.glob("*/*.csv.gz"))
+    assert len(cached) == batches
+
+    # Further iterations don't need the inventory bucket anymore
+    conn = boto3.resource("s3", region_name="us-east-1")
+    for fragment in inv_downloader.inventory_list:
+        conn.Object(f"{main_bucket_name}-inventory", fragment).delete()
+    keys = [
+        row[1]
+        for _, reader in inv_downloader.get_inventory()
+        for row in reader
+    ]
+    assert keys == test_file_names
+
+    # Without caching, fragments are downloaded again
+    inv_downloader = InventoryDownloader(
+        main_bucket=main_bucket_name, cache_dir=str(tmp_path), cache_size_mb=0
+    )
+    assert inv_downloader.cache_dir is None
+    with pytest.raises(SystemExit):
+        list(inv_downloader.get_inventory())
+
+
+@mock_s3
+def test_inventory_downloader_cache_concurrent(monkeypatch, tmp_path):
+    """Making room in the cache tolerates the inventories removed in the
+    meantime, and the fragments cached concurrently stay within the limit.
+    """
+    main_bucket_name = "test-bucket-1234"
+    test_file_names = [f"{pydicom.uid.generate_uid()}.dcm" for i in range(40)]
+    create_inventory(test_file_names, main_bucket_name)
+    inv_downloader = InventoryDownloader(
+        main_bucket=main_bucket_name, cache_dir=str(tmp_path), cache_size_mb=1
+    )
+
+    # An older inventory removed (e.g. by another process) while scanned
+    old_inventory = tmp_path / "old-inventory"
+    old_inventory.mkdir()
+    (old_inventory / "fragment.csv.gz").write_bytes(b"0" * 1024)
+    folder_size = services._folder_size
+
+    def removed_folder_size(path):
+        if path == str(old_inventory):
+            shutil.rmtree(path)
+        return folder_size(path)
+
+    monkeypatch.setattr(services, "_folder_size", removed_folder_size)
+    current = tmp_path / "current"
+    current.mkdir()
+    assert inv_downloader._make_room(1024, str(current))
+    monkeypatch.setattr(services, "_folder_size", folder_size)
+
+    # Fragments of 300kB cached from several threads, only 3 fit in
+    def cache(index):
+        path = current / f"fragment{index}.csv.gz"
+        with tempfile.NamedTemporaryFile(
+            dir=str(current), suffix=".part"
+        ) as f:
+            f.write(b"0" * 300 * 1024)
+            inv_downloader._cache(f, str(path))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(cache, range(8)))
+    assert len(list(current.glob("*.csv.gz"))) == 3
+
+
 @pytest.mark.parametrize(
     "key",
     ["testfile", "path/testfile", "path/subpath/testfile"],
@@ -508,6 +1955,129 @@ def test_get_submitting_centre():
         helpers.get_submitting_centre_from_key(s3client, key_valid + ".bak")
 
 
+@pytest.mark.parametrize("prefix_bytes", [None, 16, 64, 4096])
+@mock_s3
+def test_get_submitting_centre_ranged(prefix_bytes):
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+
+    contents = {
+        "first.json": {"SubmittingCentre": "Centre Á", "Other": "x" * 100},
+        "late.json": {"Notes": "y" * 100, "SubmittingCentre": "Late Centre"},
+        "missing.json": {"Pseudonym": "Covid123", "Notes": "z" * 100},
+    }
+    for key, content in contents.items():
+        conn.meta.client.put_object(
+            Bucket=bucket_name, Key=key, Body=json.dumps(content)
+        )
+    for key, content in contents.items():
+        assert helpers.get_submitting_centre_from_key(
+            s3client, key, prefix_bytes=prefix_bytes
+        ) == content.get("SubmittingCentre")
+
+    conn.meta.client.put_object(
+        Bucket=bucket_name,
+        Key="invalid.json",
+        Body=json.dumps(contents["late.json"])[:-5],
+    )
+    with pytest.raises(json.decoder.JSONDecodeError):
+        helpers.get_submitting_centre_from_key(
+            s3client, "invalid.json", prefix_bytes=prefix_bytes
+        )
+
+
+def test_find_json_field():
+    document = json.dumps(
+        {"A": [1, {"SubmittingCentre": "inner"}], "SubmittingCentre": 12345}
+    )
+    assert helpers.find_json_field(document, "SubmittingCentre") == 12345
+    assert helpers.find_json_field(document, "B") is None
+    assert helpers.find_json_field(" { } ", "SubmittingCentre") is None
+    # Can't tell from the beginning of the document
+    for end in [0, 5, 20, len(document) - 3, len(document) - 1]:
+        with pytest.raises(json.decoder.JSONDecodeError):
+            helpers.find_json_field(document[:end], "SubmittingCentre")
+    with pytest.raises(json.decoder.JSONDecodeError):
+        helpers.find_json_field("[1, 2]", "SubmittingCentre")
+
+
+@mock_s3
+def test_submitting_centre_lookup(tmp_path):
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+
+    keys = {
+        "raw-nhs-upload/2021-01-01/data/Covid1_data.json": "CentreA",
+        "raw-nhs-upload/2021-01-01/data/Covid2_status.json": "CentreB",
+        "raw-nhs-upload/2021-01-01/data/Covid3_data.json": None,
+        "raw-nhs-upload/2021-01-01/data/Covid4_data.json": "CentreD",
+    }
+    for key, centre in keys.items():
+        content = {"Pseudonym": "Covid"}
+        if centre is not None:
+            content["SubmittingCentre"] = centre
+        conn.meta.client.put_object(
+            Bucket=bucket_name, Key=key, Body=json.dumps(content)
+        )
+    store_path = str(tmp_path / "centres.sqlite")
+
+    lookup = SubmittingCentreLookup(
+        s3client, cache_size=2, store_path=store_path
+    )
+    for key, centre in keys.items():
+        assert lookup.get_centre(key) == centre
+    assert lookup.counters == {"hits": 0, "store_hits": 0, "misses": 4}
+    # Looked up by pseudonym, from memory
+    assert (
+        lookup.get_centre("raw-nhs-upload/2021-01-02/data/Covid2_data.json")
+        == "CentreB"
+    )
+    assert lookup.counters["hits"] == 1
+    # Dropped from memory, but kept in the store
+    assert lookup.get_centre(list(keys)[0]) == "CentreA"
+    assert lookup.counters == {"hits": 1, "store_hits": 1, "misses": 4}
+
+    # Next run, from the store without reading S3
+    conn.meta.client.delete_object(Bucket=bucket_name, Key=list(keys)[1])
+    lookup = SubmittingCentreLookup(s3client, store_path=store_path)
+    assert lookup.get_centre(list(keys)[1]) == "CentreB"
+    assert lookup.get_centre(list(keys)[1]) == "CentreB"
+    # Files without a centre are not read again either
+    assert lookup.get_centre(list(keys)[2]) is None
+    assert lookup.counters == {"hits": 1, "store_hits": 2, "misses": 0}
+
+
+@mock_s3
+def test_submitting_centre_lookup_status_first():
+    """A status file without a centre doesn't hide the centre in the data
+    file of the same patient."""
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+    status_key = "raw-nhs-upload/2021-01-01/data/Covid1_status.json"
+    data_key = "raw-nhs-upload/2021-01-02/data/Covid1_data.json"
+    conn.meta.client.put_object(
+        Bucket=bucket_name,
+        Key=status_key,
+        Body=json.dumps({"Pseudonym": "Covid1"}),
+    )
+    conn.meta.client.put_object(
+        Bucket=bucket_name,
+        Key=data_key,
+        Body=json.dumps({"Pseudonym": "Covid1", "SubmittingCentre": "Site A"}),
+    )
+
+    lookup = SubmittingCentreLookup(s3client)
+    assert lookup.get_centre(status_key) is None
+    assert lookup.get_centre(data_key) == "Site A"
+    assert lookup.counters == {"hits": 0, "store_hits": 0, "misses": 2}
+
+
 @mock_s3
 def test_load_config():
     bucket_name = "testbucket-12345"
@@ -657,20 +2227,72 @@ def test_submittingcentres_e2e(capsys):
             Bucket=bucket_name, Key=target_file, Body=file_content
         )
 
-    create_inventory(target_files + extra_files, bucket_name)
-
-    inv_downloader = InventoryDownloader(main_bucket=bucket_name)
-    filelist = FileList(inv_downloader)
+    create_inventory(target_files + extra_files, bucket_name)
+
+    inv_downloader = InventoryDownloader(main_bucket=bucket_name)
+    filelist = FileList(inv_downloader)
+    services = {
+        "config": config,
+        "filelist": filelist,
+        "s3client": s3client,
+        "centrelookup": SubmittingCentreLookup(s3client),
+    }
+    bonobo.run(submittingcentres.get_graph(), services=services)
+
+    with open("/tmp/message.txt", "r") as f:
+        output = f.read().splitlines()
+    assert output == ["CentreA", "CentreB", "CentreC"]
+
+
+@mock_s3
+def test_submittingcentres_failed_lookup():
+    """A lookup failing while still in flight at the end of the input only
+    leaves out the centre of that file."""
+
+    class SlowFailingLookup(SubmittingCentreLookup):
+        def get_centre(self, key):
+            if "Covid3" in key:
+                time.sleep(0.2)
+                raise RuntimeError("Lookup failed")
+            return super().get_centre(key)
+
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+    config = PipelineConfig()
+    input_config = {
+        "raw_prefixes": ["raw-nhs-upload/"],
+        "training_percentage": 0,
+        "sites": {"split": [], "training": [], "validation": []},
+    }
+    conn.meta.client.put_object(
+        Bucket=bucket_name, Key=CONFIG_KEY, Body=json.dumps(input_config)
+    )
+    next(warehouseloader.load_config(s3client, config))
+
+    target_files = [
+        f"raw-nhs-upload/2021-01-31/data/Covid{i}_data.json" for i in range(4)
+    ]
+    for i, target_file in enumerate(target_files):
+        file_content = json.dumps({"SubmittingCentre": f"Centre{i}"})
+        conn.meta.client.put_object(
+            Bucket=bucket_name, Key=target_file, Body=file_content
+        )
+    create_inventory(target_files, bucket_name)
+
     services = {
         "config": config,
-        "filelist": filelist,
+        "filelist": FileList(InventoryDownloader(main_bucket=bucket_name)),
         "s3client": s3client,
+        "centrelookup": SlowFailingLookup(s3client),
     }
-    bonobo.run(submittingcentres.get_graph(), services=services)
+    if os.path.exists("/tmp/message.txt"):
+        os.remove("/tmp/message.txt")
+    bonobo.run(submittingcentres.get_graph(workers=4), services=services)
 
     with open("/tmp/message.txt", "r") as f:
-        output = f.read().splitlines()
-    assert output == ["CentreA", "CentreB", "CentreC"]
+        assert f.read().splitlines() == ["Centre0", "Centre1", "Centre2"]
 
 
 ##
@@ -709,6 +2331,66 @@ def test_data_copy(task, old_key, new_key):
         assert not s3client.object_exists(new_key)
 
 
+@pytest.mark.parametrize("workers", [1, 4])
+@mock_s3
+def test_submittingcentres_incremental(tmp_path, workers):
+    """Run the submitting centres pipeline twice with a result store, the
+    second run without reading the clinical data files."""
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+    config = PipelineConfig()
+    input_config = {
+        "raw_prefixes": ["raw-nhs-upload/"],
+        "training_percentage": 0,
+        "sites": {"split": [], "training": [], "validation": []},
+    }
+    conn.meta.client.put_object(
+        Bucket=bucket_name, Key=CONFIG_KEY, Body=json.dumps(input_config)
+    )
+    next(warehouseloader.load_config(s3client, config))
+
+    target_files = [
+        f"raw-nhs-upload/2021-01-31/data/Covid{i}_data.json" for i in range(20)
+    ]
+    for i, target_file in enumerate(target_files):
+        file_content = json.dumps({"SubmittingCentre": f"Centre{i % 7}"})
+        conn.meta.client.put_object(
+            Bucket=bucket_name, Key=target_file, Body=file_content
+        )
+    create_inventory(target_files, bucket_name)
+    expected = sorted(f"Centre{i}" for i in range(7))
+
+    store_path = str(tmp_path / "centres.sqlite")
+    for run in range(2):
+        inv_downloader = InventoryDownloader(main_bucket=bucket_name)
+        centrelookup = SubmittingCentreLookup(s3client, store_path=store_path)
+        services = {
+            "config": config,
+            "filelist": FileList(inv_downloader),
+            "s3client": s3client,
+            "centrelookup": centrelookup,
+        }
+        if os.path.exists("/tmp/message.txt"):
+            os.remove("/tmp/message.txt")
+        bonobo.run(
+            submittingcentres.get_graph(workers=workers), services=services
+        )
+        with open("/tmp/message.txt", "r") as f:
+            assert f.read().splitlines() == expected
+        if run == 0:
+            assert centrelookup.counters["misses"] == 20
+            # The files are not read again
+            for target_file in target_files:
+                conn.meta.client.delete_object(
+                    Bucket=bucket_name, Key=target_file
+                )
+        else:
+            assert centrelookup.counters["store_hits"] == 20
+            assert centrelookup.counters["misses"] == 0
+
+
 @mock_s3
 def test_process_patient_data():
 
@@ -774,11 +2456,13 @@ def test_process_patient_data():
 
     inv_downloader = InventoryDownloader(main_bucket=bucket_name)
     patientcache = PatientCache(inv_downloader)
+    existenceindex = ExistenceIndex(inv_downloader, s3client)
 
     kwargs = {
         "config": config,
         "patientcache": patientcache,
-        "s3client": s3client,
+        "existenceindex": existenceindex,
+        "centrelookup": SubmittingCentreLookup(s3client),
     }
 
     # Not handled task
@@ -945,6 +2629,302 @@ def test_warehouseloader_extract_raw_files():
     key_set = set([key for _, key, _ in result_list])
     assert key_set ^ set(target_files) == set()
 
+    # Files completed in an earlier attempt are skipped
+    journal = RunJournal("test")
+    journal.expect(target_files[0], {})
+    journal.expect(target_files[4], {"copied": "copy"})
+    journal.expect(target_files[5], {"copied-5": "copy", "json": "metadata"})
+    journal.written("copied-5")
+    journal.written("json")
+    result_list = list(
+        warehouseloader.extract_raw_files_from_folder(
+            config, filelist, journal=journal
+        )
+    )
+    key_set = set([key for _, key, _ in result_list])
+    assert key_set == set(target_files) - {target_files[0], target_files[5]}
+    assert not journal.interrupted
+
+    # No files are taken once the time budget is used up
+    journal = RunJournal("test", budget=datetime.timedelta(0))
+    assert not list(
+        warehouseloader.extract_raw_files_from_folder(
+            config, filelist, journal=journal
+        )
+    )
+    assert journal.interrupted
+
+
+@mock_s3
+def test_extract_raw_files_since_watermarks():
+    """Test listing only the raw date folders since the watermarks."""
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+    config = PipelineConfig()
+    config.set_config(
+        {
+            "raw_prefixes": ["raw-nhs-upload/", "raw-acme-upload/"],
+            "training_percentage": 0,
+            "sites": {"split": [], "training": [], "validation": []},
+        }
+    )
+
+    old_files = [
+        "raw-nhs-upload/2021-01-31/data/Covid1_data.json",
+        "raw-nhs-upload/2021-01-31/images/1.2.3.dcm",
+        "raw-acme-upload/2021-02-27/data/Covid2_data.json",
+    ]
+    new_files = [
+        "raw-nhs-upload/2021-02-28/data/Covid3_data.json",
+        "raw-nhs-upload/2021-03-01/images/1.2.4.dcm",
+        "raw-acme-upload/2021-02-28/data/Covid4_data.json",
+        "raw-acme-upload/2021-03-02/images/1.2.5.dcm",
+    ]
+    create_inventory(old_files + new_files, bucket_name)
+    filelist = FileList(InventoryDownloader(main_bucket=bucket_name))
+    conn.meta.client.put_object(
+        Bucket=bucket_name,
+        Key=WATERMARK_KEY,
+        Body=json.dumps(
+            {
+                "watermarks": {
+                    "raw-nhs-upload": "2021-02-28",
+                    "raw-acme-upload": "2021-02-28",
+                }
+            }
+        ),
+    )
+
+    watermarks = RawWatermarks(s3client)
+    keys = [
+        key
+        for _, key, _ in warehouseloader.extract_raw_files_from_folder(
+            config, filelist, watermarks
+        )
+    ]
+    assert sorted(keys) == sorted(new_files)
+    watermarks.save()
+    assert RawWatermarks(s3client).watermarks == {
+        "raw-nhs-upload": "2021-03-01",
+        "raw-acme-upload": "2021-03-02",
+    }
+
+    # The latest folders are taken again
+    watermarks = RawWatermarks(s3client)
+    keys = [
+        key
+        for _, key, _ in warehouseloader.extract_raw_files_from_folder(
+            config, filelist, watermarks
+        )
+    ]
+    assert sorted(keys) == sorted(new_files[1::2])
+
+    # Full runs take everything
+    watermarks = RawWatermarks(s3client, full=True)
+    keys = [
+        key
+        for _, key, _ in warehouseloader.extract_raw_files_from_folder(
+            config, filelist, watermarks
+        )
+    ]
+    assert sorted(keys) == sorted(old_files + new_files)
+
+
+@mock_s3
+def test_extract_raw_files_retries():
+    """The images left unresolved in earlier runs are taken again in later
+    runs, before the watermarks too, until they are resolved."""
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+    config = PipelineConfig()
+    config.set_config(
+        {
+            "raw_prefixes": ["raw-nhs-upload/"],
+            "training_percentage": 0,
+            "sites": {"split": [], "training": [], "validation": []},
+        }
+    )
+    failed = "raw-nhs-upload/2021-01-31/images/1.2.3.dcm"
+    waiting = "raw-nhs-upload/2021-01-31/images/1.2.4.dcm"
+    processed = "raw-nhs-upload/2021-01-31/images/1.2.5.dcm"
+    new_image = "raw-nhs-upload/2021-03-01/images/1.2.6.dcm"
+    create_inventory(
+        [
+            failed,
+            waiting,
+            processed,
+            new_image,
+            "training/xray/Covid3/1/2/1.2.5.dcm",
+            "training/xray-metadata/Covid3/1/2/1.2.5.json",
+        ],
+        bucket_name,
+    )
+    filelist = FileList(InventoryDownloader(main_bucket=bucket_name))
+
+    # Left unresolved in the last run
+    watermarks = RawWatermarks(s3client)
+    watermarks.seen = {"raw-nhs-upload": "2021-02-28"}
+    watermarks.retry(failed)
+    watermarks.retry(waiting, "Covid2")
+    watermarks.retry(processed, "Covid3")
+    watermarks.save()
+
+    def extract():
+        watermarks = RawWatermarks(s3client)
+        keys = [
+            key
+            for _, key, _ in warehouseloader.extract_raw_files_from_folder(
+                config, filelist, watermarks
+            )
+        ]
+        watermarks.save()
+        return sorted(keys)
+
+    # Those still waiting for their patients are not taken again, and
+    # those processed since are resolved
+    assert extract() == [failed, new_image]
+    assert RawWatermarks(s3client).retries == {
+        failed: None,
+        waiting: "Covid2",
+    }
+
+    # Resolved when processed
+    watermarks = RawWatermarks(s3client)
+    watermarks.resolve(failed)
+    watermarks.save()
+    assert RawWatermarks(s3client).retries == {waiting: "Covid2"}
+    assert extract() == [new_image]
+
+    # A skipped clinical data file is taken again, with the images waiting
+    # for its patient, and resolved once it's not in the inventory anymore
+    skipped = "raw-nhs-upload/2021-01-31/data/Covid2_data.json"
+    removed = "raw-nhs-upload/2021-01-31/data/Covid5_data.json"
+    create_inventory(
+        [skipped, failed, waiting, processed, new_image], bucket_name
+    )
+    filelist = FileList(InventoryDownloader(main_bucket=bucket_name))
+    watermarks = RawWatermarks(s3client)
+    watermarks.retry(skipped)
+    watermarks.retry(removed)
+    watermarks.save()
+    assert extract() == [skipped, waiting, new_image]
+    assert RawWatermarks(s3client).retries == {
+        skipped: None,
+        waiting: "Covid2",
+    }
+
+
+def test_raw_watermarks_outputs():
+    """The raw files are only resolved once all their outputs are written,
+    and taken again if any of them fails."""
+    watermarks = RawWatermarks()
+    keys = [f"raw-a/2021-01-01/images/{index}.dcm" for index in range(5)]
+    for key in keys:
+        watermarks.retry(key, "Covid1")
+    watermarks.save()
+
+    # Nothing to write
+    watermarks.expect(keys[0], {})
+    # All written
+    watermarks.expect(keys[1], {"out/1.dcm": "copy", "out/1.json": "meta"})
+    watermarks.written("out/1.dcm")
+    watermarks.written("out/1.json")
+    # One of the outputs failed, before or after the other was written
+    watermarks.expect(keys[2], ["out/2.dcm", "out/2.json"])
+    watermarks.failed("out/2.dcm")
+    watermarks.written("out/2.json")
+    watermarks.expect(keys[3], ["out/3.dcm", "out/3.json"])
+    watermarks.written("out/3.dcm")
+    watermarks.failed("out/3.json")
+    # Neither written nor failed by the end of the run
+    watermarks.expect(keys[4], ["out/4.dcm"])
+    watermarks.save()
+    assert watermarks.retries == {keys[2]: None, keys[3]: None, keys[4]: None}
+
+    # Files not retried are noted when their outputs fail
+    new_key = "raw-a/2021-01-02/data/Covid1_data.json"
+    watermarks.expect(new_key, ["out/Covid1.json"])
+    watermarks.written("out/Covid1.json")
+    watermarks.save()
+    assert new_key not in watermarks.retries
+    watermarks.expect(new_key, ["out/Covid1.json"])
+    watermarks.failed("out/Covid1.json")
+    watermarks.save()
+    assert watermarks.retries[new_key] is None
+
+
+@mock_s3
+def test_failed_writes_retried():
+    """Clinical data files skipped, and raw files whose copies or uploads
+    failed, are noted to retry."""
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name, backoff=0)
+    config = PipelineConfig()
+    config.set_config(
+        {
+            "raw_prefixes": ["raw-nhs-upload/"],
+            "training_percentage": 0,
+            "sites": {"split": [], "training": ["CentreA"], "validation": []},
+        }
+    )
+    create_inventory([CONFIG_KEY], bucket_name)
+    inv_downloader = InventoryDownloader(main_bucket=bucket_name)
+    data_files = {
+        "raw-nhs-upload/2021-01-31/data/Covid1_data.json": "CentreA",
+        "raw-nhs-upload/2021-01-31/data/Covid2_data.json": "CentreB",
+        "raw-nhs-upload/2021-01-31/data/Covid3_data.json": None,
+    }
+    for key, centre in data_files.items():
+        conn.meta.client.put_object(
+            Bucket=bucket_name,
+            Key=key,
+            Body=json.dumps({"SubmittingCentre": centre}),
+        )
+    watermarks = RawWatermarks()
+    pipeline_services = {
+        "config": config,
+        "patientcache": PatientCache(inv_downloader),
+        "existenceindex": ExistenceIndex(inv_downloader, s3client),
+        "centrelookup": SubmittingCentreLookup(s3client),
+        "watermarks": watermarks,
+    }
+    copies = [
+        result
+        for key in data_files
+        for result in warehouseloader.process_patient_data(
+            "process", key, None, **pipeline_services
+        )
+    ]
+    # The unknown site and the missing centre are retried
+    assert [key for _, key, _ in copies] == list(data_files)[:1]
+
+    # The copy fails, the raw file missing
+    conn.meta.client.delete_object(Bucket=bucket_name, Key=copies[0][1])
+    with pytest.raises(ClientError):
+        warehouseloader.data_copy(
+            *copies[0], s3client=s3client, watermarks=watermarks
+        )
+    # The upload fails, to a missing bucket
+    missing_bucket = S3Client(bucket="missing-bucket-12345", backoff=0)
+    image_key = "raw-nhs-upload/2021-01-31/images/1.2.3.dcm"
+    watermarks.expect(image_key, ["training/xray-metadata/1.2.3.json"])
+    with pytest.raises(ClientError):
+        warehouseloader.upload_text_data(
+            "upload",
+            "training/xray-metadata/1.2.3.json",
+            b"{}",
+            s3client=missing_bucket,
+            watermarks=watermarks,
+        )
+    watermarks.save()
+    assert set(watermarks.retries) == set(data_files) | {image_key}
+
 
 @mock_s3
 def test_list_clinical_files():
@@ -1051,8 +3031,11 @@ def test_list_image_metadata_files():
         f"{TRAINING_PREFIX}xray-metadata/Covid7/1060/2020/3062.json",
         f"{TRAINING_PREFIX}xray-metadata/Covid7/1060/2021/3063.json",
         f"{TRAINING_PREFIX}xray-metadata/Covid7/1060/2021/3064.json",
+        # Per-series file
+        f"{TRAINING_PREFIX}ct-metadata/Covid8/1070/2070/20211001T000000-1.ndjson.gz",
     ]
     extra_files = [
+        "metadata-manifests/20211001T000000-1.json.gz",
         f"{TRAINING_PREFIX}xray/Covid1/1000/2000/3000.dcm",
         f"{TRAINING_PREFIX}ct/Covid2/1010/2010/3010.dcm",
         f"{TRAINING_PREFIX}mri/Covid3/1020/2020/3020.dcm",
@@ -1069,7 +3052,8 @@ def test_list_image_metadata_files():
     # Function under test
     results = list(dataprocess.list_image_metadata_files(filelist))
 
-    assert len(results) == 7
+    assert len(results) == 8
+    assert ("training", "ct", target_files[-1]) in results
 
     assert ("training", "xray", target_files[0]) in results
     assert ("training", "ct", target_files[1]) in results
@@ -1080,7 +3064,7 @@ def test_list_image_metadata_files():
 
     # find the result of multifile
     multi_file_result = [
-        item for item in results if item[2] in target_files[6:]
+        item for item in results if item[2] in target_files[6:-1]
     ][0]
     assert multi_file_result[0] == "training"
     assert multi_file_result[1] == "xray"
@@ -1095,14 +3079,15 @@ def test_list_image_metadata_files():
         ("CentreA", "CentreB", "training", None),
     ],
 )
+@pytest.mark.parametrize("sharded", [None, "in", "out"])
 @mock_s3
 def test_warehouseloader_e2e(
-    clinical_centre, config_centre, config_group, final_location
+    clinical_centre, config_centre, config_group, final_location, sharded
 ):
     """Full pipeline run of the pipeline test
 
     Single image file, checking processing and copying going to the right
-    place.
+    place, and nothing done in the shards without the patient.
     """
     test_file_name = (
         "1.3.6.1.4.1.11129.5.5.110503645592756492463169821050252582267888.dcm"
@@ -1166,13 +3151,55 @@ def test_warehouseloader_e2e(
     inv_downloader = InventoryDownloader(main_bucket=bucket_name)
     filelist = FileList(inv_downloader)
     patientcache = PatientCache(inv_downloader)
+    headerstats = HeaderSizeStats(s3client)
+    existenceindex = ExistenceIndex(inv_downloader, s3client)
+    shard = None
+    if sharded is not None:
+        shard = next(
+            shard
+            for shard in (Shard(index, 3) for index in range(3))
+            if shard.includes(patient_id) == (sharded == "in")
+        )
+        if sharded == "out":
+            final_location = None
     services = {
         "config": config,
         "filelist": filelist,
         "patientcache": patientcache,
         "s3client": s3client,
+        "headerstats": headerstats,
+        "existenceindex": existenceindex,
+        "centrelookup": SubmittingCentreLookup(s3client),
+        "watermarks": RawWatermarks(s3client),
+        "shard": shard,
+        "journal": None,
+        "seriesmetadata": None,
+        "forecast": None,
+        "headercache": None,
     }
-    bonobo.run(warehouseloader.get_graph(), services=services)
+    # With the smallest queues between the steps, to check they don't block
+    metrics = StageMetrics("warehouseloader")
+    bonobo.run(
+        warehouseloader.get_graph(),
+        services=services,
+        strategy=helpers.pipeline_strategy(2, metrics=metrics),
+    )
+
+    # The S3 requests are counted for the steps making them
+    stages = metrics.summary()["stages"]
+    assert stages["ImageHeaderFetcher"]["s3_requests"] > 0
+    assert stages["ImageHeaderFetcher"]["s3_bytes"] > 0
+    assert stages["extract_raw_files_from_folder"]["calls"] == 1
+    assert sum(stage["s3_requests"] for stage in stages.values()) <= (
+        s3client.counters["requests"]
+    )
+
+    # Header length statistics are saved for the next run
+    assert HeaderSizeStats(s3client).samples["raw-nhs-upload"][0] == 784
+    # The watermarks are moved on at the end of the run, unless sharded
+    assert RawWatermarks(s3client).watermarks == (
+        {"raw-nhs-upload": "2021-03-01"} if shard is None else {}
+    )
 
     if final_location is not None:
         # Image copied to the right place
@@ -1212,6 +3239,243 @@ def test_warehouseloader_e2e(
             assert not s3client.object_exists(clinical_file_data)
 
 
+@mock_s3
+def test_warehouseloader_forecast(monkeypatch, tmp_path):
+    """The dry run forecasts the writes of the real run, and the forecast
+    from the inventory alone makes no requests for the raw files."""
+    test_file_path = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / "sample.dcm"
+    )
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    input_config = {
+        "raw_prefixes": ["raw-nhs-upload/"],
+        "training_percentage": 0,
+        "sites": {"split": [], "training": ["CentreA"], "validation": []},
+    }
+    conn.meta.client.put_object(
+        Bucket=bucket_name, Key=CONFIG_KEY, Body=json.dumps(input_config)
+    )
+
+    # Covid0 is already in a group, Covid2 has no clinical data yet
+    image_sizes = dict()
+    for patient in range(3):
+        image_data = pydicom.dcmread(test_file_path)
+        image_data.PatientID = f"Covid{patient}"
+        image_data.Modality = "CR"
+        uid = image_data.SOPInstanceUID = pydicom.uid.generate_uid()
+        with BytesIO() as f:
+            image_data.save_as(f)
+            content = f.getvalue()
+        key = f"raw-nhs-upload/2021-03-01/images/{uid}.dcm"
+        conn.meta.client.put_object(Bucket=bucket_name, Key=key, Body=content)
+        image_sizes[key] = len(content)
+    orphan_image = key
+    clinical_files = [
+        "raw-nhs-upload/2021-03-01/data/Covid0_data.json",
+        "raw-nhs-upload/2021-03-01/data/Covid1_data.json",
+    ]
+    for clinical_file in clinical_files:
+        conn.meta.client.put_object(
+            Bucket=bucket_name,
+            Key=clinical_file,
+            Body=json.dumps({"SubmittingCentre": "CentreA"}),
+        )
+    processed_file = "training/data/Covid0/data_2021-03-01.json"
+    conn.meta.client.put_object(Bucket=bucket_name, Key=processed_file)
+    create_inventory(
+        list(image_sizes) + clinical_files + [processed_file],
+        bucket_name,
+        sizes=image_sizes,
+    )
+
+    def run(forecast, **options):
+        s3client = S3Client(bucket=bucket_name)
+        inv_downloader = InventoryDownloader(main_bucket=bucket_name)
+        services = {
+            "config": PipelineConfig(),
+            "filelist": FileList(inv_downloader),
+            "patientcache": PatientCache(inv_downloader),
+            "s3client": s3client,
+            "headerstats": HeaderSizeStats(s3client),
+            "existenceindex": ExistenceIndex(
+                inv_downloader, s3client, track_writes=forecast is None
+            ),
+            "centrelookup": SubmittingCentreLookup(s3client),
+            "watermarks": RawWatermarks(s3client),
+            "shard": None,
+            "journal": None,
+            "seriesmetadata": None,
+            "forecast": forecast,
+            "headercache": None,
+        }
+        requests_before = s3client.counters["requests"]
+        bonobo.run(warehouseloader.get_graph(**options), services=services)
+        return s3client, s3client.counters["requests"] - requests_before
+
+    # From the inventory, only the configuration is read
+    forecast = RunForecast(latency_ms=100)
+    s3client, requests = run(forecast, forecast_only=True)
+    assert requests == 1
+    assert forecast.counters["copies"] == 4
+    assert forecast.counters["copy_bytes"] == sum(image_sizes.values())
+    assert forecast.counters["metadata_files"] == 3
+    report = forecast.report(
+        s3client, forecast_file=str(tmp_path / "forecast.json")
+    )
+    # The headers and a submitting centre, and the missing keys checked
+    assert report["requests"]["GET"] == s3client.operations["GET"][
+        "requests"
+    ] + (3 + 1)
+    assert report["requests"]["HEAD"] == 3 * 2 + 1
+    assert report["requests"]["COPY"] == 4
+    assert report["latency_ms"]["COPY"] == 100
+    assert report["estimated_seconds"] >= 0.7
+    with open(tmp_path / "forecast.json") as f:
+        assert json.load(f) == report
+
+    monkeypatch.setattr(warehouseloader, "DRY_RUN", True)
+    dry_forecast = RunForecast()
+    run(dry_forecast)
+    assert not conn.meta.client.list_objects_v2(
+        Bucket=bucket_name, Prefix="training/xray"
+    ).get("Contents")
+
+    monkeypatch.setattr(warehouseloader, "DRY_RUN", False)
+    s3client, _ = run(None)
+    metadata_files = conn.meta.client.list_objects_v2(
+        Bucket=bucket_name, Prefix="training/xray-metadata"
+    )["Contents"]
+    assert dry_forecast.counters["copies"] == 3
+    assert dry_forecast.counters["copies"] == (
+        s3client.operations["COPY"]["requests"]
+    )
+    assert dry_forecast.counters["metadata_files"] == len(metadata_files)
+    assert dry_forecast.counters["copy_bytes"] == sum(
+        size for key, size in image_sizes.items() if key != orphan_image
+    )
+    assert dry_forecast.counters["metadata_bytes"] == sum(
+        item["Size"] for item in metadata_files
+    )
+
+
+@pytest.mark.parametrize("keep_headers", [True, False])
+@mock_s3
+def test_warehouseloader_deferred_images(monkeypatch, tmp_path, keep_headers):
+    """Images without patient data are deferred, and processed once the
+    patient data arrives, even in date folders before the watermarks: from
+    their kept headers, or downloaded again if the local header cache is
+    lost between the runs (as on hosts without persistent storage)."""
+    test_file_path = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / "sample.dcm"
+    )
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    input_config = {
+        "raw_prefixes": ["raw-nhs-upload/"],
+        "training_percentage": 0,
+        "sites": {"split": [], "training": ["CentreA"], "validation": []},
+    }
+    conn.meta.client.put_object(
+        Bucket=bucket_name, Key=CONFIG_KEY, Body=json.dumps(input_config)
+    )
+    image_data = pydicom.dcmread(test_file_path)
+    image_data.PatientID = "Covid9"
+    image_data.Modality = "CR"
+    with BytesIO() as f:
+        image_data.save_as(f)
+        content = f.getvalue()
+    image_name = f"{image_data.SOPInstanceUID}.dcm"
+    image_file = f"raw-nhs-upload/2021-03-01/images/{image_name}"
+    conn.meta.client.put_object(
+        Bucket=bucket_name, Key=image_file, Body=content
+    )
+    raw_files = [CONFIG_KEY, image_file]
+
+    def upload_clinical_file(key):
+        conn.meta.client.put_object(
+            Bucket=bucket_name,
+            Key=key,
+            Body=json.dumps({"SubmittingCentre": "CentreA"}),
+        )
+        raw_files.append(key)
+        create_inventory(raw_files, bucket_name)
+
+    def run():
+        s3client = S3Client(bucket=bucket_name)
+        inv_downloader = InventoryDownloader(main_bucket=bucket_name)
+        headercache = HeaderCache(
+            store_path=str(tmp_path / "headers.sqlite")
+            if keep_headers
+            else None
+        )
+        services = {
+            "config": PipelineConfig(),
+            "filelist": FileList(inv_downloader),
+            "patientcache": PatientCache(inv_downloader),
+            "s3client": s3client,
+            "headerstats": HeaderSizeStats(s3client),
+            "existenceindex": ExistenceIndex(inv_downloader, s3client),
+            "centrelookup": SubmittingCentreLookup(s3client),
+            "watermarks": RawWatermarks(s3client),
+            "shard": None,
+            "journal": None,
+            "seriesmetadata": None,
+            "forecast": None,
+            "headercache": headercache,
+        }
+        bonobo.run(warehouseloader.get_graph(), services=services)
+        return headercache
+
+    # Only another patient's data has arrived, moving the watermarks on
+    upload_clinical_file("raw-nhs-upload/2021-03-03/data/Covid1_data.json")
+    headercache = run()
+    assert headercache.counters["deferred"] == 1
+    assert list(headercache.deferred()) == [(image_file, "Covid9")]
+    assert RawWatermarks(S3Client(bucket=bucket_name)).retries == {
+        image_file: "Covid9"
+    }
+    image_prefix = "training/xray/Covid9/"
+    assert not conn.meta.client.list_objects_v2(
+        Bucket=bucket_name, Prefix=image_prefix
+    ).get("Contents")
+
+    # The image's date folder is not taken again, and its header is not
+    # downloaded again
+    def no_download(self):
+        raise AssertionError(f"Downloaded {self.key}")
+
+    # Not taken again while the patient data is missing
+    upload_clinical_file("raw-nhs-upload/2021-03-04/data/Covid2_data.json")
+    monkeypatch.setattr(PartialDicom, "download_header", no_download)
+    headercache = run()
+    assert headercache.counters["hits"] == 0
+    monkeypatch.undo()
+
+    if keep_headers:
+        monkeypatch.setattr(PartialDicom, "download_header", no_download)
+    upload_clinical_file("raw-nhs-upload/2021-03-05/data/Covid9_data.json")
+    headercache = run()
+    assert headercache.counters["hits"] == (1 if keep_headers else 0)
+    assert len(headercache) == 0
+    assert RawWatermarks(S3Client(bucket=bucket_name)).retries == {}
+    study_id = image_data.StudyInstanceUID
+    series_id = image_data.SeriesInstanceUID
+    image_key = f"{image_prefix}{study_id}/{series_id}/{image_name}"
+    assert S3Client(bucket=bucket_name).object_exists(image_key)
+    metadata_key = (
+        f"training/xray-metadata/Covid9/{study_id}/{series_id}/"
+        + image_name.replace(".dcm", ".json")
+    )
+    metadata = json.loads(
+        S3Client(bucket=bucket_name).object_content(metadata_key)
+    )
+    uploaded_data = pydicom.dcmread(BytesIO(content), stop_before_pixels=True)
+    assert metadata == warehouseloader.scrub_dicom(uploaded_data)
+
+
 @pytest.mark.parametrize(
     "clinical_files",
     ["data", "status", "mixed"],
@@ -1258,3 +3522,236 @@ def test_dataprocess_load_clinical_files(clinical_files):
 
     assert result[0] == "patient"
     assert result[1] == target_result
+
+
+def s3_notification(bucket_name, key, size=None):
+    """An S3 object created event notification message body."""
+    s3_object = {"key": key.replace(" ", "+")}
+    if size is not None:
+        s3_object["size"] = size
+    return json.dumps(
+        {
+            "Records": [
+                {
+                    "eventName": "ObjectCreated:Put",
+                    "s3": {
+                        "bucket": {"name": bucket_name},
+                        "object": s3_object,
+                    },
+                }
+            ]
+        }
+    )
+
+
+def test_created_objects():
+    body = s3_notification("bucket", "raw-a/2021-01-01/data/A B_data.json", 10)
+    assert list(events.created_objects(body)) == [
+        ("bucket", "raw-a/2021-01-01/data/A B_data.json", 10)
+    ]
+    test_event = json.dumps({"Event": "s3:TestEvent", "Bucket": "bucket"})
+    assert list(events.created_objects(test_event)) == []
+    assert list(events.created_objects("not json")) == []
+
+
+@pytest.mark.parametrize("region", ["us-east-1", "eu-west-2"])
+@mock_sqs
+def test_sqs_queue(monkeypatch, region):
+    # The region is taken from the queue URL
+    monkeypatch.delenv("AWS_DEFAULT_REGION", raising=False)
+    sqs = boto3.client("sqs", region_name=region)
+    url = sqs.create_queue(QueueName="notifications")["QueueUrl"]
+    queue = SQSQueue(url)
+    queue.send("message")
+    messages = queue.receive()
+    assert [body for _, body in messages] == ["message"]
+    queue.delete(messages[0][0])
+    assert queue.receive() == []
+
+
+@pytest.mark.parametrize(
+    "url,region",
+    [
+        (
+            "https://sqs.eu-west-2.amazonaws.com/123456789012/queue",
+            "eu-west-2",
+        ),
+        (
+            "https://eu-west-2.queue.amazonaws.com/123456789012/queue",
+            "eu-west-2",
+        ),
+        ("https://queue.amazonaws.com/123456789012/queue", "us-east-1"),
+        ("https://localhost:9324/123456789012/queue", None),
+    ],
+)
+def test_sqs_queue_url_region(url, region):
+    assert SQSQueue.url_region(url) == region
+
+
+def test_sqlite_queue(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / "queue.sqlite"), visibility_timeout=60)
+    for message in range(3):
+        queue.send(f"message{message}")
+    messages = queue.receive(max_messages=2)
+    assert [body for _, body in messages] == ["message0", "message1"]
+    # Hidden while being processed
+    assert [body for _, body in queue.receive()] == ["message2"]
+    assert queue.receive() == []
+    queue.delete(messages[0][0])
+    assert len(queue) == 2
+
+    queue = SQLiteQueue(str(tmp_path / "queue.sqlite"), visibility_timeout=0)
+    queue.send("message3")
+    assert [body for _, body in queue.receive()] == ["message3"]
+    assert [body for _, body in queue.receive()] == ["message3"]
+
+
+@mock_s3
+def test_events_consume(tmp_path):
+    """Process new uploads from their event notifications, with the image
+    arriving before the clinical data of its patient."""
+    test_file_name = (
+        "1.3.6.1.4.1.11129.5.5.110503645592756492463169821050252582267888.dcm"
+    )
+    test_file_path = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / test_file_name
+    )
+    patient_id = "Covid0000"
+    series_path = (
+        "1.3.6.1.4.1.11129.5.5.112507010803284478207522016832191866964708/"
+        + "1.3.6.1.4.1.11129.5.5.112630850362182468372440828755218293352329"
+    )
+
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+    config = PipelineConfig()
+    config.set_config(
+        {
+            "raw_prefixes": ["raw-nhs-upload/"],
+            "training_percentage": 0,
+            "sites": {"split": [], "training": ["CentreA"], "validation": []},
+        }
+    )
+    create_inventory([CONFIG_KEY], bucket_name)
+    inv_downloader = InventoryDownloader(main_bucket=bucket_name)
+    pipeline_services = {
+        "config": config,
+        "s3client": s3client,
+        "patientcache": PatientCache(inv_downloader),
+        "headerstats": HeaderSizeStats(s3client),
+        "existenceindex": ExistenceIndex(inv_downloader, s3client),
+        "centrelookup": SubmittingCentreLookup(s3client),
+    }
+    queue = SQLiteQueue(str(tmp_path / "queue.sqlite"), visibility_timeout=0)
+
+    image_file = f"raw-nhs-upload/2021-03-01/images/{test_file_name}"
+    conn.meta.client.upload_file(test_file_path, bucket_name, image_file)
+    queue.send(s3_notification(bucket_name, image_file, 1000000))
+    clinical_file = f"raw-nhs-upload/2021-03-01/data/{patient_id}_data.json"
+    conn.meta.client.put_object(
+        Bucket=bucket_name,
+        Key=clinical_file,
+        Body=json.dumps(
+            {"Pseudonym": patient_id, "SubmittingCentre": "CentreA"}
+        ),
+    )
+    queue.send(s3_notification(bucket_name, clinical_file))
+    queue.send(s3_notification("other-bucket", clinical_file))
+    queue.send(s3_notification(bucket_name, "raw-other/2021-03-01/x.json"))
+
+    # The image is left in the queue until its patient is known
+    assert events.consume(queue, pipeline_services, rounds=1) == 3
+    assert len(queue) == 1
+    assert s3client.object_exists(
+        f"training/data/{patient_id}/data_2021-03-01.json"
+    )
+    assert events.consume(queue, pipeline_services, rounds=1) == 1
+    assert len(queue) == 0
+    assert s3client.object_exists(
+        f"training/xray/{patient_id}/{series_path}/{test_file_name}"
+    )
+    assert s3client.object_exists(
+        f"training/xray-metadata/{patient_id}/{series_path}/"
+        + test_file_name.replace(".dcm", ".json")
+    )
+
+
+@mock_s3
+def test_events_consume_failed_write(monkeypatch, tmp_path):
+    """An image whose copy failed is copied when its notification is
+    received again."""
+    test_file_name = (
+        "1.3.6.1.4.1.11129.5.5.110503645592756492463169821050252582267888.dcm"
+    )
+    test_file_path = str(
+        pathlib.Path(__file__).parent.absolute() / "test_data" / test_file_name
+    )
+    patient_id = "Covid0000"
+    series_path = (
+        "1.3.6.1.4.1.11129.5.5.112507010803284478207522016832191866964708/"
+        + "1.3.6.1.4.1.11129.5.5.112630850362182468372440828755218293352329"
+    )
+
+    bucket_name = "testbucket-12345"
+    conn = boto3.resource("s3", region_name="us-east-1")
+    conn.create_bucket(Bucket=bucket_name)
+    s3client = S3Client(bucket=bucket_name)
+    config = PipelineConfig()
+    config.set_config(
+        {
+            "raw_prefixes": ["raw-nhs-upload/"],
+            "training_percentage": 0,
+            "sites": {"split": [], "training": ["CentreA"], "validation": []},
+        }
+    )
+    create_inventory([CONFIG_KEY], bucket_name)
+    inv_downloader = InventoryDownloader(main_bucket=bucket_name)
+    pipeline_services = {
+        "config": config,
+        "s3client": s3client,
+        "patientcache": PatientCache(inv_downloader),
+        "headerstats": HeaderSizeStats(s3client),
+        "existenceindex": ExistenceIndex(inv_downloader, s3client),
+        "centrelookup": SubmittingCentreLookup(s3client),
+    }
+    queue = SQLiteQueue(str(tmp_path / "queue.sqlite"), visibility_timeout=0)
+
+    clinical_file = f"raw-nhs-upload/2021-03-01/data/{patient_id}_data.json"
+    conn.meta.client.put_object(
+        Bucket=bucket_name,
+        Key=clinical_file,
+        Body=json.dumps(
+            {"Pseudonym": patient_id, "SubmittingCentre": "CentreA"}
+        ),
+    )
+    queue.send(s3_notification(bucket_name, clinical_file))
+    assert events.consume(queue, pipeline_services, rounds=1) == 1
+
+    image_file = f"raw-nhs-upload/2021-03-01/images/{test_file_name}"
+    conn.meta.client.upload_file(test_file_path, bucket_name, image_file)
+    queue.send(s3_notification(bucket_name, image_file, 1000000))
+    copy_object = s3client.copy_object
+
+    def failing_copy(old_key, new_key):
+        raise ClientError(
+            {"Error": {"Code": "AccessDenied", "Message": "Denied"}},
+            "CopyObject",
+        )
+
+    monkeypatch.setattr(s3client, "copy_object", failing_copy)
+    # Left in the queue, with nothing written
+    assert events.consume(queue, pipeline_services, rounds=1) == 0
+    assert len(queue) == 1
+    image_key = f"training/xray/{patient_id}/{series_path}/{test_file_name}"
+    assert not s3client.object_exists(image_key)
+
+    monkeypatch.setattr(s3client, "copy_object", copy_object)
+    assert events.consume(queue, pipeline_services, rounds=1) == 1
+    assert len(queue) == 0
+    assert s3client.object_exists(image_key)
+    assert s3client.object_exists(
+        f"training/xray-metadata/{patient_id}/{series_path}/"
+        + test_file_name.replace(".dcm", ".json")
+    )
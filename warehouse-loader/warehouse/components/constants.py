@@ -1,6 +1,14 @@
 TRAINING_PREFIX = "training/"
 VALIDATION_PREFIX = "validation/"
 CONFIG_KEY = "config.json"
+HEADER_STATS_KEY = "header-stats.json"
+HEADER_CACHE_KEY = "header-cache.jsonl.gz"
+WRITE_MARKER_KEY = "last-write.json"
+PATIENT_CACHE_KEY = "patient-cache.npz"
+WATERMARK_KEY = "raw-watermarks.json"
+JOURNAL_PREFIX = "run-journals/"
+METADATA_MANIFEST_PREFIX = "metadata-manifests/"
+RUN_SUMMARY_PREFIX = "run-summaries/"
 
 TRAINING_PERCENTAGE = 0
 
@@ -1,14 +1,27 @@
+import codecs
+import contextvars
+import hashlib
 import json
 import logging
 import re
+import time
+from functools import partial
 
 import mondrian
+from bonobo.execution.contexts.graph import GraphExecutionContext
+from bonobo.execution.contexts.node import NodeExecutionContext
+from bonobo.execution.strategies import ThreadPoolExecutorStrategy
+from bonobo.structs.inputs import BUFFER_SIZE, Input
+from bonobo.util import get_name
 from botocore.exceptions import ClientError
 
 # set up logging
 mondrian.setup(excepthook=True)
 logger = logging.getLogger()
 
+# Whitespace between JSON tokens
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
 
 def get_date_from_key(key):
     """Extract date from an object key from the bucket's directory pattern,
@@ -29,7 +42,220 @@ def get_date_from_key(key):
         return date_match.group("date")
 
 
-def get_submitting_centre_from_key(s3client, key):
+def patient_hash(patient_id):
+    """Hash a patient ID (sha512) into a large integer, to assign the
+    patient to groups pseudo-randomly but deterministically.
+
+    Parameters
+    ----------
+    patient_id : str
+        The patient ID to hash (case and surrounding whitespace ignored)
+
+    Returns
+    -------
+    int
+        The hash of the patient ID
+    """
+    return int(
+        hashlib.sha512(patient_id.strip().upper().encode("utf-8")).hexdigest(),
+        16,
+    )
+
+
+# The pipeline step the current thread works for, as its name and the
+# StageMetrics recording its work (see InstrumentedNodeExecutionContext)
+CURRENT_STAGE = contextvars.ContextVar("current_stage", default=None)
+
+
+class InstrumentedNodeExecutionContext(NodeExecutionContext):
+    """Node execution context that records the time taken by each call of
+    the node, and its counts of items, in a `StageMetrics`.
+
+    The time spent waiting to send results on (while the next node's queue
+    is full) is left out. The node's S3 requests are counted for it through
+    `CURRENT_STAGE`, also from the threads it hands work to with
+    `in_current_stage`.
+    """
+
+    def __init__(self, *args, stage, metrics, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stage = stage
+        self.metrics = metrics
+        self._step_start = None
+        self._send_seconds = 0.0
+
+    def _begin(self):
+        self._send_seconds = 0.0
+        return time.perf_counter(), time.thread_time()
+
+    def _elapsed(self, started):
+        """The wall and CPU time since `_begin`, in seconds."""
+        wall_start, cpu_start = started
+        wall = time.perf_counter() - wall_start - self._send_seconds
+        return max(wall, 0.0), time.thread_time() - cpu_start
+
+    def _get(self):
+        input_bag = super()._get()
+        self._step_start = self._begin()
+        return input_bag
+
+    def _send(self, value, _control=False):
+        started = time.perf_counter()
+        try:
+            return super()._send(value, _control=_control)
+        finally:
+            self._send_seconds += time.perf_counter() - started
+
+    def start(self):
+        token = CURRENT_STAGE.set((self.stage, self.metrics))
+        started = self._begin()
+        try:
+            super().start()
+        finally:
+            wall, _ = self._elapsed(started)
+            self.metrics.count(self.stage, setup_seconds=wall)
+            CURRENT_STAGE.reset(token)
+
+    def step(self):
+        # Only set once there is an input to process
+        self._step_start = None
+        token = CURRENT_STAGE.set((self.stage, self.metrics))
+        try:
+            super().step()
+        finally:
+            CURRENT_STAGE.reset(token)
+            if self._step_start is not None:
+                self.metrics.record(
+                    self.stage, *self._elapsed(self._step_start)
+                )
+
+    def stop(self):
+        if self.stopped:
+            return super().stop()
+        token = CURRENT_STAGE.set((self.stage, self.metrics))
+        started = self._begin()
+        try:
+            super().stop()
+        finally:
+            wall, _ = self._elapsed(started)
+            self.metrics.count(
+                self.stage,
+                teardown_seconds=wall,
+                items_in=self.statistics["in"],
+                items_out=self.statistics["out"],
+                errors=self.statistics["err"],
+            )
+            CURRENT_STAGE.reset(token)
+
+
+class PipelineGraphExecutionContext(GraphExecutionContext):
+    """Graph execution context with input queues of a limited size for
+    the nodes, so that a node blocks when it gets too far ahead of the
+    node it sends to, instead of piling up items in memory. The work of
+    the nodes is recorded if a `StageMetrics` is given.
+    """
+
+    def __init__(self, *args, queue_size=None, metrics=None, **kwargs):
+        # The first node's input has to take the start and end of the
+        # stream before any node runs
+        self.queue_size = (
+            BUFFER_SIZE if queue_size is None else max(queue_size, 2)
+        )
+        self.metrics = metrics
+        self._stages = set()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def alive(self):
+        # The nodes are started in their own threads, so right after the
+        # graph is started some of them may not have started yet
+        return any(node.alive or not node.started for node in self.nodes)
+
+    def _stage_name(self, node):
+        """A name for the node that's unique within the graph."""
+        name = get_name(node)
+        stage, number = name, 1
+        while stage in self._stages:
+            number += 1
+            stage = f"{name}_{number}"
+        self._stages.add(stage)
+        return stage
+
+    def create_node_execution_context_for(self, node):
+        node_input = Input(maxsize=self.queue_size)
+        if self.metrics is None:
+            return self.NodeExecutionContextType(
+                node, parent=self, _input=node_input
+            )
+        return InstrumentedNodeExecutionContext(
+            node,
+            parent=self,
+            _input=node_input,
+            stage=self._stage_name(node),
+            metrics=self.metrics,
+        )
+
+
+def pipeline_strategy(queue_size=None, metrics=None):
+    """The execution strategy to run a pipeline graph with.
+
+    Parameters
+    ----------
+    queue_size : int, default=None
+        The number of items each node's input queue can hold, bonobo's
+        default if not given.
+    metrics : StageMetrics, default=None
+        If given, the work of each node is recorded in it.
+
+    Returns
+    -------
+    bonobo.execution.strategies.ThreadPoolExecutorStrategy
+        The strategy to pass to `bonobo.run`.
+    """
+    return ThreadPoolExecutorStrategy(
+        GraphExecutionContextType=partial(
+            PipelineGraphExecutionContext,
+            queue_size=queue_size,
+            metrics=metrics,
+        )
+    )
+
+
+def in_current_stage(function):
+    """Wrap a function to run in another thread (e.g. in a pool) on behalf
+    of the current pipeline step, so that its S3 requests and CPU time are
+    counted for the step.
+
+    Parameters
+    ----------
+    function : callable
+        The function to wrap.
+
+    Returns
+    -------
+    callable
+        The wrapped function, or the function itself when not running in
+        an instrumented pipeline step.
+    """
+    stage = CURRENT_STAGE.get()
+    if stage is None:
+        return function
+
+    def run(*args, **kwargs):
+        token = CURRENT_STAGE.set(stage)
+        started = time.thread_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            name, metrics = stage
+            cpu = time.thread_time() - started
+            metrics.count(name, worker_cpu_seconds=cpu)
+            CURRENT_STAGE.reset(token)
+
+    return run
+
+
+def get_submitting_centre_from_key(s3client, key, prefix_bytes=None):
     """Extract the SubmittingCentre value from an S3 object that is
     a JSON file in the expected format.
 
@@ -39,6 +265,10 @@ def get_submitting_centre_from_key(s3client, key):
         The service that handles S3 data access
     key : str
         The S3 object key of the JSON file to process.
+    prefix_bytes : int, default=None
+        If given, only this many bytes are read from the start of the file
+        first, and the whole file is read only if the field is not found
+        in them.
 
     Returns
     -------
@@ -46,8 +276,20 @@ def get_submitting_centre_from_key(s3client, key):
         The value defined for the SubmittingCentre field in the file
     """
     try:
-        file_content = s3client.object_content(key).decode("utf-8")
-        json_content = json.loads(file_content)
+        if prefix_bytes is not None:
+            content = s3client.object_content(
+                key, content_range=f"bytes=0-{prefix_bytes - 1}"
+            )
+            if len(content) >= prefix_bytes:
+                text = codecs.getincrementaldecoder("utf-8")().decode(content)
+                try:
+                    return find_json_field(text, "SubmittingCentre")
+                except json.decoder.JSONDecodeError:
+                    logger.debug(f"SubmittingCentre not in range of {key}.")
+                content = s3client.object_content(key)
+        else:
+            content = s3client.object_content(key)
+        json_content = json.loads(content.decode("utf-8"))
     except ClientError:
         logger.error(f"Couldn't download contents of {key}.")
         raise
@@ -55,3 +297,62 @@ def get_submitting_centre_from_key(s3client, key):
         logger.error(f"Couldn't decode contents of {key} as JSON. ")
         raise
     return json_content.get("SubmittingCentre")
+
+
+def _skip_whitespace(text, position):
+    return WHITESPACE.match(text, position).end()
+
+
+def find_json_field(text, field):
+    """Find a top level field of a JSON object, parsing only as much of the
+    document as needed (which can be the beginning of a longer one).
+
+    Parameters
+    ----------
+    text : str
+        The JSON document, or the beginning of it.
+    field : str
+        The name of the field to look for.
+
+    Returns
+    -------
+    any
+        The value of the field, or None if the object doesn't have it.
+
+    Raises
+    ------
+    json.decoder.JSONDecodeError
+        If the text is not a JSON object, or it ends before the field (and
+        the value after it) is found.
+    """
+    decoder = json.JSONDecoder()
+    position = _skip_whitespace(text, 0)
+    if text[position : position + 1] != "{":
+        raise json.decoder.JSONDecodeError("Expecting '{'", text, position)
+    position = _skip_whitespace(text, position + 1)
+    if text[position : position + 1] == "}":
+        return None
+    while True:
+        if text[position : position + 1] != '"':
+            raise json.decoder.JSONDecodeError(
+                "Expecting property name", text, position
+            )
+        name, position = json.decoder.scanstring(text, position + 1)
+        position = _skip_whitespace(text, position)
+        if text[position : position + 1] != ":":
+            raise json.decoder.JSONDecodeError("Expecting ':'", text, position)
+        value, position = decoder.raw_decode(
+            text, _skip_whitespace(text, position + 1)
+        )
+        # The value is only complete if something follows it
+        position = _skip_whitespace(text, position)
+        separator = text[position : position + 1]
+        if separator not in {",", "}"}:
+            raise json.decoder.JSONDecodeError(
+                "Expecting ',' or '}'", text, position
+            )
+        if name == field:
+            return value
+        if separator == "}":
+            return None
+        position = _skip_whitespace(text, position + 1)
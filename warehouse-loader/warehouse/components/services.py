@@ -1,19 +1,161 @@
 import csv
+import datetime
 import gzip
+import hashlib
+import importlib
+import json
 import logging
+import math
+import os
+import random
 import re
+import shutil
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from io import BytesIO, TextIOWrapper
+from itertools import islice, repeat
+from urllib.parse import urlparse
 
 import boto3
 import mondrian
-from botocore.exceptions import ClientError
-
-from warehouse.components.constants import TRAINING_PERCENTAGE
+import numpy as np
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError,
+    ConnectionClosedError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+import warehouse.components.helpers as helpers
+from warehouse.components.constants import (
+    HEADER_CACHE_KEY,
+    HEADER_STATS_KEY,
+    JOURNAL_PREFIX,
+    KB,
+    METADATA_MANIFEST_PREFIX,
+    PATIENT_CACHE_KEY,
+    RUN_SUMMARY_PREFIX,
+    TRAINING_PERCENTAGE,
+    WATERMARK_KEY,
+    WRITE_MARKER_KEY,
+)
 
 mondrian.setup(excepthook=True)
 logger = logging.getLogger()
 
+# Size of the connection pool of the S3 client
+S3_MAX_CONNECTIONS = int(os.getenv("S3_MAX_CONNECTIONS", default=50))
+# Attempts of each S3 request, when it's throttled or fails on the server side
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", default=8))
+# S3 error codes (and HTTP statuses) to slow down and retry on
+S3_THROTTLE_ERRORS = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequests",
+    "503",
+    "429",
+}
+# S3 error codes (and HTTP statuses) to retry on
+S3_TRANSIENT_ERRORS = {
+    "InternalError",
+    "ServiceUnavailable",
+    "RequestTimeout",
+    "RequestTimeTooSkewed",
+    "500",
+    "502",
+    "504",
+}
+# Local folder to keep the downloaded inventory fragments in
+INVENTORY_CACHE_DIR = os.getenv(
+    "INVENTORY_CACHE_DIR",
+    default=os.path.join(tempfile.gettempdir(), "warehouse-inventory"),
+)
+# Size limit of the local inventory cache (0 turns the cache off)
+INVENTORY_CACHE_MB = int(os.getenv("INVENTORY_CACHE_MB", default=2048))
+# Inventory fragment formats by file suffix (gzipped CSV is the fallback)
+INVENTORY_FORMATS = {"parquet": ".parquet", "orc": ".orc", "csv": ".csv.gz"}
+# Rows to read at once from columnar inventory fragments
+INVENTORY_BATCH_ROWS = 65536
+# Inventory fragments to download and decompress ahead (0 turns it off)
+INVENTORY_PREFETCH = int(os.getenv("INVENTORY_PREFETCH", default=0))
+# Local folder to keep the patient cache snapshots in (empty turns it off)
+PATIENT_CACHE_DIR = os.getenv(
+    "PATIENT_CACHE_DIR",
+    default=os.path.join(tempfile.gettempdir(), "warehouse-patients"),
+)
+# Format version of the patient cache snapshots
+PATIENT_CACHE_VERSION = 1
+# Bytes to read from the start of the clinical data files to find the
+# SubmittingCentre in, before reading the whole file
+SUBMITTING_CENTRE_RANGE_KB = int(
+    os.getenv("SUBMITTING_CENTRE_RANGE_KB", default=4)
+)
+# Local file to keep the submitting centres of the patients in between runs
+# (empty turns it off)
+SUBMITTING_CENTRE_STORE = os.getenv(
+    "SUBMITTING_CENTRE_STORE",
+    default=os.path.join(tempfile.gettempdir(), "warehouse-centres.sqlite"),
+)
+# Local file to keep the headers of the images without patient data in
+# between runs, until their patients are known (empty turns it off)
+HEADER_CACHE_STORE = os.getenv(
+    "HEADER_CACHE_STORE",
+    default=os.path.join(tempfile.gettempdir(), "warehouse-headers.sqlite"),
+)
+# Local folder to keep the journals of the runs in (empty turns it off)
+RUN_JOURNAL_DIR = os.getenv(
+    "RUN_JOURNAL_DIR",
+    default=os.path.join(tempfile.gettempdir(), "warehouse-journal"),
+)
+# How often to copy the run journal to the bucket (0 turns it off)
+RUN_JOURNAL_SYNC_SECONDS = int(
+    os.getenv("RUN_JOURNAL_SYNC_SECONDS", default=300)
+)
+# Local file to write the summary of a pipeline run to, as JSON (the
+# summary is also saved in the bucket)
+RUN_SUMMARY_FILE = os.getenv("RUN_SUMMARY_FILE", default=None)
+# Local file to write the metrics of a pipeline run to, in the Prometheus
+# text format (e.g. for the node exporter's textfile collector)
+METRICS_PROMETHEUS_FILE = os.getenv("METRICS_PROMETHEUS_FILE", default=None)
+# Latency to assume in the run forecasts for the kinds of S3 requests not
+# made during the run (in milliseconds)
+FORECAST_LATENCY_MS = float(os.getenv("FORECAST_LATENCY_MS", default=50))
+# Local file to write the forecast of a dry run to, as JSON
+FORECAST_FILE = os.getenv("FORECAST_FILE", default=None)
+# Upper bounds of the histogram buckets of the pipeline steps' call times
+# (in seconds)
+STAGE_TIME_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0)
+# Local folder to keep the per-series metadata manifests in (empty turns
+# it off)
+METADATA_MANIFEST_DIR = os.getenv(
+    "METADATA_MANIFEST_DIR",
+    default=os.path.join(tempfile.gettempdir(), "warehouse-manifests"),
+)
+# Format version of the per-series metadata manifests
+METADATA_MANIFEST_VERSION = 1
+# Images to collect in a series before writing its metadata object
+SERIES_METADATA_MAX_ROWS = int(
+    os.getenv("SERIES_METADATA_MAX_ROWS", default=2000)
+)
+# Size of the collected metadata at which all the series are written
+SERIES_METADATA_BUFFER_MB = int(
+    os.getenv("SERIES_METADATA_BUFFER_MB", default=256)
+)
+
 
 class PipelineConfig:
     """Configuration settings for the whole pipeline"""
@@ -89,10 +231,210 @@ class PipelineConfig:
         return self.sites.get(submitting_centre)
 
 
+class Shard:
+    """One of the disjoint parts of the patients, for splitting a run
+    across independent tasks."""
+
+    def __init__(self, index, count):
+        """One of the disjoint parts of the patients.
+
+        The patients are assigned to the shards by the same hash of their
+        IDs as to the training and validation groups, so the clinical and
+        image files of a patient are always processed by the same task.
+        The digits deciding the group are left out, so each shard gets a
+        similar mix of the groups.
+
+        Parameters
+        ----------
+        index : int
+            The shard to take, from 0 to count - 1.
+        count : int
+            The number of shards.
+
+        Raises
+        ------
+        ValueError
+            If the index is not within the number of shards.
+        """
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index}/{count}")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, value):
+        """Parse a shard given as "index/count", such as "0/4".
+
+        Parameters
+        ----------
+        value : str or None
+            The shard to parse.
+
+        Returns
+        -------
+        Shard or None
+            The shard, or None if no shard is given.
+
+        Raises
+        ------
+        ValueError
+            If the shard is not in the expected format.
+        """
+        if not value:
+            return None
+        m = re.match(r"^\s*(?P<index>\d+)\s*/\s*(?P<count>\d+)\s*$", value)
+        if m is None:
+            raise ValueError(f"Invalid shard {value!r}, expected index/count")
+        return cls(int(m.group("index")), int(m.group("count")))
+
+    def includes(self, patient_id):
+        """Check whether a patient is in this shard.
+
+        Parameters
+        ----------
+        patient_id : str
+            The patient ID to check.
+
+        Returns
+        -------
+        bool
+            True if the patient's files are to be processed by this shard.
+        """
+        shard = (helpers.patient_hash(patient_id) // 100) % self.count
+        return shard == self.index
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+
+class AdaptiveLimiter:
+    """Limit the number of requests in flight, adapting the limit to the
+    throttling seen (additive increase, multiplicative decrease)."""
+
+    def __init__(self, maximum, minimum=1, initial=None):
+        """Limit the number of requests in flight.
+
+        The limit grows by about one for each limit's worth of successful
+        requests, and is halved when a request is throttled (at most once
+        for the requests started under the same limit).
+
+        Parameters
+        ----------
+        maximum : int
+            The highest limit.
+        minimum : int, default=1
+            The lowest limit.
+        initial : int, default=None
+            The limit to start with, the maximum if not given.
+        """
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial if initial is not None else maximum)
+        self.in_flight = 0
+        self._generation = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Wait for a free slot, and hold it while in the context.
+
+        Yields
+        ------
+        int
+            The generation of the limit the slot was taken under, to pass
+            to `throttled`.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            generation = self._generation
+        try:
+            yield generation
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+    def succeeded(self):
+        """Ramp up the limit after a successful request."""
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify()
+
+    def throttled(self, generation):
+        """Back off after a throttled request.
+
+        Parameters
+        ----------
+        generation : int
+            The generation of the limit the request was started under.
+        """
+        with self._condition:
+            if generation == self._generation:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._generation += 1
+
+
 class S3Client:
-    def __init__(self, bucket):
+    def __init__(
+        self,
+        bucket,
+        max_connections=S3_MAX_CONNECTIONS,
+        max_attempts=S3_MAX_ATTEMPTS,
+        backoff=0.1,
+    ):
+        """The service that handles S3 data access, safe to use from
+        concurrent steps.
+
+        The requests share a connection pool, and the number of them in
+        flight is limited by an `AdaptiveLimiter`, backing off when S3
+        throttles them. Throttled and transient errors are retried with
+        jittered exponential backoff. The requests, retries, throttles,
+        and bytes transferred are counted in `counters`, and the requests
+        of each kind ("GET", "HEAD", "PUT", "COPY", "LIST", "DELETE") and
+        the time they took in `operations`.
+
+        Parameters
+        ----------
+        bucket : str
+            The bucket to work with.
+        max_connections : int, default=S3_MAX_CONNECTIONS
+            The size of the connection pool, and the highest number of
+            requests in flight.
+        max_attempts : int, default=S3_MAX_ATTEMPTS
+            The attempts to make of each request, at least 1.
+        backoff : float, default=0.1
+            The base of the retry delays in seconds, doubled after each
+            attempt (up to 20 seconds).
+
+        Raises
+        ------
+        ValueError
+            If the number of attempts is less than 1.
+        """
+        if max_attempts < 1:
+            raise ValueError(f"Invalid max_attempts {max_attempts}")
         self._bucket = bucket
-        self._client = boto3.client("s3")
+        self._client = boto3.client(
+            "s3",
+            config=Config(
+                max_pool_connections=max_connections,
+                # Retries are done here, classified by the error
+                retries={"max_attempts": 0},
+            ),
+        )
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.limiter = AdaptiveLimiter(max_connections)
+        self.counters = {
+            "requests": 0,
+            "retries": 0,
+            "throttles": 0,
+            "bytes": 0,
+        }
+        self.operations = dict()
+        self._counters_lock = threading.Lock()
 
     @property
     def bucket(self):
@@ -102,6 +444,95 @@ class S3Client:
     def client(self):
         return self._client
 
+    def _count(self, **increments):
+        with self._counters_lock:
+            for name, value in increments.items():
+                self.counters[name] += value
+        stage = helpers.CURRENT_STAGE.get()
+        if stage is not None:
+            # Counted for the pipeline step making the request too
+            stage_name, metrics = stage
+            metrics.count(
+                stage_name,
+                **{f"s3_{name}": value for name, value in increments.items()},
+            )
+
+    def _time(self, operation, seconds):
+        with self._counters_lock:
+            timing = self.operations.setdefault(
+                operation, {"requests": 0, "seconds": 0.0}
+            )
+            timing["requests"] += 1
+            timing["seconds"] += seconds
+
+    @staticmethod
+    def _error_kind(error):
+        """Classify a request error as "throttle", "transient", or None
+        if it's not to be retried."""
+        if isinstance(
+            error,
+            (ConnectionClosedError, EndpointConnectionError, ReadTimeoutError),
+        ):
+            return "transient"
+        if not isinstance(error, ClientError):
+            return None
+        code = str(error.response.get("Error", {}).get("Code"))
+        status = str(
+            error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        )
+        if code in S3_THROTTLE_ERRORS or status in S3_THROTTLE_ERRORS:
+            return "throttle"
+        if code in S3_TRANSIENT_ERRORS or status in S3_TRANSIENT_ERRORS:
+            return "transient"
+        return None
+
+    def _request(self, operation, request):
+        """Run a request within the concurrency limit, retrying it on
+        throttling and transient errors.
+
+        Parameters
+        ----------
+        operation : str
+            The kind of the request ("GET", "PUT", ...), for the counts.
+        request : callable
+            The request to make, without arguments, returning the result
+            and the number of bytes transferred.
+
+        Returns
+        -------
+        any
+            The result of the request.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            with self.limiter.slot() as generation:
+                self._count(requests=1)
+                started = time.monotonic()
+                try:
+                    result, transferred = request()
+                except (
+                    ClientError,
+                    ConnectionClosedError,
+                    EndpointConnectionError,
+                    ReadTimeoutError,
+                ) as error:
+                    self._time(operation, time.monotonic() - started)
+                    kind = self._error_kind(error)
+                    if kind is None or attempt == self.max_attempts:
+                        raise
+                    if kind == "throttle":
+                        self._count(throttles=1)
+                        self.limiter.throttled(generation)
+                    logger.debug(f"Retrying S3 request after error: {error}")
+                else:
+                    self._time(operation, time.monotonic() - started)
+                    self.limiter.succeeded()
+                    self._count(bytes=transferred)
+                    return result
+            self._count(retries=1)
+            time.sleep(
+                random.uniform(0, min(20, self.backoff * 2 ** (attempt - 1)))
+            )
+
     def object_exists(self, key):
         """Checking whether a given object exists in our work bucket
 
@@ -123,61 +554,240 @@ class S3Client:
             If the file to be uploaded doesn't exists.
         """
         try:
-            self._client.head_object(Bucket=self._bucket, Key=key)
+            self._request(
+                "HEAD",
+                lambda: (
+                    self._client.head_object(Bucket=self._bucket, Key=key),
+                    0,
+                ),
+            )
         except ClientError as e:
             if e.response["Error"]["Code"] == "404":
                 return False
             else:
-                raise ClientError
+                raise
         else:
             return True
 
     def get_object(self, key):
-        try:
-            args = {"Bucket": self._bucket, "Key": key}
-            return self._client.get_object(**args)
-        except ClientError:
-            raise
+        args = {"Bucket": self._bucket, "Key": key}
+        return self._request(
+            "GET", lambda: (self._client.get_object(**args), 0)
+        )
 
     def object_content(self, key, content_range=None):
-        try:
-            args = {"Bucket": self._bucket, "Key": key}
-            if content_range is not None:
-                args["Range"] = content_range
-            file_content = self._client.get_object(**args)["Body"].read()
-        except ClientError:
-            raise
-        return file_content
+        args = {"Bucket": self._bucket, "Key": key}
+        if content_range is not None:
+            args["Range"] = content_range
+
+        def request():
+            # Read within the retries, as the download can fail midway too
+            content = self._client.get_object(**args)["Body"].read()
+            return content, len(content)
+
+        return self._request("GET", request)
 
     def put_object(self, key, content):
-        try:
-            args = {"Bucket": self._bucket, "Key": key, "Body": content}
-            self._client.put_object(**args)
-        except ClientError:
-            raise
+        args = {"Bucket": self._bucket, "Key": key, "Body": content}
+        self._request(
+            "PUT", lambda: (self._client.put_object(**args), len(content))
+        )
 
     def copy_object(self, old_key, new_key):
-        try:
-            args = {
-                "Bucket": self._bucket,
-                "CopySource": {"Bucket": self._bucket, "Key": old_key},
-                "Key": new_key,
-            }
-            self._client.copy_object(**args)
-        except ClientError:
-            raise
+        args = {
+            "Bucket": self._bucket,
+            "CopySource": {"Bucket": self._bucket, "Key": old_key},
+            "Key": new_key,
+        }
+        self._request("COPY", lambda: (self._client.copy_object(**args), 0))
+
+    def list_keys(self, prefix):
+        """List the keys of the objects under a prefix.
+
+        Parameters
+        ----------
+        prefix : str
+            The prefix to list.
+
+        Yields
+        ------
+        str
+            The keys of the objects, in lexicographic order.
+        """
+        args = {"Bucket": self._bucket, "Prefix": prefix}
+        while True:
+            page = self._request(
+                "LIST", lambda: (self._client.list_objects_v2(**args), 0)
+            )
+            for item in page.get("Contents", []):
+                yield item["Key"]
+            if not page.get("IsTruncated"):
+                return
+            args["ContinuationToken"] = page["NextContinuationToken"]
+
+    def delete_object(self, key):
+        args = {"Bucket": self._bucket, "Key": key}
+        self._request(
+            "DELETE", lambda: (self._client.delete_object(**args), 0)
+        )
 
     def upload_file(self, key, file_name):
+        size = os.path.getsize(file_name)
+        self._request(
+            "PUT",
+            lambda: (
+                self._client.upload_file(file_name, self._bucket, key),
+                size,
+            ),
+        )
+
+
+def _fragment_format(inventory_file):
+    """The format of an inventory fragment, from its key.
+
+    Parameters
+    ----------
+    inventory_file : str
+        The key of the fragment in the inventory bucket.
+
+    Returns
+    -------
+    str
+        "parquet", "orc", or "csv" (gzipped) for anything else.
+    """
+    for fragment_format, suffix in INVENTORY_FORMATS.items():
+        if inventory_file.endswith(suffix):
+            return fragment_format
+    return "csv"
+
+
+def _columnar_rows(f, fragment_format, bucket):
+    """Read the key, size, and last modified date columns of a Parquet or
+    ORC inventory fragment, in record batches.
+
+    Parameters
+    ----------
+    f : file object
+        The fragment opened for binary reading.
+    fragment_format : str
+        Either "parquet" or "orc".
+    bucket : str
+        The bucket to list in the rows (that column is not read).
+
+    Yields
+    ------
+    tuple[str, str, int or None, datetime.datetime or None]
+        The (bucket, key, size, last modified date) of each object.
+    """
+    for batch in _columnar_batches(f, fragment_format):
+        # The columns come in the order of the file's schema (for ORC),
+        # not necessarily the order they were asked for in
+        values = {
+            name: batch.column(name).to_pylist() for name in batch.schema.names
+        }
+        missing = [None] * batch.num_rows
+        yield from zip(
+            repeat(bucket),
+            values["key"],
+            values.get("size", missing),
+            values.get("last_modified_date", missing),
+        )
+
+
+def _columnar_batches(f, fragment_format):
+    """The record batches of a Parquet or ORC fragment, with only its
+    inventory columns, only importing the pyarrow module of the given
+    format (pyarrow may be built without ORC support).
+    """
+    try:
+        reader = importlib.import_module(f"pyarrow.{fragment_format}")
+    except ImportError:
+        raise RuntimeError(
+            f"Reading {fragment_format} inventory needs pyarrow installed."
+        )
+    if fragment_format == "parquet":
+        fragment = reader.ParquetFile(f)
+        columns = _inventory_columns(fragment.schema_arrow.names)
+        batches = fragment.iter_batches(
+            batch_size=INVENTORY_BATCH_ROWS, columns=columns
+        )
+    else:
+        fragment = reader.ORCFile(f)
+        columns = _inventory_columns(fragment.schema.names)
+        batches = (
+            fragment.read_stripe(stripe, columns=columns)
+            for stripe in range(fragment.nstripes)
+        )
+    return batches
+
+
+def _folder_size(path):
+    """The total size of the complete files in a folder, leaving out the
+    partial downloads, and the files removed while it's scanned."""
+    total = 0
+    for item in os.scandir(path):
         try:
-            self._client.upload_file(file_name, self._bucket, key)
-        except (ClientError, FileNotFoundError):
-            raise
+            if item.is_file() and not item.name.endswith(".part"):
+                total += item.stat().st_size
+        except FileNotFoundError:
+            continue
+    return total
+
+
+def _inventory_columns(names):
+    if "key" not in names:
+        raise ValueError(f"No key column in inventory columns: {names}")
+    return [
+        name for name in ["key", "size", "last_modified_date"] if name in names
+    ]
 
 
 class InventoryDownloader:
-    def __init__(self, main_bucket):
+    def __init__(
+        self,
+        main_bucket,
+        cache_dir=INVENTORY_CACHE_DIR,
+        cache_size_mb=INVENTORY_CACHE_MB,
+        prefetch=INVENTORY_PREFETCH,
+        index_lists=("raw_data", "raw_images", "patient_groups"),
+    ):
+        """Access to the latest S3 inventory of the main bucket.
+
+        The inventory fragments are kept in a local cache folder, so each of
+        them is downloaded only once, however many times the inventory is
+        iterated through. The fragments of each inventory (manifest symlink)
+        are kept in their own subfolder, and the folders of older inventories
+        are removed when the cache would grow beyond its size limit.
+
+        Parameters
+        ----------
+        main_bucket : str
+            The bucket whose inventory to use.
+        cache_dir : str, default=INVENTORY_CACHE_DIR
+            The local folder to keep the inventory fragments in, None turns
+            caching off.
+        cache_size_mb : int, default=INVENTORY_CACHE_MB
+            The size limit of the cache folder in megabytes, 0 turns caching
+            off.
+        prefetch : int, default=INVENTORY_PREFETCH
+            The number of fragments to download and decompress in the
+            background while the current one is read, 0 turns it off.
+        index_lists : tuple[str], default=("raw_data", "raw_images",
+            "patient_groups")
+            The key lists that the inventory index keeps for the pipeline
+            (see `InventoryIndex`).
+        """
         self.main_bucket = main_bucket
         self.inventory_bucket = self.main_bucket + "-inventory"
+        self.inventory_date = None
+        self.cache_dir = cache_dir if cache_size_mb > 0 else None
+        self.cache_size = cache_size_mb * KB * KB
+        self.prefetch = prefetch
+        self.index_lists = index_lists
+        self._index = None
+        self._index_lock = threading.Lock()
+        # Taken by the prefetching threads to make room in the cache
+        self._cache_lock = threading.Lock()
         self._get_inventory_list()
 
     def _get_inventory_list(self):
@@ -189,7 +799,10 @@ class InventoryDownloader:
                 Bucket=inventory_bucket,
                 Prefix=f"{self.main_bucket}/daily-full-inventory/hive",
             )["Contents"]
-            latest_symlink = sorted([obj["Key"] for obj in objs])[-1]
+            latest = sorted(objs, key=lambda obj: obj["Key"])[-1]
+            latest_symlink = latest["Key"]
+            self.latest_symlink = latest_symlink
+            self.inventory_date = latest["LastModified"]
             response = s3_client.get_object(
                 Bucket=inventory_bucket, Key=latest_symlink
             )
@@ -201,7 +814,7 @@ class InventoryDownloader:
             logger.error(f"Can't use inventory due to run time error: {e}")
             sys.exit(1)
 
-    def get_inventory(self, excludeline=set()):
+    def get_inventory(self, excludeline=set(), ordered=True):
         """Iterate through all the inventory files, and passing back a reader
         to use the data from them.
 
@@ -209,223 +822,3029 @@ class InventoryDownloader:
         ----------
         exclideline : set
             Listing all the fragments of the inventory to exclude from reading
+        ordered : bool, default=True
+            Whether to pass back the fragments in the order they are listed
+            in the inventory, or as soon as they are downloaded (only makes
+            a difference when prefetching).
 
         Yields
         ------
-        tuple[int, _csv.reader]
-            Index of the given inventory fragment and a CSV reader initialized
+        tuple[int, iterator]
+            Index of the given inventory fragment and an iterator of its
+            rows, (bucket, key, size, ...) each, whatever format the
+            inventory is delivered in.
         """
         try:
             s3_client = boto3.client("s3")
+            fragments = []
             for index, inventory_file in enumerate(self.inventory_list):
                 if index in excludeline:
                     logger.debug(
                         f"Skipping inventory file as requested: {inventory_file}"
                     )
                     continue
-                logger.debug(f"Downloading inventory file: {inventory_file}")
-                with tempfile.TemporaryFile(mode="w+b") as f:
-                    s3_client.download_fileobj(
-                        self.inventory_bucket, inventory_file, f
-                    )
-                    f.seek(0)
-                    with gzip.open(f, mode="rt") as cf:
-                        reader = csv.reader(cf)
-                        yield index, reader
+                fragments += [(index, inventory_file)]
+            if self.prefetch > 0:
+                yield from self._prefetch_fragments(
+                    s3_client, fragments, ordered
+                )
+                return
+            for index, inventory_file in fragments:
+                with self._open_fragment(s3_client, inventory_file) as f:
+                    yield index, self._read_fragment(f, inventory_file)
         except Exception as e:  # noqa: E722
             logger.error(f"Can't use inventory due to run time error: {e}")
             sys.exit(1)
 
-    def get_bucket(self):
-        """The S3 bucket that this downloader is configured to use.
+    def _prefetch_fragments(self, s3_client, fragments, ordered):
+        """Download and decompress the inventory fragments in a worker pool,
+        keeping at most `prefetch` of them loaded ahead of the one read.
 
-        Returns
-        -------
-        str
-            S3 bucket name
+        Parameters
+        ----------
+        s3_client : botocore.client.S3
+            The client to download the fragments with.
+        fragments : list[tuple[int, str]]
+            The index and key of the fragments to read.
+        ordered : bool
+            Whether to keep the order of the fragments.
+
+        Yields
+        ------
+        tuple[int, iterator]
+            Index of the given inventory fragment and an iterator of its rows
         """
-        return self.main_bucket
+        fragments = iter(fragments)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+
+            def fill():
+                for index, inventory_file in islice(
+                    fragments, self.prefetch - len(pending)
+                ):
+                    future = executor.submit(
+                        self._load_fragment, s3_client, inventory_file
+                    )
+                    pending.append((index, inventory_file, future))
+
+            fill()
+            while pending:
+                if ordered:
+                    item = pending.popleft()
+                else:
+                    wait(
+                        [future for _, _, future in pending],
+                        return_when=FIRST_COMPLETED,
+                    )
+                    item = next(item for item in pending if item[2].done())
+                    pending.remove(item)
+                index, inventory_file, future = item
+                data = future.result()
+                fill()
+                yield index, self._read_loaded_fragment(data, inventory_file)
 
+    def _load_fragment(self, s3_client, inventory_file):
+        """Load an inventory fragment into memory, decompressing CSV ones.
 
-class CacheContradiction(Exception):
-    pass
+        Parameters
+        ----------
+        s3_client : botocore.client.S3
+            The client to download the fragment with.
+        inventory_file : str
+            The key of the fragment in the inventory bucket.
+
+        Returns
+        -------
+        bytes
+            The contents of the fragment.
+        """
+        with self._open_fragment(s3_client, inventory_file) as f:
+            data = f.read()
+        if _fragment_format(inventory_file) == "csv":
+            data = gzip.decompress(data)
+        return data
+
+    def _read_loaded_fragment(self, data, inventory_file):
+        fragment_format = _fragment_format(inventory_file)
+        if fragment_format == "csv":
+            yield from csv.reader(
+                TextIOWrapper(BytesIO(data), encoding="utf-8")
+            )
+        else:
+            yield from _columnar_rows(
+                BytesIO(data), fragment_format, self.main_bucket
+            )
 
+    def _fragment_path(self, inventory_file):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(
+            self.cache_dir,
+            hashlib.sha1(self.latest_symlink.encode("utf-8")).hexdigest(),
+            hashlib.sha1(inventory_file.encode("utf-8")).hexdigest()
+            + INVENTORY_FORMATS[_fragment_format(inventory_file)],
+        )
 
-class PatientCache:
-    """A cache to store group assignments of patient IDs"""
+    def _read_fragment(self, f, inventory_file):
+        """Iterate through the rows of an inventory fragment.
 
-    def __init__(self, downloader):
-        """A cache to store group assignments of patient IDs.
+        CSV fragments are read row by row, while for the columnar formats
+        only the key and size columns are read, in record batches.
 
         Parameters
         ----------
-        downloader: InventoryDownloader
-            An initialized downloader instance.
+        f : file object
+            The fragment opened for binary reading.
+        inventory_file : str
+            The key of the fragment, to tell its format by.
+
+        Yields
+        ------
+        list or tuple
+            The (bucket, key, size, ...) rows of the fragment.
         """
-        self.downloader = downloader
-        self.store = dict()
-        self._load_cache()
+        fragment_format = _fragment_format(inventory_file)
+        if fragment_format == "csv":
+            with gzip.open(f, mode="rt") as cf:
+                yield from csv.reader(cf)
+        else:
+            yield from _columnar_rows(f, fragment_format, self.main_bucket)
 
-    def _load_cache(self):
-        pattern = re.compile(
-            r"^(?P<group>training|validation)/data/(?P<pseudonym>[^/]*)/[^/]*$"
-        )
-        for f, fragment_reader in self.downloader.get_inventory():
-            for row in fragment_reader:
-                key = row[1]
-                key_match = pattern.match(key)
-                if key_match:
-                    self.add(
-                        key_match.group("pseudonym"),
-                        key_match.group("group"),
-                    )
+    @contextmanager
+    def _open_fragment(self, s3_client, inventory_file):
+        """Open an inventory fragment from the local cache, downloading it
+        (and caching it if there's room) first if needed.
 
-    def add(self, patient_id, group):
-        """Add an item to an existing patient cache
+        Parameters
+        ----------
+        s3_client : botocore.client.S3
+            The client to download the fragment with.
+        inventory_file : str
+            The key of the fragment in the inventory bucket.
 
-        Paramters
-        ---------
-        patient_id : str
-            The patient ID or pseudonym to store
-        group : str
-            Expected group is "training" or "validation", only stores whether the patient is in the "training group or not.
+        Yields
+        ------
+        file object
+            The gzipped fragment opened for binary reading.
         """
-        if patient_id not in self.store:
-            self.store[patient_id] = group == "training"
-        elif self.store[patient_id] != (group == "training"):
-            raise CacheContradiction(
-                f"Found patient with ambiguous groups: {patient_id}"
+        path = self._fragment_path(inventory_file)
+        if path is not None and os.path.exists(path):
+            logger.debug(f"Reading cached inventory file: {inventory_file}")
+            with open(path, "rb") as f:
+                yield f
+            return
+
+        logger.debug(f"Downloading inventory file: {inventory_file}")
+        folder = None
+        if path is not None:
+            folder = os.path.dirname(path)
+            os.makedirs(folder, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            mode="w+b", dir=folder, suffix=".part"
+        ) as f:
+            s3_client.download_fileobj(
+                self.inventory_bucket, inventory_file, f
             )
+            f.flush()
+            if path is not None:
+                self._cache(f, path)
+            f.seek(0)
+            yield f
 
-    def get_group(self, patient_id):
-        """Check if a given patient is in "training" or "validation" group,
-        or even known to the cache or not.
+    def _cache(self, f, path):
+        """Keep a downloaded fragment in the cache, if there's room for it.
 
         Parameters
         ----------
-        patient_id : str
-            The patient ID / pseudonym in question
+        f : tempfile.NamedTemporaryFile
+            The downloaded fragment, in the cache folder of its inventory.
+        path : str
+            The path to keep the fragment at.
+        """
+        # One fragment at a time, so the cache stays within its size limit
+        # and the folders are not removed from under another thread
+        with self._cache_lock:
+            if not self._make_room(f.tell(), os.path.dirname(path)):
+                return
+            try:
+                # Keep the download after the temporary file is closed
+                os.link(f.name, path)
+            except OSError as e:
+                logger.debug(f"Can't cache inventory file: {e}")
+
+    def _make_room(self, size, current):
+        """Remove older inventories from the cache until a new fragment of
+        the given size fits in.
+
+        Parameters
+        ----------
+        size : int
+            The size of the new fragment in bytes.
+        current : str
+            The cache folder of the current inventory, which is kept.
 
         Returns
         -------
-        group : str or None
-            The values "training" or "validation" if grouping is known, or None if patient is not in cache.
+        bool
+            True if the new fragment fits into the cache.
+        """
+        usage = dict()
+        modified = dict()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if entry.is_dir():
+                    modified[entry.path] = entry.stat().st_mtime
+                    usage[entry.path] = _folder_size(entry.path)
+            except FileNotFoundError:
+                # Removed in the meantime (e.g. by another process)
+                usage.pop(entry.path, None)
+        total = sum(usage.values())
+        for folder in sorted(usage, key=modified.get):
+            if total + size <= self.cache_size:
+                break
+            if os.path.normpath(folder) == os.path.normpath(current):
+                continue
+            logger.debug(f"Removing cached inventory: {folder}")
+            shutil.rmtree(folder, ignore_errors=True)
+            total -= usage[folder]
+        return total + size <= self.cache_size
+
+    def get_index(self):
+        """The contents of the inventory classified for the pipelines,
+        built on first use with a single pass through the inventory.
+
+        Returns
+        -------
+        InventoryIndex
+            The classified inventory contents
+        """
+        with self._index_lock:
+            if self._index is None:
+                self._index = InventoryIndex(self, lists=self.index_lists)
+        return self._index
+
+    def get_bucket(self):
+        """The S3 bucket that this downloader is configured to use.
+
+        Returns
+        -------
+        str
+            S3 bucket name
         """
-        group = None
+        return self.main_bucket
+
+
+def _row_size(row):
+    """The object size listed in an inventory row.
+
+    Parameters
+    ----------
+    row : list
+        The inventory row (bucket, key, size, ...)
+
+    Returns
+    -------
+    int or None
+        The size in bytes, or None if it's not listed
+    """
+    try:
+        return int(row[2])
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def _row_modified(row):
+    """The last modified date listed in an inventory row.
+
+    Parameters
+    ----------
+    row : list
+        The inventory row (bucket, key, size, last modified date, ...)
+
+    Returns
+    -------
+    float
+        The date as a POSIX timestamp, or NaN if it's not listed
+    """
+    try:
+        modified = row[3]
+    except IndexError:
+        return math.nan
+    if isinstance(modified, str):
         try:
-            group = "training" if self.store[patient_id] else "validation"
-        except KeyError:
-            # Not Cached
-            pass
-        return group
+            modified = datetime.datetime.strptime(
+                modified.replace("Z", "+0000"), "%Y-%m-%dT%H:%M:%S.%f%z"
+            )
+        except ValueError:
+            return math.nan
+    if not isinstance(modified, datetime.datetime):
+        return math.nan
+    if modified.tzinfo is None:
+        modified = modified.replace(tzinfo=datetime.timezone.utc)
+    return modified.timestamp()
 
 
-class FileList:
-    def __init__(self, downloader):
-        self.downloader = downloader
-        self.bucket = downloader.get_bucket()
+class HashedKeySet:
+    """A compact set of strings, for large sets of keys and filenames.
 
-    def get_raw_data_list(self, raw_prefixes=set()):
-        """Get the list of raw data files from the inventory
+    The strings are stored as sorted 64-bit hashes in a numpy array, that is
+    8 bytes per entry instead of a Python string each. The price is a tiny
+    chance of false positives (about n^2 / 2^65 for n entries, ie. 1 in
+    a million for 6 million entries).
+    """
+
+    def __init__(self, keys=()):
+        """A compact set of strings.
 
         Parameters
         ----------
-        raw_prefixes : set, default=set()
-            The raw prefixes to consider for processing in the warehouse.
+        keys : iterable of str, default=()
+            The initial contents of the set.
+        """
+        hashes = array("Q", (self.hash(key) for key in keys))
+        self._set_hashes(hashes)
 
-        Yields
-        ------
-        str
-            The keys for the raw data files found
+    @classmethod
+    def from_hashes(cls, hashes):
+        """Create a set from already hashed strings.
+
+        Parameters
+        ----------
+        hashes : array.array
+            The hashes of the strings (as from `HashedKeySet.hash`), of
+            typecode "Q".
+
+        Returns
+        -------
+        HashedKeySet
+            The set containing the given strings.
         """
+        key_set = cls()
+        key_set._set_hashes(hashes)
+        return key_set
 
-        pattern = re.compile(
-            r"^(?P<raw_prefix>raw-.*)/(\d{4}-\d{2}-\d{2})/data/(?P<filename>[^/]*)$"
-        )
-        for r, fragment_reader in self.downloader.get_inventory():
-            for row in fragment_reader:
-                key = row[1]
-                key_match = pattern.match(key)
-                if key_match and key_match.group("raw_prefix") in raw_prefixes:
-                    yield key
+    def _set_hashes(self, hashes):
+        self._sorted = np.unique(np.frombuffer(hashes, dtype=np.uint64))
+        # Keys added later, kept separately to keep lookups cheap
+        self._added = set()
 
-    def get_pending_raw_images_list(self, raw_prefixes=set()):
-        """Get the list of raw data files from the inventory
+    @staticmethod
+    def hash(key):
+        """The 64-bit hash of a string, as stored in the set.
 
         Parameters
         ----------
-        raw_prefixes : set, default=set()
-            The raw prefixes to consider for processing in the warehouse.
+        key : str
+            The string to hash.
 
-        Yields
-        ------
-        str
-            The keys for raw image files that seem not yet to be processed.
+        Returns
+        -------
+        int
+            The hash value.
         """
-        raw_pattern = re.compile(
-            r"^(?P<raw_prefix>raw-.*)/\d{4}-\d{2}-\d{2}/images/(?P<filename>[^/]*)$"
+        return int.from_bytes(
+            hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(),
+            "little",
         )
-        processed_pattern = re.compile(
-            r"^(training|validation)/(xray|ct|mri).*/(?P<filename>[^/]*)$"
+
+    def _find(self, hashed):
+        position = np.searchsorted(self._sorted, np.uint64(hashed))
+        return (
+            position < len(self._sorted) and self._sorted[position] == hashed
         )
-        fragment_excludelist = set()
-        for _, fragment_reader in self.downloader.get_inventory():
-            raw_list = dict()
-            for row in fragment_reader:
-                key = row[1]
-                key_match = raw_pattern.match(key)
-                if key_match and key_match.group("raw_prefix") in raw_prefixes:
-                    raw_list[key_match.group("filename")] = key
-
-            unprocessed = set(raw_list.keys())
-            unprocessed_json = {
-                key.replace(".dcm", ".json") for key in unprocessed
-            }
-            if len(unprocessed) == 0:
-                continue
 
-            for f, fragment_reader2 in self.downloader.get_inventory(
-                fragment_excludelist
-            ):
-                filenames = set()
-                for row in fragment_reader2:
-                    # Processed file cache
-                    item = processed_pattern.match(row[1])
-                    if item:
-                        filenames.add(item.group("filename"))
-                if len(filenames) == 0:
-                    fragment_excludelist.add(f)
-                unprocessed = unprocessed - filenames
-                unprocessed_json = unprocessed_json - filenames
-                if len(unprocessed) == 0 and len(unprocessed_json) == 0:
-                    break
-
-            unprocessed |= {
-                key.replace(".json", ".dcm") for key in unprocessed_json
-            }
-            for unproc in unprocessed:
-                yield raw_list[unproc]
+    def __contains__(self, key):
+        hashed = self.hash(key)
+        return hashed in self._added or self._find(hashed)
 
-    def get_processed_data_list(self):
-        """Getting the list of processed data files from the warehouse
+    def __len__(self):
+        return len(self._sorted) + len(self._added)
 
-        Yields
-        ------
-        str
-            The keys to the processed data files to look at.
-        """
-        pattern = re.compile(
-            r"^(training|validation)/data/.*/(?P<filename>[^/]*)$"
-        )
-        for _, fragment_reader in self.downloader.get_inventory():
-            for row in fragment_reader:
-                key = row[1]
-                key_match = pattern.match(key)
-                if key_match:
-                    yield key
+    def add(self, key):
+        """Add a string to the set.
 
-    def get_processed_images_list(self):
-        """Getting the list of processed non-data files (ie. images and
+        Parameters
+        ----------
+        key : str
+            The string to add.
+        """
+        hashed = self.hash(key)
+        if not self._find(hashed):
+            self._added.add(hashed)
+
+    def discard(self, key):
+        """Remove a string added to the set with `add` (the initial
+        contents are kept).
+
+        Parameters
+        ----------
+        key : str
+            The string to remove.
+        """
+        self._added.discard(self.hash(key))
+
+    def copy(self):
+        """A copy of the set, that can be changed independently.
+
+        Returns
+        -------
+        HashedKeySet
+            The copy of the set.
+        """
+        key_set = HashedKeySet()
+        key_set._sorted = self._sorted
+        key_set._added = set(self._added)
+        return key_set
+
+    def union(self, other):
+        """A new set with the strings of both sets.
+
+        Parameters
+        ----------
+        other : HashedKeySet
+            The set to merge with this one.
+
+        Returns
+        -------
+        HashedKeySet
+            The merged set.
+        """
+        hashes = array("Q", self._sorted.tobytes())
+        for key_set in (self, other):
+            hashes.extend(key_set._added)
+        hashes.extend(array("Q", other._sorted.tobytes()))
+        return HashedKeySet.from_hashes(hashes)
+
+
+class InventoryIndex:
+    """The keys of an inventory sorted into the groups that the pipelines
+    use, classifying each row once in a single pass through the inventory.
+    """
+
+    RAW_PATTERN = re.compile(
+        r"^(?P<raw_prefix>raw-.*)/\d{4}-\d{2}-\d{2}/(?P<kind>data|images)/(?P<filename>[^/]*)$"
+    )
+    PATIENT_PATTERN = re.compile(
+        r"^(?P<group>training|validation)/data/(?P<pseudonym>[^/]*)/[^/]*$"
+    )
+    PROCESSED_DATA_PATTERN = re.compile(
+        r"^(training|validation)/data/.*/(?P<filename>[^/]*)$"
+    )
+    PROCESSED_IMAGES_PATTERN = re.compile(
+        r"^(training|validation)/(?!data)[^/]*/.*/(?P<filename>[^/]*)$"
+    )
+    PROCESSED_FILENAME_PATTERN = re.compile(
+        r"^(training|validation)/(xray|ct|mri).*/(?P<filename>[^/]*)$"
+    )
+    PROCESSED_GROUPS = ("training", "validation")
+
+    LISTS = (
+        "raw_data",
+        "raw_images",
+        "processed_data",
+        "processed_images",
+        "patient_groups",
+    )
+
+    def __init__(
+        self,
+        downloader,
+        lists=("raw_data", "raw_images", "patient_groups"),
+    ):
+        """The keys of an inventory sorted into groups.
+
+        Only the key lists that the pipeline asks for are kept, the others
+        are None. The processed keys and filenames are always kept, hashed.
+
+        Parameters
+        ----------
+        downloader : InventoryDownloader
+            An initialized downloader instance.
+        lists : tuple[str], default=("raw_data", "raw_images",
+            "patient_groups")
+            The key lists to keep, out of `LISTS`.
+
+        Attributes
+        ----------
+        raw_data : list[tuple[str, str]] or None
+            Raw clinical data files as (raw prefix, key) pairs.
+        raw_images : list[tuple[str, str, int or None]] or None
+            Raw image files as (raw prefix, key, size), listing each
+            filename once per raw prefix and inventory fragment.
+        processed_filenames : HashedKeySet
+            The filenames of the processed images and their metadata.
+        processed_keys : HashedKeySet
+            The keys of the processed clinical data, image, and metadata files.
+        processed_data : list[str] or None
+            The keys of the processed clinical data files.
+        processed_images : list[str] or None
+            The keys of the processed non-data files (images and metadata).
+        patient_groups : list[tuple[str, str]] or None
+            The (pseudonym, group) pairs of the processed clinical data
+            files, until taken with `take_patient_groups`.
+        patient_modified : array.array or None
+            The last modified dates of the files of `patient_groups` as POSIX
+            timestamps (NaN if the inventory doesn't list them).
+        storage_sizes : dict[str, int]
+            Total object sizes under the processed groups and their
+            subfolders (e.g. "training/" and "training/ct/").
+        """
+        unknown = set(lists) - set(self.LISTS)
+        if unknown:
+            raise ValueError(f"Unknown inventory index lists: {unknown}")
+        self._downloader = downloader
+        self.raw_data = [] if "raw_data" in lists else None
+        self.raw_images = [] if "raw_images" in lists else None
+        self.processed_data = [] if "processed_data" in lists else None
+        self.processed_images = [] if "processed_images" in lists else None
+        self.patient_groups = None
+        self.patient_modified = None
+        if "patient_groups" in lists:
+            self.patient_groups = []
+            self.patient_modified = array("d")
+        self.storage_sizes = dict()
+        # Hashes of the processed filenames and keys while reading
+        self._filename_hashes = array("Q")
+        self._key_hashes = array("Q")
+        rows = 0
+        for _, fragment_reader in downloader.get_inventory(ordered=False):
+            # Raw images by prefix and filename, once per fragment
+            fragment_images = dict()
+            for row in fragment_reader:
+                self._classify(row, fragment_images)
+                rows += 1
+            if self.raw_images is not None:
+                self.raw_images.extend(fragment_images.values())
+        self.processed_filenames = HashedKeySet.from_hashes(
+            self._filename_hashes
+        )
+        self.processed_keys = HashedKeySet.from_hashes(self._key_hashes)
+        del self._filename_hashes, self._key_hashes
+        logger.debug(f"Inventory index built from {rows} rows")
+
+    def _classify(self, row, fragment_images):
+        key = row[1]
+        if key.startswith("raw-"):
+            self._classify_raw(row, fragment_images)
+            return
+        parts = key.split("/", 2)
+        if parts[0] not in self.PROCESSED_GROUPS:
+            return
+        size = _row_size(row) or 0
+        for prefix in [f"{parts[0]}/"] + (
+            [f"{parts[0]}/{parts[1]}/"] if len(parts) > 2 else []
+        ):
+            self.storage_sizes[prefix] = (
+                self.storage_sizes.get(prefix, 0) + size
+            )
+        if len(parts) > 1 and parts[1] == "data":
+            self._classify_processed_data(row)
+        else:
+            self._classify_processed_images(row)
+
+    def _classify_raw(self, row, fragment_images):
+        key = row[1]
+        key_match = self.RAW_PATTERN.match(key)
+        if key_match is None:
+            return
+        raw_prefix = sys.intern(key_match.group("raw_prefix"))
+        if key_match.group("kind") == "data":
+            if self.raw_data is not None:
+                self.raw_data.append((raw_prefix, key))
+        elif self.raw_images is not None:
+            # By prefix too, so that the images of other raw prefixes
+            # never shadow those of the configured ones
+            filename = key_match.group("filename")
+            fragment_images[(raw_prefix, filename)] = (
+                raw_prefix,
+                key,
+                _row_size(row),
+            )
+
+    def _classify_processed_data(self, row):
+        key = row[1]
+        if self.PROCESSED_DATA_PATTERN.match(key):
+            if self.processed_data is not None:
+                self.processed_data.append(key)
+            self._key_hashes.append(HashedKeySet.hash(key))
+        if self.patient_groups is not None:
+            self._append_patient(
+                row, self.patient_groups, self.patient_modified
+            )
+
+    def _classify_processed_images(self, row):
+        key = row[1]
+        if self.PROCESSED_IMAGES_PATTERN.match(key):
+            if self.processed_images is not None:
+                self.processed_images.append(key)
+            self._key_hashes.append(HashedKeySet.hash(key))
+        key_match = self.PROCESSED_FILENAME_PATTERN.match(key)
+        if key_match:
+            self._filename_hashes.append(
+                HashedKeySet.hash(key_match.group("filename"))
+            )
+
+    def _append_patient(self, row, patient_groups, patient_modified):
+        key_match = self.PATIENT_PATTERN.match(row[1])
+        if key_match:
+            patient_groups.append(
+                (
+                    key_match.group("pseudonym"),
+                    sys.intern(key_match.group("group")),
+                )
+            )
+            patient_modified.append(_row_modified(row))
+
+    def iter_processed(self, kind):
+        """The keys of the processed clinical data or non-data files, read
+        from the inventory again if the index doesn't keep their list.
+
+        Parameters
+        ----------
+        kind : str
+            "data" or "images"
+
+        Yields
+        ------
+        str
+            The keys of the processed files of the given kind.
+        """
+        keys = self.processed_data if kind == "data" else self.processed_images
+        if keys is not None:
+            yield from keys
+            return
+        pattern = (
+            self.PROCESSED_DATA_PATTERN
+            if kind == "data"
+            else self.PROCESSED_IMAGES_PATTERN
+        )
+        for _, fragment_reader in self._downloader.get_inventory():
+            for row in fragment_reader:
+                if pattern.match(row[1]):
+                    yield row[1]
+
+    def take_patient_groups(self):
+        """The patient groups and their last modified dates, released from
+        the index (and read from the inventory again if taken already).
+
+        Returns
+        -------
+        tuple[list[tuple[str, str]], array.array]
+            The `patient_groups` and `patient_modified` of the index.
+        """
+        patient_groups, patient_modified = (
+            self.patient_groups,
+            self.patient_modified,
+        )
+        self.patient_groups = self.patient_modified = None
+        if patient_groups is not None:
+            return patient_groups, patient_modified
+        patient_groups, patient_modified = [], array("d")
+        for _, fragment_reader in self._downloader.get_inventory():
+            for row in fragment_reader:
+                self._append_patient(row, patient_groups, patient_modified)
+        return patient_groups, patient_modified
+
+
+class CacheContradiction(Exception):
+    pass
+
+
+class PatientCache:
+    """A cache to store group assignments of patient IDs"""
+
+    def __init__(
+        self,
+        downloader,
+        s3client=None,
+        snapshot_dir=None,
+        track_writes=True,
+        margin=datetime.timedelta(days=1),
+    ):
+        """A cache to store group assignments of patient IDs.
+
+        The patients found in the inventory are kept as sorted 64-bit hashes
+        of their IDs, with a bitset of which of them are in the "training"
+        group, using about 8 bytes per patient (see `HashedKeySet`). The
+        patients added during the run are kept in `store`.
+
+        As the assignments never change, the cache is saved as a snapshot
+        (locally and/or in the bucket), with the date of the inventory it
+        covers as its watermark. Later runs load the snapshot and take only
+        the inventory rows modified since the watermark, and not even those
+        if the inventory hasn't changed since. The patients added during a
+        run are appended to a journal next to the local snapshot.
+
+        Parameters
+        ----------
+        downloader: InventoryDownloader
+            An initialized downloader instance.
+        s3client : S3Client, default=None
+            The client to load and save the snapshot in the bucket with.
+        snapshot_dir : str, default=None
+            The local folder to keep the snapshot and the journal in.
+        track_writes : bool, default=True
+            Whether to save the snapshot in the bucket and to journal the
+            added patients (turn off for dry runs).
+        margin : datetime.timedelta, default=1 day
+            How long before the watermark to still take the inventory rows
+            from, covering the objects written while the inventory was
+            generated.
+        """
+        self.downloader = downloader
+        self.s3client = s3client
+        self.track_writes = track_writes
+        self.margin = margin
+        self.store = dict()
+        self._hashes = np.zeros(0, dtype=np.uint64)
+        self._training = np.zeros(0, dtype=np.uint8)
+        self._lock = threading.Lock()
+        self._journal = None
+        self.snapshot_path = None
+        self.journal_path = None
+        if snapshot_dir:
+            name = f"patients-{downloader.get_bucket()}"
+            self.snapshot_path = os.path.join(snapshot_dir, f"{name}.npz")
+            self.journal_path = os.path.join(snapshot_dir, f"{name}.log")
+        self._load_cache()
+
+    def _load_cache(self):
+        watermark = self._load_snapshot()
+        inventory_date = self.downloader.inventory_date
+        if inventory_date is not None:
+            inventory_date = inventory_date.timestamp()
+        if (
+            watermark is None
+            or inventory_date is None
+            or inventory_date > watermark
+        ):
+            self._merge_index(watermark)
+        else:
+            logger.debug("Patient cache snapshot is up to date.")
+        self._read_journal()
+        if inventory_date is not None and (
+            watermark is None or inventory_date > watermark
+        ):
+            watermark = inventory_date
+        self._save_snapshot(watermark)
+
+    def _merge_index(self, watermark):
+        """Merge the patients of the inventory index, those modified since
+        the watermark if given, releasing them from the index."""
+        (
+            patient_groups,
+            patient_modified,
+        ) = self.downloader.get_index().take_patient_groups()
+        if watermark is not None:
+            since = watermark - self.margin.total_seconds()
+            patient_groups = [
+                patient_group
+                for patient_group, modified in zip(
+                    patient_groups, patient_modified
+                )
+                # Rows without a date are taken too
+                if not modified <= since
+            ]
+        self._merge(patient_groups)
+
+    def _load_snapshot(self):
+        """Load the latest of the local and the bucket snapshots.
+
+        Returns
+        -------
+        float or None
+            The watermark of the loaded snapshot, None if there's none.
+        """
+        snapshots = []
+        if self.snapshot_path is not None and os.path.exists(
+            self.snapshot_path
+        ):
+            with open(self.snapshot_path, "rb") as f:
+                snapshots += [self._parse_snapshot(f.read())]
+        if self.s3client is not None:
+            try:
+                snapshots += [
+                    self._parse_snapshot(
+                        self.s3client.object_content(PATIENT_CACHE_KEY)
+                    )
+                ]
+            except ClientError as ex:
+                if ex.response["Error"]["Code"] != "NoSuchKey":
+                    raise
+        snapshots = [snapshot for snapshot in snapshots if snapshot]
+        if not snapshots:
+            logger.info("No patient cache snapshot found.")
+            return None
+        watermark, self._hashes, self._training = max(
+            snapshots, key=lambda snapshot: snapshot[0]
+        )
+        logger.debug(
+            f"Patient cache snapshot loaded: {len(self._hashes)} patients"
+        )
+        return watermark
+
+    @staticmethod
+    def _parse_snapshot(data):
+        try:
+            with np.load(BytesIO(data)) as snapshot:
+                if int(snapshot["version"]) != PATIENT_CACHE_VERSION:
+                    logger.warning("Ignoring patient cache snapshot version.")
+                    return None
+                return (
+                    float(snapshot["watermark"]),
+                    snapshot["hashes"],
+                    snapshot["training"],
+                )
+        except (
+            EOFError,
+            KeyError,
+            OSError,
+            ValueError,
+            zipfile.BadZipFile,
+        ):
+            logger.warning("Invalid patient cache snapshot, ignoring it.")
+            return None
+
+    def _save_snapshot(self, watermark):
+        """Save the patients into a new snapshot, and start a new journal
+        for the patients added later."""
+        if watermark is None:
+            return
+        buffer = BytesIO()
+        np.savez(
+            buffer,
+            version=np.array(PATIENT_CACHE_VERSION),
+            watermark=np.array(watermark),
+            hashes=self._hashes,
+            training=self._training,
+        )
+        if self.s3client is not None and self.track_writes:
+            self.s3client.put_object(PATIENT_CACHE_KEY, buffer.getvalue())
+        if self.snapshot_path is None:
+            return
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            mode="wb",
+            dir=os.path.dirname(self.snapshot_path),
+            suffix=".part",
+            delete=False,
+        ) as f:
+            f.write(buffer.getvalue())
+        os.replace(f.name, self.snapshot_path)
+        if self.track_writes:
+            self._journal = open(self.journal_path, "w", encoding="utf-8")
+
+    def _read_journal(self):
+        if self.journal_path is None or not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, encoding="utf-8") as f:
+            patient_groups = [
+                tuple(line.rstrip("\n").rsplit(",", 1))
+                for line in f
+                if "," in line
+            ]
+        self._merge(patient_groups)
+
+    def _merge(self, patient_groups):
+        """Merge (patient ID, group) pairs into the sorted hashes, checking
+        for contradicting groups."""
+        cached = len(self._hashes)
+        hashes = np.concatenate(
+            (
+                self._hashes,
+                np.fromiter(
+                    (
+                        HashedKeySet.hash(patient_id)
+                        for patient_id, _ in patient_groups
+                    ),
+                    dtype=np.uint64,
+                    count=len(patient_groups),
+                ),
+            )
+        )
+        training = np.concatenate(
+            (
+                np.unpackbits(self._training, count=cached).astype(bool),
+                np.fromiter(
+                    (group == "training" for _, group in patient_groups),
+                    dtype=bool,
+                    count=len(patient_groups),
+                ),
+            )
+        )
+        order = np.lexsort((training, hashes))
+        hashes, training = hashes[order], training[order]
+        repeated = hashes[1:] == hashes[:-1]
+        contradictions = repeated & (training[1:] != training[:-1])
+        if contradictions.any():
+            position = np.argmax(contradictions)
+            patient_groups_position = (
+                max(order[position], order[position + 1]) - cached
+            )
+            raise CacheContradiction(
+                "Found patient with ambiguous groups: "
+                + patient_groups[patient_groups_position][0]
+            )
+        unique = np.ones(len(hashes), dtype=bool)
+        unique[1:] = ~repeated
+        self._hashes = hashes[unique]
+        self._training = np.packbits(training[unique])
+
+    def _cached_training(self, patient_id):
+        """Whether a patient from the inventory is in the "training" group,
+        or None if the patient is not listed there."""
+        hashed = np.uint64(HashedKeySet.hash(patient_id))
+        position = np.searchsorted(self._hashes, hashed)
+        if position == len(self._hashes) or self._hashes[position] != hashed:
+            return None
+        return bool(self._training[position >> 3] & (0x80 >> (position & 7)))
+
+    def add(self, patient_id, group):
+        """Add an item to an existing patient cache
+
+        Paramters
+        ---------
+        patient_id : str
+            The patient ID or pseudonym to store
+        group : str
+            Expected group is "training" or "validation", only stores whether the patient is in the "training group or not.
+        """
+        training = self.store.get(patient_id)
+        if training is None:
+            training = self._cached_training(patient_id)
+        if training is None:
+            self.store[patient_id] = group == "training"
+            if self._journal is not None:
+                with self._lock:
+                    self._journal.write(f"{patient_id},{group}\n")
+                    self._journal.flush()
+        elif training != (group == "training"):
+            raise CacheContradiction(
+                f"Found patient with ambiguous groups: {patient_id}"
+            )
+
+    def get_group(self, patient_id):
+        """Check if a given patient is in "training" or "validation" group,
+        or even known to the cache or not.
+
+        Parameters
+        ----------
+        patient_id : str
+            The patient ID / pseudonym in question
+
+        Returns
+        -------
+        group : str or None
+            The values "training" or "validation" if grouping is known, or None if patient is not in cache.
+        """
+        training = self.store.get(patient_id)
+        if training is None:
+            training = self._cached_training(patient_id)
+        if training is None:
+            # Not Cached
+            return None
+        return "training" if training else "validation"
+
+
+class ExistenceIndex:
+    """An index of the processed objects listed in the inventory, to check
+    whether a given key exists without a request to S3 for each."""
+
+    def __init__(
+        self,
+        downloader,
+        s3client=None,
+        track_writes=True,
+        margin=datetime.timedelta(hours=1),
+        save_interval=datetime.timedelta(minutes=1),
+        manifests=None,
+    ):
+        """An index of the processed objects listed in the inventory.
+
+        Keys are stored in a `HashedKeySet` to keep the memory use low. Keys
+        that are not in the index are checked in S3 as well (if a client is
+        given), unless the bucket's write marker shows that nothing was
+        written since the inventory was generated. The metadata of images
+        written into per-series files are found in their manifests.
+
+        Parameters
+        ----------
+        downloader : InventoryDownloader
+            An initialized downloader instance.
+        s3client : S3Client, default=None
+            The client to check keys missing from the inventory with,
+            and to keep the write marker with.
+        track_writes : bool, default=True
+            Whether to update the write marker in the bucket when new keys
+            are added (turn off for dry runs).
+        margin : datetime.timedelta, default=1 hour
+            How much earlier than the inventory the last recorded write
+            has to be to trust the inventory for missing keys, leaving
+            time for the writes queued after the recorded decisions.
+        save_interval : datetime.timedelta, default=1 minute
+            How often to update the write marker while adding keys (the
+            writes after the last update are covered by the margin).
+        manifests : MetadataManifests, default=None
+            The images whose metadata are in per-series files.
+        """
+        self.downloader = downloader
+        self.s3client = s3client
+        self.manifests = manifests
+        self.track_writes = track_writes
+        self.save_interval = save_interval
+        self.store = self.downloader.get_index().processed_keys.copy()
+        self._saved_write = None
+        self._lock = threading.Lock()
+        self.verify_missing = self._needs_verification(margin)
+        logger.debug(
+            f"Existence index: {len(self.store)} keys, "
+            + f"verifying missing keys: {self.verify_missing}"
+        )
+
+    def _needs_verification(self, margin):
+        inventory_date = self.downloader.inventory_date
+        if self.s3client is None or inventory_date is None:
+            return self.s3client is not None
+        try:
+            marker = json.loads(
+                self.s3client.object_content(WRITE_MARKER_KEY).decode("utf-8")
+            )
+            last_write = datetime.datetime.fromtimestamp(
+                float(marker["last_write"]), datetime.timezone.utc
+            )
+        except ClientError as ex:
+            if ex.response["Error"]["Code"] == "NoSuchKey":
+                logger.info("No write marker found, verifying missing keys.")
+                return True
+            raise
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Invalid write marker, verifying missing keys.")
+            return True
+        return last_write + margin >= inventory_date
+
+    def exists(self, key):
+        """Check whether an object exists in the bucket.
+
+        Parameters
+        ----------
+        key : str
+            The object key in question.
+
+        Returns
+        -------
+        bool
+            True if the object is listed in the inventory, was added
+            during this run, is an image metadata file written into a
+            per-series file, or (if checking is needed) is found in S3.
+        """
+        if self.listed(key):
+            return True
+        if self.verify_missing:
+            return self.s3client.object_exists(key)
+        return False
+
+    def listed(self, key):
+        """Check whether an object is known to exist, without checking in
+        S3 for the keys missing from the inventory.
+
+        Parameters
+        ----------
+        key : str
+            The object key in question.
+
+        Returns
+        -------
+        bool
+            True if the object is listed in the inventory, was added
+            during this run, or is an image metadata file written into a
+            per-series file.
+        """
+        if key in self.store:
+            return True
+        return self.manifests is not None and key in self.manifests
+
+    def add(self, key):
+        """Record a key that is going to be written during this run.
+
+        Parameters
+        ----------
+        key : str
+            The object key to add to the index.
+        """
+        self.store.add(key)
+        if not self.track_writes or self.s3client is None:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            if (
+                self._saved_write is None
+                or now - self._saved_write >= self.save_interval
+            ):
+                self._save_marker(now)
+
+    def discard(self, key):
+        """Forget a key recorded with `add` whose write failed, so it's
+        taken again (the keys listed in the inventory are kept).
+
+        Parameters
+        ----------
+        key : str
+            The object key to remove from the index.
+        """
+        self.store.discard(key)
+
+    def _save_marker(self, last_write):
+        contents = {"last_write": last_write.timestamp()}
+        self.s3client.put_object(WRITE_MARKER_KEY, json.dumps(contents))
+        self._saved_write = last_write
+
+
+class RawWatermarks:
+    """The latest upload date folders seen under each raw prefix, to only
+    enumerate the folders from that date on in later runs, and the raw
+    files left unresolved to take again whatever their date folders."""
+
+    def __init__(self, s3client=None, full=False):
+        """The latest upload date folders seen under each raw prefix.
+
+        The watermarks are kept in the bucket next to the configuration
+        file. A run takes the date folders at or after the watermark of
+        their raw prefix (the latest folder is taken again, as uploads can
+        continue into it), and the watermarks are moved on to the latest
+        folders seen when the run is finished.
+
+        The raw files left unresolved in a run are saved with the
+        watermarks, for later runs to take them again until they are
+        resolved: the images whose patients are not known yet (with their
+        patients) or whose headers were not read, the clinical data files
+        skipped (e.g. without a submitting centre), and the files whose
+        outputs failed to be written. A raw file is only resolved once all
+        its outputs are written (see `expect` and `written`).
+
+        Parameters
+        ----------
+        s3client : S3Client, default=None
+            The client to load and save the watermarks with.
+        full : bool, default=False
+            Whether to take all the date folders, e.g. for backfills (the
+            watermarks are still updated).
+        """
+        self.s3client = s3client
+        self.full = full
+        self.watermarks = dict()
+        self.seen = dict()
+        # The raw files to retry from earlier runs, with their patients
+        self.retries = dict()
+        self._unresolved = dict()
+        self._resolved = set()
+        # The outputs still to be written, and their raw files
+        self._outputs = dict()
+        self._remaining = dict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if self.s3client is None:
+            return
+        try:
+            contents = json.loads(
+                self.s3client.object_content(WATERMARK_KEY).decode("utf-8")
+            )
+            retries = dict(contents.get("retries", {}))
+            self.watermarks = {
+                prefix: date
+                for prefix, date in contents["watermarks"].items()
+                if isinstance(date, str)
+            }
+            self.retries = retries
+        except ClientError as ex:
+            if ex.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            logger.info("No raw watermarks found, taking all date folders.")
+        except (KeyError, AttributeError, TypeError, ValueError):
+            logger.warning("Invalid raw watermarks, taking all date folders.")
+
+    def include(self, raw_prefix, key):
+        """Check whether a raw file is in a date folder to take in this run,
+        recording the date folder as seen.
+
+        Parameters
+        ----------
+        raw_prefix : str
+            The raw prefix of the file (without the trailing slash).
+        key : str
+            The object key of the file.
+
+        Returns
+        -------
+        bool
+            True if the file is to be taken (files outside of date folders
+            are always taken).
+        """
+        date = helpers.get_date_from_key(key)
+        if date is None:
+            return True
+        with self._lock:
+            if date > self.seen.get(raw_prefix, ""):
+                self.seen[raw_prefix] = date
+        if self.full:
+            return True
+        return date >= self.watermarks.get(raw_prefix, "")
+
+    def retry(self, key, patient_id=None):
+        """Note a raw file left unresolved in this run, to take it again in
+        later runs.
+
+        Parameters
+        ----------
+        key : str
+            The object key of the raw file.
+        patient_id : str, default=None
+            The patient of an image, if its header was read.
+        """
+        with self._lock:
+            self._unresolved[key] = patient_id
+            self._resolved.discard(key)
+
+    def resolve(self, key):
+        """Note a raw file as resolved, so it's not taken again.
+
+        Parameters
+        ----------
+        key : str
+            The object key of the raw file.
+        """
+        if key not in self.retries and key not in self._unresolved:
+            return
+        with self._lock:
+            self._unresolved.pop(key, None)
+            self._resolved.add(key)
+
+    def expect(self, key, outputs):
+        """Note the outputs to be written for a raw file, which is resolved
+        once all of them are.
+
+        Parameters
+        ----------
+        key : str
+            The object key of the raw file.
+        outputs : iterable of str
+            The keys of the outputs to be written.
+        """
+        outputs = list(outputs)
+        if not outputs:
+            self.resolve(key)
+            return
+        with self._lock:
+            for output_key in outputs:
+                self._outputs[output_key] = key
+            self._remaining[key] = self._remaining.get(key, 0) + len(outputs)
+
+    def written(self, output_key):
+        """Note an output as written, resolving its raw file if it was the
+        last one to be written.
+
+        Parameters
+        ----------
+        output_key : str
+            The key of the output.
+        """
+        with self._lock:
+            key = self._outputs.pop(output_key, None)
+            if key is None or key not in self._remaining:
+                # Not expected, or another output of the file failed
+                return
+            self._remaining[key] -= 1
+            if self._remaining[key] > 0:
+                return
+            del self._remaining[key]
+        self.resolve(key)
+
+    def failed(self, output_key):
+        """Note an output that failed to be written, to take its raw file
+        again in later runs.
+
+        Parameters
+        ----------
+        output_key : str
+            The key of the output.
+        """
+        with self._lock:
+            key = self._outputs.pop(output_key, None)
+            if key is None:
+                return
+            self._remaining.pop(key, None)
+        self.retry(key)
+
+    def save(self):
+        """Move the watermarks to the latest date folders seen, and save
+        them in the bucket with the images to retry."""
+        with self._lock:
+            for raw_prefix, date in self.seen.items():
+                if date > self.watermarks.get(raw_prefix, ""):
+                    self.watermarks[raw_prefix] = date
+            for key in self._resolved:
+                self.retries.pop(key, None)
+            # Outputs neither written nor failed (e.g. their step crashed)
+            for key in self._remaining:
+                self._unresolved.setdefault(key, None)
+            self.retries.update(self._unresolved)
+            self._unresolved = dict()
+            self._resolved = set()
+        if self.s3client is None:
+            return
+        contents = {"watermarks": self.watermarks, "retries": self.retries}
+        self.s3client.put_object(WATERMARK_KEY, json.dumps(contents))
+
+
+class RunJournal:
+    """An append-only journal of the work completed for each raw file in a
+    run, to skip the completed files when an interrupted run restarts."""
+
+    def __init__(
+        self,
+        name,
+        s3client=None,
+        journal_dir=None,
+        sync_interval=None,
+        budget=None,
+        track_writes=True,
+    ):
+        """An append-only journal of the work completed in a run.
+
+        Each line records an action completed for a raw file: "copy" and
+        "metadata" for its outputs written, and "done" once all of them
+        are. The journal is kept in a local file, and copied to the bucket
+        every `sync_interval`, so a task restarted elsewhere can continue
+        from it. It's removed when a run finishes, as the watermarks and
+        the write marker cover the completed work from then on.
+
+        Parameters
+        ----------
+        name : str
+            The name of the journal, unique to the bucket and the shard.
+        s3client : S3Client, default=None
+            The client to sync the journal to the bucket with.
+        journal_dir : str, default=None
+            The local folder to keep the journal in (kept in memory only
+            if not given).
+        sync_interval : datetime.timedelta, default=None
+            How often to copy the journal to the bucket, not copied if
+            not given.
+        budget : datetime.timedelta, default=None
+            The time after which to stop taking new files, unlimited if
+            not given.
+        track_writes : bool, default=True
+            Whether to write the journal (turn off for dry runs).
+        """
+        self.s3client = s3client
+        self.sync_interval = sync_interval
+        self.track_writes = track_writes
+        self.key = f"{JOURNAL_PREFIX}{name}.log"
+        self.path = None
+        if journal_dir:
+            self.path = os.path.join(journal_dir, f"{name}.log")
+        self.deadline = None
+        if budget is not None:
+            self.deadline = time.monotonic() + budget.total_seconds()
+        self.interrupted = False
+        self.completed = dict()
+        # The outputs still to be written, and their raw files
+        self._pending = dict()
+        self._remaining = dict()
+        self._journal = None
+        self._synced = time.monotonic()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        contents = []
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                contents += [f.read()]
+        if self.s3client is not None and self.sync_interval is not None:
+            try:
+                contents += [
+                    self.s3client.object_content(self.key).decode("utf-8")
+                ]
+            except ClientError as ex:
+                if ex.response["Error"]["Code"] != "NoSuchKey":
+                    raise
+        for content in contents:
+            self._add_entries(content)
+        if self.completed:
+            logger.info(
+                f"Run journal loaded: {len(self.completed)} raw files."
+            )
+        if self.path is None or not self.track_writes:
+            return
+        # Start with the merged entries, leaving out the cut short lines
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._journal = open(self.path, "w", encoding="utf-8")
+        for key, actions in self.completed.items():
+            for action in actions:
+                self._journal.write(f"{action}\t{key}\n")
+        self._journal.flush()
+
+    def _add_entries(self, content):
+        """Add the entries of a journal's contents to the completed work.
+
+        Parameters
+        ----------
+        content : str
+            The journal lines, each an action and a raw file key separated
+            by a tab.
+        """
+        for line in content.splitlines():
+            # Lines cut short by an interruption have no separator
+            if "\t" in line:
+                action, key = line.split("\t", 1)
+                self.completed.setdefault(key, set()).add(action)
+
+    def done(self, key):
+        """Check whether all the work for a raw file was completed.
+
+        Parameters
+        ----------
+        key : str
+            The key of the raw file.
+
+        Returns
+        -------
+        bool
+            True if the raw file was handled in an earlier attempt.
+        """
+        return "done" in self.completed.get(key, ())
+
+    def expect(self, key, outputs):
+        """Record the outputs to be written for a raw file, which is done
+        once all of them are.
+
+        Parameters
+        ----------
+        key : str
+            The key of the raw file.
+        outputs : dict
+            The actions ("copy" or "metadata") by the keys of the outputs
+            to be written.
+        """
+        with self._lock:
+            for output_key, action in outputs.items():
+                self._pending[output_key] = (key, action)
+            if outputs:
+                remaining = self._remaining.get(key, 0)
+                self._remaining[key] = remaining + len(outputs)
+            elif key not in self._remaining:
+                self._append(key, "done")
+
+    def written(self, output_key):
+        """Record an output as written.
+
+        Parameters
+        ----------
+        output_key : str
+            The key of the output, as given to `expect`.
+        """
+        with self._lock:
+            if output_key not in self._pending:
+                return
+            key, action = self._pending.pop(output_key)
+            self._append(key, action)
+            self._remaining[key] -= 1
+            if self._remaining[key] == 0:
+                del self._remaining[key]
+                self._append(key, "done")
+
+    def _append(self, key, action):
+        self.completed.setdefault(key, set()).add(action)
+        if self._journal is None:
+            return
+        self._journal.write(f"{action}\t{key}\n")
+        self._journal.flush()
+        if self.sync_interval is None:
+            return
+        elapsed = time.monotonic() - self._synced
+        if elapsed >= self.sync_interval.total_seconds():
+            self._sync()
+
+    def _sync(self):
+        if self.s3client is None or self.path is None:
+            return
+        self.s3client.upload_file(self.key, self.path)
+        self._synced = time.monotonic()
+
+    def out_of_time(self):
+        """Check whether the time budget of the run is used up, in which
+        case no new files are to be taken.
+
+        Returns
+        -------
+        bool
+            True if the run is past its budget.
+        """
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.interrupted = True
+        return self.interrupted
+
+    def close(self):
+        """Finish the journal at the end of a run: remove it if the run
+        got through all the files, otherwise save it for the next attempt.
+        """
+        if self._journal is None:
+            return
+        with self._lock:
+            self._journal.close()
+            self._journal = None
+            if self.interrupted:
+                if self.sync_interval is not None:
+                    self._sync()
+                logger.info(
+                    f"Run journal saved: {len(self.completed)} raw files."
+                )
+                return
+            os.remove(self.path)
+            if self.s3client is not None and self.sync_interval is not None:
+                self.s3client.delete_object(self.key)
+
+
+class MetadataManifests:
+    """The images whose metadata are in the per-series metadata files, as
+    listed by the manifests written along with them."""
+
+    def __init__(self, s3client=None, cache_dir=None):
+        """The images whose metadata are in the per-series metadata files.
+
+        Each manifest lists the rows of the series files written together,
+        as {"series": {series file key: [image UUID of each row]}}. All the
+        manifests are listed on start (not taken from the inventory, so the
+        latest ones are included too), and as they are never changed, they
+        are downloaded only once if a local folder is given.
+
+        Parameters
+        ----------
+        s3client : S3Client, default=None
+            The client to list and download the manifests with.
+        cache_dir : str, default=None
+            The local folder to keep the downloaded manifests in.
+        """
+        self.s3client = s3client
+        self.cache_dir = cache_dir
+        self.keys = HashedKeySet()
+        self.filenames = HashedKeySet()
+        self.manifests = 0
+        if s3client is not None:
+            self._load()
+
+    def _load(self):
+        key_hashes = array("Q")
+        filename_hashes = array("Q")
+        for key in self.s3client.list_keys(METADATA_MANIFEST_PREFIX):
+            for image_key in self.image_keys(self._read(key)):
+                key_hashes.append(HashedKeySet.hash(image_key))
+                filename_hashes.append(
+                    HashedKeySet.hash(image_key.rsplit("/", 1)[-1])
+                )
+            self.manifests += 1
+        self.keys = HashedKeySet.from_hashes(key_hashes)
+        self.filenames = HashedKeySet.from_hashes(filename_hashes)
+        logger.debug(
+            f"Metadata manifests: {self.manifests} manifests, "
+            + f"{len(self.keys)} images"
+        )
+
+    def _read(self, key):
+        path = None
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, key.rsplit("/", 1)[-1])
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    return self._parse(f.read())
+        content = self.s3client.object_content(key)
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                mode="wb", dir=self.cache_dir, suffix=".part", delete=False
+            ) as f:
+                f.write(content)
+            os.replace(f.name, path)
+        return self._parse(content)
+
+    @staticmethod
+    def _parse(content):
+        manifest = json.loads(gzip.decompress(content).decode("utf-8"))
+        if manifest.get("version") != METADATA_MANIFEST_VERSION:
+            logger.warning("Ignoring metadata manifest version.")
+            return {"series": {}}
+        return manifest
+
+    @staticmethod
+    def image_keys(manifest):
+        """The keys of the per-image metadata files that the rows of the
+        series files in a manifest stand for.
+
+        Parameters
+        ----------
+        manifest : dict
+            The manifest to go through.
+
+        Yields
+        ------
+        str
+            The metadata key of each image.
+        """
+        for series_key, uuids in manifest["series"].items():
+            folder = series_key.rsplit("/", 1)[0]
+            for image_uuid in uuids:
+                yield f"{folder}/{image_uuid}.json"
+
+    def add(self, manifest):
+        """Add the images of a newly written manifest.
+
+        Parameters
+        ----------
+        manifest : dict
+            The manifest written.
+        """
+        for image_key in self.image_keys(manifest):
+            self.keys.add(image_key)
+            self.filenames.add(image_key.rsplit("/", 1)[-1])
+
+    def __contains__(self, key):
+        return key in self.keys
+
+
+class SeriesMetadataWriter:
+    """Collect the metadata of the images by series, to write one file per
+    series instead of one per image."""
+
+    METADATA_PATTERN = re.compile(
+        r"^(?P<series>(training|validation)/[^/]*-metadata/[^/]+/[^/]+/[^/]+)/(?P<uuid>[^/]+)\.json$"
+    )
+
+    def __init__(
+        self,
+        s3client,
+        manifests=None,
+        journal=None,
+        max_rows=SERIES_METADATA_MAX_ROWS,
+        max_buffer_mb=SERIES_METADATA_BUFFER_MB,
+        watermarks=None,
+    ):
+        """Collect the metadata of the images by series.
+
+        The metadata of a series are written as a gzipped NDJSON file next
+        to where the per-image files would be, one row per image, e.g.
+        `training/ct-metadata/PATIENT_ID/STUDY_UID/SERIES_UID/PART.ndjson.gz`.
+        The files written together are listed in a manifest under
+        `METADATA_MANIFEST_PREFIX` (see `MetadataManifests`), written after
+        them, so the images are only taken as done once their rows are
+        written.
+
+        Parameters
+        ----------
+        s3client : S3Client
+            The client to write the files with.
+        manifests : MetadataManifests, default=None
+            The manifests to add the written ones to.
+        journal : RunJournal, default=None
+            The journal to record the written images in.
+        max_rows : int, default=SERIES_METADATA_MAX_ROWS
+            The number of images at which a series is written.
+        max_buffer_mb : int, default=SERIES_METADATA_BUFFER_MB
+            The size of the collected metadata at which all the series
+            are written.
+        watermarks : RawWatermarks, default=None
+            To note the images whose metadata are written, or failed to be.
+        """
+        self.s3client = s3client
+        self.manifests = manifests
+        self.journal = journal
+        self.watermarks = watermarks
+        self.max_rows = max_rows
+        self.max_buffer_size = max_buffer_mb * KB * KB
+        self.counters = {"images": 0, "series_files": 0, "manifests": 0}
+        self._series = dict()
+        self._buffer_size = 0
+        self._lock = threading.Lock()
+
+    def add(self, key, content):
+        """Collect the metadata of an image, if it's a metadata file.
+
+        Parameters
+        ----------
+        key : str
+            The key of the per-image metadata file.
+        content : bytes
+            The metadata as a single line of JSON.
+
+        Returns
+        -------
+        bool
+            True if the metadata is collected, False if the key is not
+            of a metadata file (to be written as it is).
+        """
+        key_match = self.METADATA_PATTERN.match(key)
+        if key_match is None:
+            return False
+        series = key_match.group("series")
+        with self._lock:
+            rows = self._series.setdefault(series, [])
+            rows.append((key, key_match.group("uuid"), content))
+            self._buffer_size += len(content)
+            if len(rows) >= self.max_rows:
+                self._write({series: self._series.pop(series)})
+            elif self._buffer_size >= self.max_buffer_size:
+                self._write(self._series)
+                self._series = dict()
+                self._buffer_size = 0
+        return True
+
+    def flush(self):
+        """Write all the collected series."""
+        with self._lock:
+            if self._series:
+                self._write(self._series)
+            self._series = dict()
+            self._buffer_size = 0
+
+    def _write(self, series_rows):
+        try:
+            self._write_series(series_rows)
+        except Exception:  # noqa: E722
+            if self.watermarks is not None:
+                for rows in series_rows.values():
+                    for key, _, _ in rows:
+                        self.watermarks.failed(key)
+            raise
+        for rows in series_rows.values():
+            self.counters["images"] += len(rows)
+            for key, _, _ in rows:
+                if self.journal is not None:
+                    self.journal.written(key)
+                if self.watermarks is not None:
+                    self.watermarks.written(key)
+
+    def _write_series(self, series_rows):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        part = f"{now:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:12]}"
+        manifest = {"version": METADATA_MANIFEST_VERSION, "series": dict()}
+        for series, rows in series_rows.items():
+            series_key = f"{series}/{part}.ndjson.gz"
+            content = b"".join(row + b"\n" for _, _, row in rows)
+            self.s3client.put_object(series_key, gzip.compress(content))
+            self._buffer_size -= sum(len(row) for _, _, row in rows)
+            manifest["series"][series_key] = [
+                image_uuid for _, image_uuid, _ in rows
+            ]
+            self.counters["series_files"] += 1
+        self.s3client.put_object(
+            f"{METADATA_MANIFEST_PREFIX}{part}.json.gz",
+            gzip.compress(json.dumps(manifest).encode("utf-8")),
+        )
+        self.counters["manifests"] += 1
+        if self.manifests is not None:
+            self.manifests.add(manifest)
+
+
+class HeaderSizeStats:
+    """Running statistics of the DICOM header lengths seen under each
+    raw prefix, to pick the initial download range for new images."""
+
+    # Room for the pixel data element's own header after the header
+    PIXEL_TAG_MARGIN = 16
+
+    def __init__(
+        self,
+        s3client=None,
+        percentile=90,
+        default_range_kb=20,
+        min_samples=10,
+        max_samples=1000,
+    ):
+        """Running statistics of the DICOM header lengths seen under each
+        raw prefix.
+
+        Parameters
+        ----------
+        s3client : S3Client, default=None
+            If set, the statistics of previous runs are loaded from, and
+            can be saved to the bucket this client is set up for.
+        percentile : int, default=90
+            The percentile of the header lengths to cover with the initial range.
+        default_range_kb : int, default=20
+            The initial range to use until enough samples are collected.
+        min_samples : int, default=10
+            The number of samples needed for a prefix before using them.
+        max_samples : int, default=1000
+            The number of most recent samples to keep for each prefix.
+        """
+        self.s3client = s3client
+        self.percentile = percentile
+        self.default_range_kb = default_range_kb
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.samples = dict()
+        self._load()
+
+    def _load(self):
+        if self.s3client is None:
+            return
+        try:
+            contents = json.loads(
+                self.s3client.object_content(HEADER_STATS_KEY).decode("utf-8")
+            )
+        except ClientError as ex:
+            if ex.response["Error"]["Code"] == "NoSuchKey":
+                logger.info("No header length statistics found, starting new.")
+                return
+            raise
+        for prefix, lengths in contents.get("prefixes", {}).items():
+            self.samples[prefix] = deque(lengths, maxlen=self.max_samples)
+
+    @staticmethod
+    def _prefix(key):
+        return key.split("/", 1)[0]
+
+    def record(self, key, header_length):
+        """Add a new header length observation.
+
+        Parameters
+        ----------
+        key : str
+            The object key of the image
+        header_length : int or None
+            The number of bytes before the pixel data, None if not known
+        """
+        if header_length is None:
+            return
+        prefix = self._prefix(key)
+        if prefix not in self.samples:
+            self.samples[prefix] = deque(maxlen=self.max_samples)
+        self.samples[prefix].append(header_length)
+
+    def initial_range_kb(self, key):
+        """The initial download range expected to cover the header of
+        a given image, based on the images seen under the same prefix.
+
+        Parameters
+        ----------
+        key : str
+            The object key of the image
+
+        Returns
+        -------
+        int
+            The range to download first, in kilobytes
+        """
+        samples = self.samples.get(self._prefix(key), [])
+        if len(samples) < self.min_samples:
+            return self.default_range_kb
+        ordered = sorted(samples)
+        rank = math.ceil(self.percentile / 100 * len(ordered)) - 1
+        length = ordered[min(max(rank, 0), len(ordered) - 1)]
+        return max(1, math.ceil((length + self.PIXEL_TAG_MARGIN) / KB))
+
+    def save(self):
+        """Store the collected statistics in the bucket, for the next run."""
+        if self.s3client is None:
+            return
+        contents = {
+            "version": 1,
+            "prefixes": {
+                prefix: list(lengths)
+                for prefix, lengths in self.samples.items()
+            },
+        }
+        self.s3client.put_object(HEADER_STATS_KEY, json.dumps(contents))
+
+
+class HeaderCache:
+    """The header records of the images whose patients are not known yet,
+    kept between runs so they are not downloaded again."""
+
+    FIELDS = (
+        "patient_id",
+        "study_id",
+        "series_id",
+        "modality",
+        "metadata",
+        "header_length",
+    )
+
+    def __init__(self, store_path=None, track_writes=True, s3client=None):
+        """The header records of the images whose patients are not known.
+
+        An image whose patient has no clinical data yet is deferred: its
+        header record is kept in a local SQLite database, with the image
+        waiting in the deferred queue (the images to take again in later
+        runs are noted with the raw watermarks in the bucket, see
+        `RawWatermarks`). Later runs take the header from here (without
+        any request) once the patient is known, and the image leaves the
+        queue when it's resolved. The records are counted in `counters`:
+        "deferred" images added to the queue, "hits" headers taken from
+        the store, and "resolved" images that left the queue.
+
+        Where the local database is not kept between runs (e.g. on a task
+        without a persistent volume), the records are kept in the bucket
+        too, as `HEADER_CACHE_KEY` next to the raw watermarks, written by
+        `save` and loaded into an empty store.
+
+        Parameters
+        ----------
+        store_path : str, default=None
+            The SQLite database file to keep the records in between runs,
+            only kept in memory for the run if not given.
+        track_writes : bool, default=True
+            Whether to add and remove records in the store, and save them
+            in the bucket (turn off for dry runs, that only read it).
+        s3client : S3Client, default=None
+            The client to load and save the records in the bucket with.
+        """
+        self.track_writes = track_writes
+        self.s3client = s3client
+        self.counters = {"deferred": 0, "hits": 0, "resolved": 0}
+        self._lock = threading.Lock()
+        if store_path:
+            folder = os.path.dirname(store_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+        self._store = sqlite3.connect(
+            store_path or ":memory:",
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._store.execute(
+            "CREATE TABLE IF NOT EXISTS headers "
+            + "(key TEXT PRIMARY KEY, patient_id TEXT NOT NULL, "
+            + "study_id TEXT, series_id TEXT, modality TEXT, "
+            + "metadata BLOB, header_length INTEGER)"
+        )
+        # The deferred images, to only query the store for them
+        self._keys = {
+            row[0] for row in self._store.execute("SELECT key FROM headers")
+        }
+        if not self._keys:
+            self._load()
+
+    def _load(self):
+        if self.s3client is None:
+            return
+        try:
+            content = self.s3client.object_content(HEADER_CACHE_KEY)
+        except ClientError as ex:
+            if ex.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            logger.info("No header cache found in the bucket.")
+            return
+        columns = ", ".join(("key",) + self.FIELDS)
+        placeholders = ", ".join("?" * (len(self.FIELDS) + 1))
+        rows = []
+        try:
+            with gzip.open(BytesIO(content), mode="rt") as f:
+                for line in f:
+                    record = json.loads(line)
+                    record["metadata"] = zlib.compress(
+                        record["metadata"].encode("utf-8")
+                    )
+                    rows += [
+                        [record["key"]]
+                        + [record.get(field) for field in self.FIELDS]
+                    ]
+        except (OSError, EOFError, KeyError, AttributeError, ValueError):
+            logger.warning("Invalid header cache in the bucket, ignored.")
+            return
+        self._store.executemany(
+            f"INSERT OR REPLACE INTO headers ({columns}) "
+            + f"VALUES ({placeholders})",
+            rows,
+        )
+        self._keys.update(row[0] for row in rows)
+        logger.info(f"Header cache loaded: {len(rows)} images deferred")
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def get(self, key):
+        """The header record of a deferred image.
+
+        Parameters
+        ----------
+        key : str
+            The object key of the raw image.
+
+        Returns
+        -------
+        dict or None
+            The fields of the header record (see `FIELDS`), with the
+            metadata as JSON bytes, or None if the image is not deferred.
+        """
+        if key not in self._keys:
+            return None
+        with self._lock:
+            row = self._store.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM headers WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.counters["hits"] += 1
+        record = dict(zip(self.FIELDS, row))
+        record["metadata"] = zlib.decompress(record["metadata"])
+        return record
+
+    def defer(self, key, record):
+        """Add an image to the deferred queue, with its header record.
+
+        Parameters
+        ----------
+        key : str
+            The object key of the raw image.
+        record : object
+            The header record, with the `FIELDS` as attributes (the
+            metadata as JSON bytes, the header length can be None).
+        """
+        if not self.track_writes or key in self._keys:
+            return
+        values = [getattr(record, field, None) for field in self.FIELDS]
+        values[self.FIELDS.index("metadata")] = zlib.compress(record.metadata)
+        columns = ", ".join(("key",) + self.FIELDS)
+        placeholders = ", ".join("?" * (len(self.FIELDS) + 1))
+        with self._lock:
+            self._store.execute(
+                f"INSERT OR REPLACE INTO headers ({columns}) "
+                + f"VALUES ({placeholders})",
+                [key] + values,
+            )
+            self._keys.add(key)
+            self.counters["deferred"] += 1
+
+    def resolve(self, key):
+        """Remove an image from the deferred queue, once its patient is
+        known.
+
+        Parameters
+        ----------
+        key : str
+            The object key of the raw image.
+        """
+        if not self.track_writes or key not in self._keys:
+            return
+        with self._lock:
+            self._store.execute("DELETE FROM headers WHERE key = ?", (key,))
+            self._keys.discard(key)
+            self.counters["resolved"] += 1
+
+    def save(self):
+        """Save the records in the bucket, for the runs that don't have the
+        local database."""
+        if self.s3client is None or not self.track_writes:
+            return
+        buffer = BytesIO()
+        with self._lock:
+            rows = self._store.execute(
+                f"SELECT key, {', '.join(self.FIELDS)} FROM headers "
+                + "ORDER BY key"
+            )
+            with gzip.open(buffer, mode="wt", encoding="utf-8") as f:
+                for row in rows:
+                    record = dict(zip(("key",) + self.FIELDS, row))
+                    record["metadata"] = zlib.decompress(
+                        record["metadata"]
+                    ).decode("utf-8")
+                    f.write(json.dumps(record) + "\n")
+        self.s3client.put_object(HEADER_CACHE_KEY, buffer.getvalue())
+
+    def deferred(self):
+        """The images in the deferred queue, with their patients.
+
+        Yields
+        ------
+        tuple[str, str]
+            The object key of the raw image and its PatientID, in the
+            order of the keys.
+        """
+        with self._lock:
+            rows = self._store.execute(
+                "SELECT key, patient_id FROM headers ORDER BY key"
+            ).fetchall()
+        yield from rows
+
+
+class SubmittingCentreLookup:
+    """Look up the submitting centres of the patients from their clinical
+    data files, remembering the centres found by pseudonym, and the results
+    by key between runs."""
+
+    PSEUDONYM_PATTERN = re.compile(
+        r"^.*/(?P<pseudonym>[^/]*)_(data|status)\.json$"
+    )
+
+    def __init__(
+        self,
+        s3client,
+        cache_size=100000,
+        store_path=None,
+        range_kb=SUBMITTING_CENTRE_RANGE_KB,
+    ):
+        """Look up the submitting centres of the patients.
+
+        Only the start of each file is read first, and the whole file only
+        if the SubmittingCentre field is not found there. The centres found
+        are remembered by the patient pseudonym in memory (the least recently
+        used ones are dropped beyond the cache size), and the results of each
+        file optionally by its key in a local SQLite database kept between
+        runs, so later runs only read the files added since. The lookups
+        are counted in `counters`: "hits" from memory, "store_hits" from the
+        database, and "misses" read from S3.
+
+        Parameters
+        ----------
+        s3client : S3Client
+            The service that handles S3 data access
+        cache_size : int, default=100000
+            The number of patients to remember in memory.
+        store_path : str, default=None
+            The SQLite database file to keep the centres of the files in
+            between runs.
+        range_kb : int, default=SUBMITTING_CENTRE_RANGE_KB
+            The kilobytes to read from the start of the files first, 0 reads
+            the whole files.
+        """
+        self.s3client = s3client
+        self.cache_size = cache_size
+        self.prefix_bytes = range_kb * KB if range_kb > 0 else None
+        self.counters = {"hits": 0, "store_hits": 0, "misses": 0}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = None
+        if store_path:
+            folder = os.path.dirname(store_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._store = sqlite3.connect(
+                store_path, isolation_level=None, check_same_thread=False
+            )
+            self._store.execute(
+                "CREATE TABLE IF NOT EXISTS key_centres "
+                + "(key TEXT PRIMARY KEY, centre TEXT)"
+            )
+
+    def _pseudonym(self, key):
+        key_match = self.PSEUDONYM_PATTERN.match(key)
+        return key_match.group("pseudonym") if key_match else key
+
+    def get_centre(self, key):
+        """The SubmittingCentre value of a clinical data file.
+
+        Parameters
+        ----------
+        key : str
+            The S3 object key of the JSON file.
+
+        Returns
+        -------
+        str or None
+            The value defined for the SubmittingCentre field in the file
+            (or in an earlier file of the same patient)
+        """
+        pseudonym = self._pseudonym(key)
+        with self._lock:
+            if pseudonym in self._memory:
+                self._memory.move_to_end(pseudonym)
+                self.counters["hits"] += 1
+                return self._memory[pseudonym]
+            if self._store is not None:
+                row = self._store.execute(
+                    "SELECT centre FROM key_centres WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self.counters["store_hits"] += 1
+                    self._remember(pseudonym, row[0])
+                    return row[0]
+            self.counters["misses"] += 1
+
+        centre = helpers.get_submitting_centre_from_key(
+            self.s3client, key, prefix_bytes=self.prefix_bytes
+        )
+        with self._lock:
+            self._remember(pseudonym, centre)
+            if self._store is not None:
+                # Also without a centre, so the file is not read again
+                self._store.execute(
+                    "INSERT OR REPLACE INTO key_centres VALUES (?, ?)",
+                    (key, centre),
+                )
+        return centre
+
+    def _remember(self, pseudonym, centre):
+        if centre is None:
+            # Not remembered for the patient, as their other files (e.g. the
+            # data file after a status file) may well define it
+            return
+        self._memory[pseudonym] = centre
+        self._memory.move_to_end(pseudonym)
+        if len(self._memory) > self.cache_size:
+            self._memory.popitem(last=False)
+
+
+class RunForecast:
+    """The work a dry run of the warehouse loader found to do, and the S3
+    requests, bytes, and time it would take."""
+
+    OPERATIONS = ("HEAD", "GET", "PUT", "COPY", "LIST")
+
+    def __init__(self, latency_ms=FORECAST_LATENCY_MS):
+        """The work a dry run of the warehouse loader found to do.
+
+        The copies and metadata uploads skipped by the dry run are counted
+        here, along with the requests estimated instead of made (when
+        forecasting from the inventory alone). The requests made by the
+        dry run itself are taken from the client in `report`, as the real
+        run makes the same ones.
+
+        Parameters
+        ----------
+        latency_ms : float, default=FORECAST_LATENCY_MS
+            The latency of the kinds of requests not made during the run,
+            in milliseconds.
+        """
+        self.latency_ms = latency_ms
+        self.counters = {
+            "copies": 0,
+            "copy_bytes": 0,
+            "metadata_files": 0,
+            "metadata_bytes": 0,
+            "read_bytes": 0,
+        }
+        self.requests = {operation: 0 for operation in self.OPERATIONS}
+        self._sizes = dict()
+        self._looked_up = set()
+        self._lock = threading.Lock()
+
+    def expect(self, key, size):
+        """Note the size of a raw file (from the inventory), for the bytes
+        of its copy.
+
+        Parameters
+        ----------
+        key : str
+            The key of the raw file.
+        size : int or None
+            Its size in bytes, None if not known.
+        """
+        if size:
+            with self._lock:
+                self._sizes[key] = size
+
+    def copy(self, key, size=None):
+        """Count a copy the run would make.
+
+        Parameters
+        ----------
+        key : str
+            The key of the object to copy.
+        size : int, default=None
+            Its size in bytes, the one noted with `expect` if not given.
+        """
+        with self._lock:
+            noted = self._sizes.pop(key, None)
+            size = noted if size is None else size
+            self.counters["copies"] += 1
+            self.counters["copy_bytes"] += size or 0
+            self.requests["COPY"] += 1
+
+    def upload(self, key, size):
+        """Count a metadata file the run would write.
+
+        Parameters
+        ----------
+        key : str
+            The key of the metadata file.
+        size : int
+            Its size in bytes.
+        """
+        with self._lock:
+            self.counters["metadata_files"] += 1
+            self.counters["metadata_bytes"] += size
+            self.requests["PUT"] += 1
+
+    def lookup(self, patient_id, transferred):
+        """Count the submitting centre lookup of a patient not yet in a
+        group, made once for each patient.
+
+        Parameters
+        ----------
+        patient_id : str
+            The pseudonym of the patient.
+        transferred : int
+            The bytes the lookup would download.
+        """
+        with self._lock:
+            if patient_id in self._looked_up:
+                return
+            self._looked_up.add(patient_id)
+        self.request("GET", transferred=transferred)
+
+    def request(self, operation, transferred=0):
+        """Count a request the run would make, that the dry run didn't.
+
+        Parameters
+        ----------
+        operation : str
+            The kind of the request (see `OPERATIONS`).
+        transferred : int, default=0
+            The bytes it would download.
+        """
+        with self._lock:
+            self.requests[operation] += 1
+            self.counters["read_bytes"] += transferred
+
+    def report(self, s3client=None, download_workers=1, forecast_file=None):
+        """Log the forecast of the run, and write it to a local file.
+
+        The runtime is estimated at the per-request latency measured by
+        the client (or `latency_ms` for the requests not made), for the
+        busiest kind of request, as the steps making them run at the same
+        time: the downloads spread over the header download workers, and
+        the existence checks, copies, and uploads one after the other.
+
+        Parameters
+        ----------
+        s3client : S3Client, default=None
+            The client of the dry run, with the requests it made.
+        download_workers : int, default=1
+            The number of downloads made at the same time.
+        forecast_file : str, default=None
+            A local file to write the forecast to, as JSON.
+
+        Returns
+        -------
+        dict
+            The objects to copy, metadata files to write, the bytes to
+            transfer, the requests of each kind, their latency, and the
+            estimated runtime in seconds.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            requests = dict(self.requests)
+        read_bytes = counters["read_bytes"]
+        latency = dict()
+        if s3client is not None:
+            read_bytes += s3client.counters["bytes"]
+            for operation, timing in s3client.operations.items():
+                requests[operation] = (
+                    requests.get(operation, 0) + timing["requests"]
+                )
+                latency[operation] = timing["seconds"] / timing["requests"]
+        latency = {
+            operation: latency.get(operation, self.latency_ms / 1000)
+            for operation in requests
+        }
+        seconds = max(
+            requests["GET"] * latency["GET"] / max(download_workers, 1),
+            requests["HEAD"] * latency["HEAD"],
+            requests["COPY"] * latency["COPY"],
+            requests["PUT"] * latency["PUT"],
+        )
+        forecast = {
+            "objects_to_copy": counters["copies"],
+            "metadata_files": counters["metadata_files"],
+            "bytes": {
+                "copy": counters["copy_bytes"],
+                "upload": counters["metadata_bytes"],
+                "download": read_bytes,
+            },
+            "requests": requests,
+            "latency_ms": {
+                operation: round(value * 1000, 3)
+                for operation, value in latency.items()
+            },
+            "estimated_seconds": round(seconds, 1),
+        }
+        logger.info(
+            f"Forecast: {forecast['objects_to_copy']} objects to copy "
+            f"({counters['copy_bytes']} bytes), "
+            f"{forecast['metadata_files']} metadata files to write "
+            f"({counters['metadata_bytes']} bytes), "
+            f"{read_bytes} bytes to download"
+        )
+        logger.info(
+            "Forecast requests: "
+            + ", ".join(
+                f"{operation} {count} ({latency[operation] * 1000:.1f} ms)"
+                for operation, count in requests.items()
+            )
+            + f", about {datetime.timedelta(seconds=round(seconds))}"
+        )
+        if forecast_file:
+            with open(f"{forecast_file}.tmp", "w") as f:
+                json.dump(forecast, f, indent=2)
+            os.replace(f"{forecast_file}.tmp", forecast_file)
+        return forecast
+
+
+class StageMetrics:
+    """Timings and counts of the steps of a pipeline run, recorded by
+    running the pipeline with `helpers.pipeline_strategy`."""
+
+    COUNTS = (
+        "setup_seconds",
+        "teardown_seconds",
+        "worker_cpu_seconds",
+        "items_in",
+        "items_out",
+        "errors",
+        "s3_requests",
+        "s3_retries",
+        "s3_throttles",
+        "s3_bytes",
+    )
+
+    def __init__(self, pipeline, buckets=STAGE_TIME_BUCKETS):
+        """Timings and counts of the steps of a pipeline run.
+
+        For each step (graph node) this keeps the number of calls, the
+        wall and CPU time they took (in total and as histograms), the
+        setup and teardown time, the CPU time of the work it handed to
+        other threads, the items in and out, the errors, and the S3
+        requests it made (see `S3Client.counters`).
+
+        Parameters
+        ----------
+        pipeline : str
+            The name of the pipeline.
+        buckets : tuple[float], default=STAGE_TIME_BUCKETS
+            The upper bounds of the call time histogram buckets, in
+            seconds.
+        """
+        self.pipeline = pipeline
+        self.buckets = buckets
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _stage(self, stage):
+        if stage not in self._stages:
+            self._stages[stage] = {
+                "calls": 0,
+                "wall_seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "wall_histogram": [0] * (len(self.buckets) + 1),
+                "cpu_histogram": [0] * (len(self.buckets) + 1),
+                **{name: 0 for name in self.COUNTS},
+            }
+        return self._stages[stage]
+
+    def record(self, stage, wall, cpu):
+        """Record a call of a step.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the step.
+        wall : float
+            The wall time the call took, in seconds.
+        cpu : float
+            The CPU time the call took, in seconds.
+        """
+        with self._lock:
+            metrics = self._stage(stage)
+            metrics["calls"] += 1
+            metrics["wall_seconds"] += wall
+            metrics["cpu_seconds"] += cpu
+            metrics["wall_histogram"][bisect_left(self.buckets, wall)] += 1
+            metrics["cpu_histogram"][bisect_left(self.buckets, cpu)] += 1
+
+    def count(self, stage, **increments):
+        """Add to the counts of a step (see `COUNTS`).
+
+        Parameters
+        ----------
+        stage : str
+            The name of the step.
+        **increments : dict[str, int or float]
+            The amounts to add to each count.
+        """
+        with self._lock:
+            metrics = self._stage(stage)
+            for name, value in increments.items():
+                metrics[name] += value
+
+    def summary(self):
+        """The summary of the run so far.
+
+        Returns
+        -------
+        dict
+            The pipeline name, start and end times, histogram buckets, and
+            the metrics of each step. The histograms list the number of
+            calls in each bucket (the last one is for longer calls).
+        """
+        finished = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            stages = {
+                stage: {
+                    name: list(value) if isinstance(value, list) else value
+                    for name, value in metrics.items()
+                }
+                for stage, metrics in self._stages.items()
+            }
+        return {
+            "pipeline": self.pipeline,
+            "started": self.started.isoformat(),
+            "finished": finished.isoformat(),
+            "duration_seconds": (finished - self.started).total_seconds(),
+            "buckets": list(self.buckets),
+            "stages": stages,
+        }
+
+    def prometheus(self, summary=None):
+        """The metrics of the run in the Prometheus text format.
+
+        Parameters
+        ----------
+        summary : dict, default=None
+            The summary to format, the current one if not given.
+
+        Returns
+        -------
+        str
+            The metrics, labelled with the pipeline and step names.
+        """
+        summary = summary or self.summary()
+        pipeline = summary["pipeline"]
+        lines = [
+            "# TYPE warehouse_run_duration_seconds gauge",
+            f'warehouse_run_duration_seconds{{pipeline="{pipeline}"}} '
+            f"{summary['duration_seconds']}",
+        ]
+        for kind in ["wall", "cpu"]:
+            name = f"warehouse_stage_{kind}_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for stage, metrics in summary["stages"].items():
+                labels = f'pipeline="{pipeline}",stage="{stage}"'
+                calls = 0
+                bounds = summary["buckets"] + ["+Inf"]
+                for bound, in_bucket in zip(
+                    bounds, metrics[f"{kind}_histogram"]
+                ):
+                    # The buckets are cumulative
+                    calls += in_bucket
+                    lines.append(
+                        f'{name}_bucket{{{labels},le="{bound}"}} {calls}'
+                    )
+                total = metrics[f"{kind}_seconds"]
+                lines.append(f"{name}_sum{{{labels}}} {total}")
+                lines.append(f"{name}_count{{{labels}}} {metrics['calls']}")
+        for count in self.COUNTS:
+            name = f"warehouse_stage_{count}"
+            if not count.endswith("_seconds"):
+                name += "_total"
+            lines.append(f"# TYPE {name} counter")
+            for stage, metrics in summary["stages"].items():
+                labels = f'pipeline="{pipeline}",stage="{stage}"'
+                lines.append(f"{name}{{{labels}}} {metrics[count]}")
+        return "\n".join(lines) + "\n"
+
+    def save(
+        self,
+        s3client=None,
+        summary_file=RUN_SUMMARY_FILE,
+        prometheus_file=METRICS_PROMETHEUS_FILE,
+    ):
+        """Save the summary of the run, and log the metrics of each step.
+
+        Parameters
+        ----------
+        s3client : S3Client, default=None
+            If given, the summary is saved in the bucket, under
+            `RUN_SUMMARY_PREFIX` as `PIPELINE/START_TIME.json`.
+        summary_file : str, default=RUN_SUMMARY_FILE
+            If given, the summary is written to this local file too.
+        prometheus_file : str, default=METRICS_PROMETHEUS_FILE
+            If given, the metrics are written to this local file, in the
+            Prometheus text format.
+
+        Returns
+        -------
+        dict
+            The summary of the run.
+        """
+        summary = self.summary()
+        for stage, metrics in summary["stages"].items():
+            logger.info(
+                f"Step {stage}: {metrics['calls']} calls, "
+                f"{metrics['wall_seconds']:.1f}s wall, "
+                f"{metrics['cpu_seconds']:.1f}s CPU, "
+                f"{metrics['s3_requests']} S3 requests"
+            )
+        content = json.dumps(summary)
+        if s3client is not None:
+            s3client.put_object(
+                f"{RUN_SUMMARY_PREFIX}{self.pipeline}/"
+                f"{self.started:%Y%m%dT%H%M%S}.json",
+                content,
+            )
+        for path, file_content in [
+            (summary_file, content),
+            (prometheus_file, self.prometheus(summary)),
+        ]:
+            if path:
+                # Replaced at once, for collectors not to read it half-written
+                with open(f"{path}.tmp", "w") as f:
+                    f.write(file_content)
+                os.replace(f"{path}.tmp", path)
+        return summary
+
+
+class SQSQueue:
+    """A queue of S3 event notifications in Amazon SQS."""
+
+    def __init__(self, url, region_name=None):
+        """A queue of S3 event notifications in Amazon SQS.
+
+        Parameters
+        ----------
+        url : str
+            The URL of the queue.
+        region_name : str, default=None
+            The region of the queue, taken from the URL if not given (and
+            from the AWS configuration if it's not in the URL either).
+        """
+        self.url = url
+        self._client = boto3.client(
+            "sqs", region_name=region_name or self.url_region(url)
+        )
+
+    @staticmethod
+    def url_region(url):
+        """The region of an SQS queue from its URL.
+
+        Parameters
+        ----------
+        url : str
+            The URL of the queue, e.g. "https://sqs.eu-west-2.amazonaws.com/
+            123456789012/notifications".
+
+        Returns
+        -------
+        str or None
+            The region, None if the URL doesn't show it.
+        """
+        host = urlparse(url).netloc.split(".")
+        if len(host) < 3 or host[-2:] != ["amazonaws", "com"]:
+            return None
+        if host[0] == "sqs":
+            return host[1]
+        if host[:2] == ["queue", "amazonaws"]:
+            # The legacy endpoint of us-east-1
+            return "us-east-1"
+        if host[1] == "queue":
+            return host[0]
+        return None
+
+    def send(self, body):
+        """Add a message to the queue.
+
+        Parameters
+        ----------
+        body : str
+            The message body.
+        """
+        self._client.send_message(QueueUrl=self.url, MessageBody=body)
+
+    def receive(self, max_messages=10, wait_seconds=0):
+        """Receive messages from the queue, which are hidden from further
+        receives until the visibility timeout of the queue, unless deleted.
+
+        Parameters
+        ----------
+        max_messages : int, default=10
+            The most messages to receive (at most 10 for SQS).
+        wait_seconds : int, default=0
+            How long to wait for messages if there are none.
+
+        Returns
+        -------
+        list[tuple[str, str]]
+            The (receipt handle, body) of the messages.
+        """
+        response = self._client.receive_message(
+            QueueUrl=self.url,
+            MaxNumberOfMessages=min(max_messages, 10),
+            WaitTimeSeconds=wait_seconds,
+        )
+        return [
+            (message["ReceiptHandle"], message["Body"])
+            for message in response.get("Messages", [])
+        ]
+
+    def delete(self, handle):
+        """Remove a received message from the queue.
+
+        Parameters
+        ----------
+        handle : str
+            The receipt handle of the message.
+        """
+        self._client.delete_message(QueueUrl=self.url, ReceiptHandle=handle)
+
+
+class SQLiteQueue:
+    """A local stand-in of an SQS queue, kept in an SQLite database."""
+
+    def __init__(self, path, visibility_timeout=30):
+        """A local stand-in of an SQS queue.
+
+        Parameters
+        ----------
+        path : str
+            The SQLite database file of the queue.
+        visibility_timeout : float, default=30
+            How long received messages are hidden from further receives
+            (in seconds), unless deleted.
+        """
+        self.visibility_timeout = visibility_timeout
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, "
+            + "body TEXT NOT NULL, visible_at REAL NOT NULL)"
+        )
+
+    def send(self, body):
+        """Add a message to the queue.
+
+        Parameters
+        ----------
+        body : str
+            The message body.
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO messages (body, visible_at) VALUES (?, ?)",
+                (body, time.time()),
+            )
+
+    def receive(self, max_messages=10, wait_seconds=0):
+        """Receive messages from the queue, which are hidden from further
+        receives for the visibility timeout, unless deleted.
+
+        Parameters
+        ----------
+        max_messages : int, default=10
+            The most messages to receive.
+        wait_seconds : int, default=0
+            How long to wait for messages if there are none.
+
+        Returns
+        -------
+        list[tuple[int, str]]
+            The (message ID, body) of the messages.
+        """
+        deadline = time.time() + wait_seconds
+        while True:
+            with self._lock:
+                now = time.time()
+                messages = self._db.execute(
+                    "SELECT id, body FROM messages WHERE visible_at <= ? "
+                    + "ORDER BY id LIMIT ?",
+                    (now, max_messages),
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE messages SET visible_at = ? WHERE id = ?",
+                    [
+                        (now + self.visibility_timeout, message_id)
+                        for message_id, _ in messages
+                    ],
+                )
+            if messages or time.time() >= deadline:
+                return messages
+            time.sleep(min(1, deadline - time.time()))
+
+    def delete(self, handle):
+        """Remove a received message from the queue.
+
+        Parameters
+        ----------
+        handle : int
+            The ID of the message.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM messages WHERE id = ?", (handle,))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM messages"
+            ).fetchone()[0]
+
+
+def get_queue(url):
+    """The notification queue at a given location.
+
+    Parameters
+    ----------
+    url : str
+        An SQS queue URL (https://...), or the path of a local SQLite queue
+        (optionally as sqlite:///path).
+
+    Returns
+    -------
+    SQSQueue or SQLiteQueue
+        The queue.
+    """
+    if url.startswith("https://"):
+        return SQSQueue(url)
+    if url.startswith("sqlite:///"):
+        url = url[len("sqlite:///") :]
+    return SQLiteQueue(url)
+
+
+def pending_raw_images(raw_images, processed_filenames, raw_prefixes):
+    """Stream the raw images that are not yet processed, ie. either the
+    image copy or its metadata file is missing from the processed side.
+
+    This is a single set difference, with one lookup of the image and of
+    its metadata filename for each raw image, so linear in the number of
+    raw images, however the inventory is fragmented.
+
+    Parameters
+    ----------
+    raw_images : iterable of tuple[str, str, int or None]
+        The (raw prefix, key, size) of each raw image.
+    processed_filenames : set[str] or HashedKeySet
+        The filenames of the processed images and metadata files.
+    raw_prefixes : set
+        The raw prefixes to consider for processing.
+
+    Yields
+    ------
+    tuple[str, int or None]
+        The key and size of each pending raw image.
+    """
+    for raw_prefix, key, size in raw_images:
+        if raw_prefix not in raw_prefixes:
+            continue
+        filename = key.rsplit("/", 1)[-1]
+        if (
+            filename not in processed_filenames
+            or filename.replace(".dcm", ".json") not in processed_filenames
+        ):
+            yield key, size
+
+
+def _resolve_missing(watermarks, kind, pending, raw_prefixes):
+    """Note the raw files to retry of a kind ("data" or "images") that are
+    not pending anymore (processed or removed since) as resolved."""
+    for key in list(watermarks.retries):
+        key_match = InventoryIndex.RAW_PATTERN.match(key)
+        if (
+            key not in pending
+            and key_match is not None
+            and key_match.group("kind") == kind
+            and key_match.group("raw_prefix") in raw_prefixes
+        ):
+            watermarks.resolve(key)
+
+
+class FileList:
+    def __init__(self, downloader, manifests=None):
+        self.downloader = downloader
+        self.manifests = manifests
+        self.bucket = downloader.get_bucket()
+
+    def get_raw_data_list(self, raw_prefixes=set(), watermarks=None):
+        """Get the list of raw data files from the inventory
+
+        Parameters
+        ----------
+        raw_prefixes : set, default=set()
+            The raw prefixes to consider for processing in the warehouse.
+        watermarks : RawWatermarks, default=None
+            If given, only the date folders at or after the watermarks
+            are listed, and the files to retry from earlier runs (those
+            not in the inventory anymore are noted as resolved).
+
+        Yields
+        ------
+        str
+            The keys for the raw data files found
+        """
+        listed = set()
+        for raw_prefix, key in self.downloader.get_index().raw_data:
+            if raw_prefix not in raw_prefixes:
+                continue
+            taken = watermarks is None or watermarks.include(raw_prefix, key)
+            if watermarks is not None and key in watermarks.retries:
+                listed.add(key)
+                taken = True
+            if taken:
+                yield key
+        if watermarks is not None:
+            _resolve_missing(watermarks, "data", listed, raw_prefixes)
+
+    def get_pending_raw_images_list(
+        self, raw_prefixes=set(), with_size=False, watermarks=None
+    ):
+        """Get the list of raw data files from the inventory
+
+        Parameters
+        ----------
+        raw_prefixes : set, default=set()
+            The raw prefixes to consider for processing in the warehouse.
+        with_size : bool, default=False
+            Whether to pass on the object sizes listed in the inventory too.
+        watermarks : RawWatermarks, default=None
+            If given, only the date folders at or after the watermarks
+            are listed.
+
+        Yields
+        ------
+        str or tuple[str, int or None]
+            The keys for raw image files that seem not yet to be processed,
+            or (key, size) pairs if sizes are requested (size is None if
+            the inventory doesn't list it).
+        """
+        index = self.downloader.get_index()
+        raw_images = index.raw_images
+        if watermarks is not None:
+            raw_images = (
+                raw_image
+                for raw_image in raw_images
+                if raw_image[0] in raw_prefixes
+                and watermarks.include(raw_image[0], raw_image[1])
+            )
+        for key, size in pending_raw_images(
+            raw_images, self._processed_filenames(index), raw_prefixes
+        ):
+            yield (key, size) if with_size else key
+
+    def get_retry_raw_images_list(self, raw_prefixes=set(), watermarks=None):
+        """Get the raw images left unresolved in earlier runs, that are still
+        pending and outside the date folders taken in this run (those inside
+        are listed with the pending images already).
+
+        The images to retry that are not pending anymore (processed or
+        removed since) are noted as resolved in the watermarks.
+
+        Parameters
+        ----------
+        raw_prefixes : set, default=set()
+            The raw prefixes to consider for processing in the warehouse.
+        watermarks : RawWatermarks, default=None
+            The watermarks with the images to retry (none if not given).
+
+        Yields
+        ------
+        tuple[str, int or None]
+            The key and size of each raw image to retry (size is None if
+            the inventory doesn't list it).
+        """
+        if watermarks is None or not watermarks.retries:
+            return
+        index = self.downloader.get_index()
+        retries = [
+            raw_image
+            for raw_image in index.raw_images
+            if raw_image[1] in watermarks.retries
+        ]
+        raw_prefix_of = {key: raw_prefix for raw_prefix, key, _ in retries}
+        pending = set()
+        for key, size in pending_raw_images(
+            retries, self._processed_filenames(index), raw_prefixes
+        ):
+            pending.add(key)
+            if not watermarks.include(raw_prefix_of[key], key):
+                yield key, size
+        _resolve_missing(watermarks, "images", pending, raw_prefixes)
+
+    def _processed_filenames(self, index):
+        processed_filenames = index.processed_filenames
+        if self.manifests is not None and len(self.manifests.filenames):
+            # Images with their metadata in per-series files
+            processed_filenames = processed_filenames.union(
+                self.manifests.filenames
+            )
+        return processed_filenames
+
+    def get_processed_data_list(self):
+        """Getting the list of processed data files from the warehouse
+
+        Yields
+        ------
+        str
+            The keys to the processed data files to look at.
+        """
+        yield from self.downloader.get_index().iter_processed("data")
+
+    def get_processed_images_list(self):
+        """Getting the list of processed non-data files (ie. images and
         metadata) from the warehouse.
 
         Yields
@@ -433,12 +3852,4 @@ class FileList:
         str
             The keys to the processed data files to look at.
         """
-        pattern = re.compile(
-            r"^(training|validation)/(?!data)[^/]*/.*/(?P<filename>[^/]*)$"
-        )
-        for _, fragment_reader in self.downloader.get_inventory():
-            for row in fragment_reader:
-                key = row[1]
-                key_match = pattern.match(key)
-                if key_match:
-                    yield key
+        yield from self.downloader.get_index().iter_processed("images")
@@ -2,6 +2,7 @@
 it available for further analysis and display.
 """
 
+import gzip
 import json
 import logging
 import os
@@ -23,6 +24,7 @@ from bonobo.util.objects import ValueHolder
 from botocore.exceptions import ClientError
 from nccid_cleaning import clean_data_df, patient_df_pipeline
 
+import warehouse.components.helpers as helpers
 import warehouse.components.services as services
 
 mondrian.setup(excepthook=True)
@@ -157,7 +159,8 @@ def load_clinical_files(*args, s3client):
 @use("filelist")
 def list_image_metadata_files(filelist):
     """Listing of processed image metadata files in the warehouse.
-    Only lists a single file per imaging study.
+    Only lists a single file per imaging study, either a per-image
+    metadata file or a per-series one.
 
     Parameters
     ----------
@@ -171,7 +174,7 @@ def list_image_metadata_files(filelist):
     """
     studies = set()
     pattern = re.compile(
-        r"^(?P<group>training|validation)/(?P<modality>[^-/]*)-metadata/(?P<pseudonym>[^/]+)/(?P<studyid>[^/]+)/(?P<seriesid>[^/]+)/(?P<filename>[^/]+\.json)$"
+        r"^(?P<group>training|validation)/(?P<modality>[^-/]*)-metadata/(?P<pseudonym>[^/]+)/(?P<studyid>[^/]+)/(?P<seriesid>[^/]+)/(?P<filename>[^/]+\.(json|ndjson\.gz))$"
     )
     for processed_file in filelist.get_processed_images_list():
         match = pattern.match(processed_file)
@@ -212,7 +215,11 @@ def load_image_metadata_files(*args, s3client):
         return
 
     last_modified = result["LastModified"].date()
-    text = result["Body"].read().decode("utf-8")
+    content = result["Body"].read()
+    if image_file.endswith(".ndjson.gz"):
+        # Per-series file, with the metadata of an image on each line
+        content = gzip.decompress(content).split(b"\n", 1)[0]
+    text = content.decode("utf-8")
     data = json.loads(
         text,
         object_hook=lambda d: {
@@ -258,15 +265,8 @@ def get_storage_stats(inventory):
         "validation/mri/",
         "validation/",
     ]
-    prefix_sums = {key: 0 for key in prefixes}
-
-    for _, fragment_reader in inventory.get_inventory():
-        for row in fragment_reader:
-            key = row[1]
-            for prefix in prefixes:
-                if key.startswith(prefix):
-                    size = int(row[2])
-                    prefix_sums[prefix] += size
+    storage_sizes = inventory.get_index().storage_sizes
+    prefix_sums = {key: storage_sizes.get(key, 0) for key in prefixes}
 
     yield "stats", prefix_sums
 
@@ -516,7 +516,10 @@ def get_services(**options):
 
     s3client = services.S3Client(bucket=BUCKET_NAME)
     s3client_processed = services.S3Client(bucket=f"{BUCKET_NAME}-processed")
-    inv_downloader = services.InventoryDownloader(main_bucket=BUCKET_NAME)
+    inv_downloader = services.InventoryDownloader(
+        main_bucket=BUCKET_NAME,
+        index_lists=("processed_data", "processed_images"),
+    )
     filelist = services.FileList(inv_downloader)
 
     return {
@@ -530,8 +533,15 @@ def get_services(**options):
 def main():
     """Execute the pipeline graph"""
     parser = bonobo.get_argument_parser()
+    metrics = services.StageMetrics("dataprocess")
     with bonobo.parse_args(parser) as options:
-        bonobo.run(get_graph(**options), services=get_services(**options))
+        pipeline_services = get_services(**options)
+        bonobo.run(
+            get_graph(**options),
+            services=pipeline_services,
+            strategy=helpers.pipeline_strategy(metrics=metrics),
+        )
+    metrics.save(None if LOCAL_ONLY else pipeline_services["s3client"])
 
 
 # The __main__ block actually execute the graph.
@@ -0,0 +1,291 @@
+""" This module processes the new raw uploads as they arrive, from the
+S3 event notifications of the bucket, instead of waiting for the next
+inventory and batch run of the warehouse loader.
+
+The notifications are read from a queue (SQS, or a local SQLite stand-in),
+and each new clinical data or image file goes through the same steps as
+in the warehouse loader pipeline. The batch pipeline is still to be run
+regularly, to pick up anything missed here.
+"""
+
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+from urllib.parse import unquote_plus
+
+import bonobo
+import mondrian
+
+import warehouse.warehouseloader as wl  # noqa: E402
+from warehouse.components import services
+
+mondrian.setup(excepthook=True)
+logger = logging.getLogger()
+
+BUCKET_NAME = os.getenv("WAREHOUSE_BUCKET", default=None)
+# The queue of the bucket's event notifications: an SQS queue URL, or the
+# path of a local SQLite queue
+QUEUE_URL = os.getenv("WAREHOUSE_QUEUE", default=None)
+# How long to wait for new notifications in a single request (in seconds)
+QUEUE_WAIT_SECONDS = int(os.getenv("QUEUE_WAIT_SECONDS", default=20))
+
+
+def created_objects(body):
+    """The objects created according to an S3 event notification.
+
+    Parameters
+    ----------
+    body : str
+        The notification message body.
+
+    Yields
+    ------
+    tuple[str, str, int or None]
+        The bucket, key, and size of each created object.
+    """
+    try:
+        records = json.loads(body).get("Records", [])
+    except (AttributeError, json.decoder.JSONDecodeError):
+        logger.warning(f"Not an S3 event notification: {body}")
+        return
+    for record in records:
+        if not record.get("eventName", "").startswith("ObjectCreated:"):
+            continue
+        try:
+            s3 = record["s3"]
+            yield (
+                s3["bucket"]["name"],
+                unquote_plus(s3["object"]["key"]),
+                s3["object"].get("size"),
+            )
+        except (KeyError, TypeError):
+            logger.warning(f"Invalid S3 event record: {record}")
+
+
+def _image_header(key, size, pipeline_services):
+    """The header record of a new image, as kept in the header cache if it
+    was deferred earlier, otherwise downloaded.
+
+    Parameters
+    ----------
+    key : str
+        The key of the new image.
+    size : int or None
+        The size of the new image, if known.
+    pipeline_services : dict
+        The services of the warehouse loader pipeline.
+
+    Returns
+    -------
+    warehouseloader.ImageHeader or None
+        The header record, None if the image is not a DICOM file.
+    """
+    headercache = pipeline_services.get("headercache")
+    record = headercache.get(key) if headercache is not None else None
+    if record is not None:
+        return wl.ImageHeader(**record)
+    headerstats = pipeline_services["headerstats"]
+    partial = wl.PartialDicom(
+        pipeline_services["s3client"],
+        key,
+        initial_range_kb=headerstats.initial_range_kb(key),
+        size=size,
+    )
+    header = partial.download_header()
+    if header is None:
+        logger.warning(
+            f"Object '{key}' couldn't be loaded as a DICOM file, skipping!"
+        )
+        return None
+    headerstats.record(key, partial.header_length)
+    return header
+
+
+def process_object(key, size, pipeline_services):
+    """Run the warehouse loader steps on a single new object.
+
+    Parameters
+    ----------
+    key : str
+        The key of the new object.
+    size : int or None
+        The size of the new object, if known.
+    pipeline_services : dict
+        The services of the warehouse loader pipeline.
+
+    Returns
+    -------
+    bool
+        False if the object should be tried again later (an image whose
+        patient's clinical data is not processed yet), True otherwise.
+    """
+    config = pipeline_services["config"]
+    s3client = pipeline_services["s3client"]
+    patientcache = pipeline_services["patientcache"]
+    key_match = services.InventoryIndex.RAW_PATTERN.match(key)
+    raw_prefixes = {prefix.rstrip("/") for prefix in config.get_raw_prefixes()}
+    if key_match is None or key_match.group("raw_prefix") not in raw_prefixes:
+        logger.debug(f"Not a raw file to process: {key}")
+        return True
+
+    suffix = Path(key).suffix.lower()
+    if suffix == ".json":
+        results = wl.process_patient_data(
+            "process",
+            key,
+            None,
+            config=config,
+            patientcache=patientcache,
+            existenceindex=pipeline_services["existenceindex"],
+            centrelookup=pipeline_services["centrelookup"],
+        )
+    elif suffix == ".dcm":
+        headercache = pipeline_services.get("headercache")
+        header = _image_header(key, size, pipeline_services)
+        if header is None:
+            return True
+        if patientcache.get_group(header.patient_id) is None:
+            logger.info(f"Patient of {key} not known yet, deferring.")
+            if headercache is not None:
+                headercache.defer(key, header)
+            return False
+        results = wl.process_image(
+            "process",
+            key,
+            header,
+            s3client=s3client,
+            patientcache=patientcache,
+            existenceindex=pipeline_services["existenceindex"],
+            headercache=headercache,
+        )
+    else:
+        return True
+
+    outputs = [
+        result for result in results if result != bonobo.constants.NOT_MODIFIED
+    ]
+    for position, result in enumerate(outputs):
+        try:
+            _write(result, s3client)
+        except Exception:  # noqa: E722
+            # Not written, so forget them in the existence index for them
+            # to be written when the notification is received again
+            for output in outputs[position:]:
+                pipeline_services["existenceindex"].discard(
+                    _output_key(output)
+                )
+            raise
+    return True
+
+
+def _output_key(result):
+    """The object to be written by a copy or metadata task."""
+    return result[2] if result[0] == "copy" else result[1]
+
+
+def _write(result, s3client):
+    """Do the copy or upload of a processed object.
+
+    Parameters
+    ----------
+    result : tuple
+        The "copy" or "metadata" task, as passed on by the processing
+        steps.
+    s3client : S3Client
+        The service that handles S3 data access
+    """
+    if result[0] == "copy":
+        wl.data_copy(*result, s3client=s3client)
+    elif result[0] == "metadata":
+        for upload in wl.process_dicom_data(*result):
+            wl.upload_text_data(*upload, s3client=s3client)
+
+
+def consume(queue, pipeline_services, rounds=None, wait_seconds=0):
+    """Process the objects of the notifications in a queue.
+
+    Messages are removed from the queue once their objects are processed,
+    those that need to be tried again (or failed) are left to reappear
+    after the visibility timeout of the queue.
+
+    Parameters
+    ----------
+    queue : SQSQueue or SQLiteQueue
+        The queue of the S3 event notifications.
+    pipeline_services : dict
+        The services of the warehouse loader pipeline.
+    rounds : int, default=None
+        The number of times to receive messages from the queue, None to
+        keep going.
+    wait_seconds : int, default=0
+        How long to wait for new messages in each round.
+
+    Returns
+    -------
+    int
+        The number of messages processed.
+    """
+    bucket = pipeline_services["s3client"].bucket
+    processed = 0
+    while rounds is None or rounds > 0:
+        if rounds is not None:
+            rounds -= 1
+        for handle, body in queue.receive(wait_seconds=wait_seconds):
+            done = True
+            for object_bucket, key, size in created_objects(body):
+                if object_bucket != bucket:
+                    logger.warning(f"Object from another bucket: {key}")
+                    continue
+                try:
+                    done = (
+                        process_object(key, size, pipeline_services) and done
+                    )
+                except Exception as e:  # noqa: E722
+                    logger.error(f"Couldn't process {key}: {e}")
+                    done = False
+            if done:
+                queue.delete(handle)
+                processed += 1
+    return processed
+
+
+def main():
+    """Process the notifications of the queue until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--queue",
+        default=QUEUE_URL,
+        help="SQS queue URL, or local SQLite queue path",
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=None,
+        help="Number of times to read the queue (default: keep going)",
+    )
+    args = parser.parse_args()
+    if BUCKET_NAME is None or args.queue is None:
+        logger.error("Set WAREHOUSE_BUCKET and WAREHOUSE_QUEUE to run.")
+        return
+
+    pipeline_services = wl.get_services()
+    loaded = list(
+        wl.load_config(
+            pipeline_services["s3client"], pipeline_services["config"]
+        )
+    )
+    if not loaded:
+        # No configuration, nothing to load
+        return
+    consume(
+        services.get_queue(args.queue),
+        pipeline_services,
+        rounds=args.rounds,
+        wait_seconds=QUEUE_WAIT_SECONDS,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@ the uploaded raw dataset.
 import logging
 import os
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import bonobo
@@ -12,19 +14,23 @@ import mondrian
 from bonobo.config import (
     Configurable,
     ContextProcessor,
+    Option,
     Service,
     use,
     use_raw_input,
 )
 from bonobo.util.objects import ValueHolder
 
-import warehouse.components.helpers as helpers
 import warehouse.warehouseloader as wl  # noqa: E402
+from warehouse.components import helpers
 from warehouse.components.services import (
+    SUBMITTING_CENTRE_STORE,
     FileList,
     InventoryDownloader,
     PipelineConfig,
     S3Client,
+    StageMetrics,
+    SubmittingCentreLookup,
 )
 
 mondrian.setup(excepthook=True)
@@ -32,6 +38,12 @@ logger = logging.getLogger()
 
 BUCKET_NAME = os.getenv("WAREHOUSE_BUCKET", default=None)
 NO_OUTPUT_FILE = bool(os.getenv("NO_OUTPUT_FILE", default=False))
+# Don't write anything to the bucket (the run summary is only kept locally)
+LOCAL_ONLY = bool(os.getenv("LOCAL_ONLY", default=False))
+# Number of clinical data files to look up concurrently
+SUBMITTING_CENTRE_WORKERS = int(
+    os.getenv("SUBMITTING_CENTRE_WORKERS", default=8)
+)
 
 
 @use("config")
@@ -65,28 +77,67 @@ def extract_raw_data_files(config, filelist):
 
 
 class SubmittingCentreExtractor(Configurable):
-    """Get unique submitting centre names from the full database."""
+    """Get unique submitting centre names from the full database.
+
+    The clinical data files are looked up concurrently, keeping a bounded
+    number of lookups in flight.
+    """
 
-    s3client = Service("s3client")
+    workers = Option(int, default=SUBMITTING_CENTRE_WORKERS)
+    centrelookup = Service("centrelookup")
 
     @ContextProcessor
     def acc(self, context, **kwargs):
-        centres = yield ValueHolder(set())
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            centres = ValueHolder(set())
+            yield centres, executor, pending
+            # The input is exhausted, collect the lookups still in flight
+            self._drain(centres, pending, 0)
         for centre in sorted(centres.get()):
             print(centre)
         if not NO_OUTPUT_FILE:
             with open("/tmp/message.txt", "w") as f:
                 for centre in sorted(centres.get()):
                     print(centre, file=f)
+        logger.info(
+            f"SubmittingCentre lookups: {kwargs['centrelookup'].counters}"
+        )
+
+    def _drain(self, centres, pending, limit):
+        """Collect finished lookups from the front of the queue.
+
+        Parameters
+        ----------
+        centres : ValueHolder(set())
+            Accumulator for the centre names
+        pending : collections.deque
+            The queue of (key, lookup future) pairs in submission order
+        limit : int
+            Wait for the oldest lookups until no more than this many are pending
+        """
+        while pending and (len(pending) > limit or pending[0][1].done()):
+            key, future = pending.popleft()
+            try:
+                centre = future.result()
+            except Exception as e:  # noqa: E722
+                logger.error(f"Couldn't look up the centre of {key}: {e}")
+                continue
+            if centre is not None:
+                centres.add(centre)
 
     @use_raw_input
-    def __call__(self, centres, *args, **kwargs):
+    def __call__(self, centres, executor, pending, *args, **kwargs):
         """The accumulator fuction run by the pipeline.
 
         Parameters
         ----------
         centres : ValueHolder(set())
             Accumulator for the centre names
+        executor : concurrent.futures.ThreadPoolExecutor
+            The pool running the lookups
+        pending : collections.deque
+            The queue of lookups in flight
         task, obj, _ = tuple[str, boto3.resource('s3').ObjectSummary, None]
             A task name ("process" is what accepted here) and a clinical data file
             object to extract the submitting centre from.
@@ -94,11 +145,11 @@ class SubmittingCentreExtractor(Configurable):
             Keyword arguments.
         """
         task, key, _ = args
-        s3client = kwargs["s3client"]
+        centrelookup = kwargs["centrelookup"]
         if task == "process" and Path(key).suffix.lower() == ".json":
-            centre = helpers.get_submitting_centre_from_key(s3client, key)
-            if centre is not None:
-                centres.add(centre)
+            get_centre = helpers.in_current_stage(centrelookup.get_centre)
+            pending.append((key, executor.submit(get_centre, key)))
+            self._drain(centres, pending, self.workers)
 
 
 ###
@@ -123,7 +174,9 @@ def get_graph(**options):
     graph.add_chain(
         wl.load_config,
         extract_raw_data_files,
-        SubmittingCentreExtractor(),
+        SubmittingCentreExtractor(
+            workers=options.get("workers", SUBMITTING_CENTRE_WORKERS)
+        ),
     )
 
     return graph
@@ -147,25 +200,46 @@ def get_services(**options):
             "config": None,
             "filelist": None,
             "s3client": None,
+            "centrelookup": None,
         }
 
     config = PipelineConfig()
-    inv_downloader = InventoryDownloader(main_bucket=BUCKET_NAME)
+    inv_downloader = InventoryDownloader(
+        main_bucket=BUCKET_NAME, index_lists=("raw_data",)
+    )
     filelist = FileList(inv_downloader)
     s3client = S3Client(bucket=BUCKET_NAME)
+    centrelookup = SubmittingCentreLookup(
+        s3client, store_path=SUBMITTING_CENTRE_STORE
+    )
 
     return {
         "config": config,
         "filelist": filelist,
         "s3client": s3client,
+        "centrelookup": centrelookup,
     }
 
 
 def main():
     """Execute the pipeline graph"""
     parser = bonobo.get_argument_parser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=SUBMITTING_CENTRE_WORKERS,
+        help="Number of clinical data files to look up concurrently",
+    )
+    metrics = StageMetrics("submittingcentres")
     with bonobo.parse_args(parser) as options:
-        bonobo.run(get_graph(**options), services=get_services(**options))
+        pipeline_services = get_services(**options)
+        bonobo.run(
+            get_graph(**options),
+            services=pipeline_services,
+            strategy=helpers.pipeline_strategy(metrics=metrics),
+        )
+    local_only = wl.DRY_RUN or LOCAL_ONLY
+    metrics.save(None if local_only else pipeline_services["s3client"])
 
 
 # The __main__ block actually execute the graph.
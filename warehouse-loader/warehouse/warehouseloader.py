@@ -1,20 +1,25 @@
 """The main warehose pipeline definition.
 """
 
-import hashlib
+import datetime
 import json
 import logging
+import math
 import os
 import re
 import struct
-from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import SEEK_END, BytesIO
+from itertools import repeat
 from pathlib import Path, posixpath
 
 import bonobo
 import mondrian
 import pydicom
-from bonobo.config import use
+from bonobo.config import Configurable, ContextProcessor, Option, Service, use
 from botocore.exceptions import ClientError
+from pydicom import jsonrep
 
 from warehouse.components import constants, helpers, services
 
@@ -27,8 +32,34 @@ BUCKET_NAME = os.getenv("WAREHOUSE_BUCKET", default=None)
 DRY_RUN = bool(os.getenv("DRY_RUN", default=False))
 if DRY_RUN:
     logger.info("This is a **dry run** with no file intended to be changed.")
+# Whether to take all raw date folders, not only those since the watermarks
+FULL_RUN = bool(os.getenv("FULL_RUN", default=False))
+# The part of the patients to process, as "index/count" (all if not set)
+SHARD = os.getenv("WAREHOUSE_SHARD", default=None)
+# Whether to only forecast the run from the inventory, without any requests
+# for the raw files themselves (a dry run)
+FORECAST_ONLY = bool(os.getenv("FORECAST_ONLY", default=False))
+# Minutes after which to stop taking new files (0 for no limit)
+RUN_BUDGET_MINUTES = float(os.getenv("RUN_BUDGET_MINUTES", default=0))
+# How to write the image metadata: "image" for a JSON file per image, or
+# "series" for a gzipped NDJSON file per series
+METADATA_LAYOUT = os.getenv("METADATA_LAYOUT", default="image")
 
 KB = 1024
+# The number of image header downloads to keep in flight at the same time
+HEADER_FETCH_WORKERS = int(os.getenv("HEADER_FETCH_WORKERS", default=8))
+# Images up to this size (when known) are downloaded in a single request
+SMALL_FILE_KB = int(os.getenv("SMALL_FILE_KB", default=64))
+# The number of items that can wait at the input of each pipeline step
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", default=128))
+# The clinical data files, with the date and patient in their keys
+CLINICAL_DATA_PATTERN = re.compile(
+    r"^.+/(?P<date>\d{4}-\d{2}-\d{2})/data/(?P<patient_id>.*)_(?P<outcome>data|status).json$"
+)
+# Value representations of the elements that hold binary data
+BINARY_VRS = frozenset(jsonrep.BINARY_VR_VALUES)
+# The Value of Interest (VOI) LUT Sequence tag
+VOI_LUT_SEQUENCE = 0x00283010
 
 ###
 # Helpers
@@ -54,16 +85,7 @@ def patient_in_training_set(
     boolean
         True if the patient ID should fall into the training set
     """
-    return (
-        int(
-            hashlib.sha512(
-                patient_id.strip().upper().encode("utf-8")
-            ).hexdigest(),
-            16,
-        )
-        % 100
-        < training_percent
-    )
+    return helpers.patient_hash(patient_id) % 100 < training_percent
 
 
 def inplace_nullify(d, key):
@@ -95,11 +117,16 @@ def inplace_nullify(d, key):
 def scrub_dicom(fd):
     """Remove binary data and other unusuaed sections from a DICOM image.
 
-    Extracted from https://bitbucket.org/scicomcore/dcm2slimjson/src/master/dcm2slimjson/main.py
+    The image data is converted to the DICOM JSON model as
+    `fd.to_json_dict()` would, in a single pass, leaving out the values of
+    the binary elements (their "InlineBinary" is null) and the VOI LUT
+    sequences (null) as it goes, so no binary data is ever encoded.
+
+    Based on https://bitbucket.org/scicomcore/dcm2slimjson/src/master/dcm2slimjson/main.py
 
     Parameters
     ----------
-    fd : pydicom.FileDataset
+    fd : pydicom.Dataset
         Image data to scrub
 
     Returns
@@ -107,17 +134,100 @@ def scrub_dicom(fd):
     dict
         Scrubbed image data as dictionary
     """
+    out = dict()
+    for tag in fd.keys():
+        json_key = f"{tag:08X}"
+        if tag == VOI_LUT_SEQUENCE:
+            # Remove Value of Interest (VOI) transform data
+            out[json_key] = None
+            continue
+        element = fd[tag]
+        if element.VR in BINARY_VRS:
+            # Drop binary data
+            out[json_key] = {"vr": element.VR}
+            if not element.is_empty:
+                out[json_key]["InlineBinary"] = None
+        elif element.VR == "SQ":
+            out[json_key] = {
+                "vr": element.VR,
+                "Value": [scrub_dicom(item) for item in element.value],
+            }
+        else:
+            out[json_key] = element.to_json_dict(None, 0)
+    return out
 
-    # Use a large value to bypass binary data handler
-    out = fd.to_json_dict(bulk_data_threshold=1e20)
 
-    # Drop binary data
-    inplace_nullify(out, "InlineBinary")
+class ImageHeader:
+    """The parts of an image's DICOM header that the pipeline uses, kept
+    instead of the whole parsed dataset once it's read.
+    """
 
-    # Remove Value of Interest (VOI) transform data
-    inplace_nullify(out, "00283010")
+    __slots__ = (
+        "patient_id",
+        "study_id",
+        "series_id",
+        "modality",
+        "metadata",
+        "header_length",
+    )
 
-    return out
+    def __init__(
+        self,
+        patient_id,
+        study_id,
+        series_id,
+        modality,
+        metadata,
+        header_length=None,
+    ):
+        """The parts of an image's DICOM header that the pipeline uses.
+
+        Parameters
+        ----------
+        patient_id : str
+            The PatientID of the image.
+        study_id : str
+            The StudyInstanceUID of the image.
+        series_id : str
+            The SeriesInstanceUID of the image.
+        modality : str
+            The Modality of the image.
+        metadata : bytes
+            The scrubbed image metadata, as JSON.
+        header_length : int, default=None
+            The position of the pixel data in the file, if known.
+        """
+        self.patient_id = patient_id
+        self.study_id = study_id
+        self.series_id = series_id
+        self.modality = modality
+        self.metadata = metadata
+        self.header_length = header_length
+
+    @classmethod
+    def from_dataset(cls, image_data, header_length=None):
+        """Take the header record of parsed image data.
+
+        Parameters
+        ----------
+        image_data : pydicom.Dataset
+            The image data to take the record of.
+        header_length : int, default=None
+            The position of the pixel data in the file, if known.
+
+        Returns
+        -------
+        ImageHeader
+            The header record of the image.
+        """
+        return cls(
+            image_data.PatientID,
+            image_data.StudyInstanceUID,
+            image_data.SeriesInstanceUID,
+            image_data["Modality"].value,
+            json.dumps(scrub_dicom(image_data)).encode("utf-8"),
+            header_length,
+        )
 
 
 class PartialDicom:
@@ -125,16 +235,29 @@ class PartialDicom:
     on traffic.
     """
 
-    def __init__(self, s3client, key, initial_range_kb=20):
+    def __init__(
+        self,
+        s3client,
+        key,
+        initial_range_kb=20,
+        size=None,
+        whole_file_kb=SMALL_FILE_KB,
+    ):
         """Download partial DICOM files iteratively, to save
         on traffic.
 
         Parameters
         ----------
-        obj : boto3.resource('s3').ObjectSummary
-            DICOM file object to download.
+        s3client : S3Client
+            The service that handles S3 data access
+        key : str
+            DICOM file object key to download.
         initial_range_kb : int, default=20
             The starting range of the file to download.
+        size : int, default=None
+            The size of the object in bytes, if known (eg. from the inventory).
+        whole_file_kb : int, default=SMALL_FILE_KB
+            Files of known size up to this are downloaded whole in one request.
         """
         # Default value of 20Kb initial range is based on
         # tests run on representative data
@@ -142,6 +265,18 @@ class PartialDicom:
         self.s3client = s3client
         self.key = key
         self.range_kb = initial_range_kb
+        # Sizes of 0 are how the inventory lists objects of unknown size
+        self.size = size or None
+        if (
+            self.size is not None
+            and self.size <= max(whole_file_kb, initial_range_kb) * KB
+        ):
+            self.range_kb = math.ceil(self.size / KB)
+        # The position of the pixel data, once found
+        self.header_length = None
+        # Transfer counters, for checking the cost of each download
+        self.requests = 0
+        self.bytes_fetched = 0
 
     def _stop_when(self, tag, VR, length):
         """Custom stopper for the DICOM reader, to stop
@@ -151,39 +286,107 @@ class PartialDicom:
         self._found_image_tag = tag == (0x7FE0, 0x0010)
         return self._found_image_tag
 
+    def _fetch(self, toprange):
+        """Download the part of the file between the bytes already
+        fetched and the given position.
+
+        Parameters
+        ----------
+        toprange : int
+            The last byte position to download (inclusive)
+
+        Returns
+        -------
+        bytes
+            The downloaded content, empty if the file has no more data
+        """
+        try:
+            content = self.s3client.object_content(
+                content_range=f"bytes={self.bytes_fetched}-{toprange}",
+                key=self.key,
+            )
+        except ClientError as ex:
+            status = ex.response.get("ResponseMetadata", {}).get(
+                "HTTPStatusCode"
+            )
+            if ex.response["Error"]["Code"] == "InvalidRange" or status == 416:
+                # Already have the whole file
+                return b""
+            raise
+        finally:
+            self.requests += 1
+        self.bytes_fetched += len(content)
+        return content
+
     def download(self):
-        """Download file iteratively
+        """Download file iteratively, each time only requesting
+        the range following the previously downloaded bytes.
 
         Returns
         -------
-        pydicom.FileDataset
-            The image data.
+        pydicom.FileDataset or None
+            The image data, or None if the whole file was downloaded
+            and still couldn't be read.
         """
+        image_data = None
         with BytesIO() as tmp:
             while True:
-                tmp.seek(0)
                 toprange = (self.range_kb * KB) - 1
-                content = self.s3client.object_content(
-                    content_range=f"bytes=0-{toprange}", key=self.key
-                )
+                if self.size is not None:
+                    toprange = min(toprange, self.size - 1)
+                content = self._fetch(toprange)
+                tmp.seek(0, SEEK_END)
                 tmp.write(content)
+                # Got less than asked for, or all there is to get,
+                # so reached the end of the file
+                complete = self.bytes_fetched <= toprange or (
+                    self.size is not None and self.bytes_fetched >= self.size
+                )
                 tmp.seek(0)
                 try:
                     image_data = pydicom.filereader.read_partial(
                         tmp, stop_when=self._stop_when
                     )
-                    if self._found_image_tag or tmp.tell() < toprange:
+                    if self._found_image_tag:
+                        self.header_length = tmp.tell()
+                    if (
+                        self._found_image_tag
+                        or tmp.tell() < toprange
+                        or complete
+                    ):
                         # We've found the image tag, or there was not image tag
                         # to be found in this image
                         break
                 except (OSError, struct.error):
                     # Can happen when file got truncated in the middle of a data field
-                    pass
+                    image_data = None
+                    if complete:
+                        break
                 except Exception:
                     raise
                 self.range_kb *= 2
+        logger.debug(
+            f"Downloaded {self.bytes_fetched} bytes of {self.key} "
+            f"in {self.requests} requests."
+        )
         return image_data
 
+    def download_header(self):
+        """Download the file's header as `download` does, and keep only
+        its header record, so the parsed data and the downloaded bytes can
+        be released right away.
+
+        Returns
+        -------
+        ImageHeader or None
+            The header record, or None if the whole file was downloaded
+            and still couldn't be read.
+        """
+        image_data = self.download()
+        if image_data is None:
+            return None
+        return ImageHeader.from_dataset(image_data, self.header_length)
+
 
 ###
 # Transformation steps
@@ -218,9 +421,50 @@ def load_config(s3client, config):
         raise
 
 
+def _unfinished(files, journal):
+    """Pass on the (key, size) pairs of the raw files not completed in an
+    earlier attempt of the run, until the run's time budget is used up."""
+    for key, size in files:
+        if journal is None:
+            yield key, size
+            continue
+        if journal.out_of_time():
+            logger.warning("Run time budget used up, not taking more files.")
+            return
+        if not journal.done(key):
+            yield key, size
+
+
+def _resolvable(retries, watermarks, arrived, patientcache):
+    """Pass on the (key, size) pairs of the images to retry, except those
+    still waiting for the data of their patients."""
+    for key, size in retries:
+        patient_id = watermarks.retries.get(key)
+        if (
+            patient_id is None
+            or patient_id in arrived
+            or (
+                patientcache is not None
+                and patientcache.get_group(patient_id) is not None
+            )
+        ):
+            yield key, size
+
+
 @use("config")
 @use("filelist")
-def extract_raw_files_from_folder(config, filelist):
+@use("watermarks")
+@use("journal")
+@use("forecast")
+@use("patientcache")
+def extract_raw_files_from_folder(
+    config,
+    filelist,
+    watermarks=None,
+    journal=None,
+    forecast=None,
+    patientcache=None,
+):
     """Extract files from a given date folder in the data dump
 
     Parameters
@@ -229,26 +473,340 @@ def extract_raw_files_from_folder(config, filelist):
         A configurations store.
     filelist : FileList
         A FileList set up for the warehouse
+    watermarks : RawWatermarks, default=None
+        The raw date folders to take, only those since the last run
+        unless it's a full run (all of them if not given), and the files
+        left unresolved in earlier runs, taken again (outside the date
+        folders of this run), except the images whose patients are still
+        not known.
+    journal : RunJournal, default=None
+        The journal of the run, to skip the files completed in an earlier
+        attempt, and to stop once the time budget is used up.
+    forecast : RunForecast, default=None
+        The forecast of a dry run, to note the image sizes in.
+    patientcache : PatientCache, default=None
+        A cache of patient assignments to training/validation groups, to
+        take the images to retry of the patients already known.
 
     Yields
     ------
-    tuple[str, boto3.resource('s3').ObjectSummary, None]
-        Tuple containing the task to do ("process"), the object, and a placeholder
+    tuple[str, boto3.resource('s3').ObjectSummary, int or None]
+        Tuple containing the task to do ("process"), the object, and for
+        images the object size from the inventory (None otherwise)
     """
     raw_prefixes = {prefix.rstrip("/") for prefix in config.get_raw_prefixes()}
     # List the clinical data files for processing
     logger.info("Starting on clinical data file processing.")
-    for key in filelist.get_raw_data_list(raw_prefixes=raw_prefixes):
+    data_files = filelist.get_raw_data_list(
+        raw_prefixes=raw_prefixes, watermarks=watermarks
+    )
+    arrived = set()
+    for key, _ in _unfinished(zip(data_files, repeat(None)), journal):
+        if watermarks is not None and watermarks.retries:
+            m = CLINICAL_DATA_PATTERN.match(key)
+            if m is not None:
+                arrived.add(m.group("patient_id"))
         yield "process", key, None
+    if journal is not None and journal.interrupted:
+        return
     # List the unprocessed image files for processing
     logger.info("Starting on image file processing.")
-    for key in filelist.get_pending_raw_images_list(raw_prefixes=raw_prefixes):
-        yield "process", key, None
+    image_files = filelist.get_pending_raw_images_list(
+        raw_prefixes=raw_prefixes, with_size=True, watermarks=watermarks
+    )
+    for key, size in _unfinished(image_files, journal):
+        if forecast is not None:
+            forecast.expect(key, size)
+        yield "process", key, size
+    if watermarks is None or not watermarks.retries:
+        return
+    if journal is not None and journal.interrupted:
+        return
+    logger.info("Starting on the images to retry from earlier runs.")
+    retries = filelist.get_retry_raw_images_list(
+        raw_prefixes=raw_prefixes, watermarks=watermarks
+    )
+    resolvable = _resolvable(retries, watermarks, arrived, patientcache)
+    for key, size in _unfinished(resolvable, journal):
+        if forecast is not None:
+            forecast.expect(key, size)
+        yield "process", key, size
+
+
+class ImageHeaderFetcher(Configurable):
+    """Download the headers of the incoming image files concurrently,
+    keeping a bounded number of PartialDicom downloads in flight.
+
+    Images are passed on in the order they arrived, with their header
+    records (see `ImageHeader`) filled in, everything else is passed on
+    unchanged, except for the clinical data files that process_patient_data
+    already sent to the copy step. The images deferred in earlier runs are
+    passed on right away, with the header records kept for them.
+
+    The raw image keys don't identify the patients, but the images taken
+    again from earlier runs may have their patients recorded (in the
+    header cache, or with the images to retry in the watermarks). Those of
+    the patients of other shards are dropped here, without a download.
+    """
+
+    workers = Option(int, default=HEADER_FETCH_WORKERS)
+    s3client = Service("s3client")
+    headerstats = Service("headerstats")
+    headercache = Service("headercache")
+    watermarks = Service("watermarks")
+    shard = Service("shard")
+
+    @ContextProcessor
+    def pending(
+        self,
+        context,
+        *,
+        s3client,
+        headerstats,
+        headercache,
+        watermarks,
+        shard,
+    ):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            yield executor, pending
+            # The input is exhausted, pass on the downloads still in flight
+            # (this runs before the end of the stream is signalled downstream)
+            for result in self._drain(pending, 0, headerstats, watermarks):
+                context.send(*result)
+        if not DRY_RUN:
+            headerstats.save()
+
+    def _drain(self, pending, limit, headerstats, watermarks):
+        """Collect finished downloads from the front of the queue.
+
+        Parameters
+        ----------
+        pending : collections.deque
+            The queue of PartialDicom downloads and their futures in submission order
+        limit : int
+            Wait for the oldest downloads until no more than this many are pending
+        headerstats : HeaderSizeStats
+            The header length statistics to update with the finished downloads
+        watermarks : RawWatermarks or None
+            To note the images whose downloads failed, to retry them later
+
+        Yields
+        ------
+        tuple[str, str, ImageHeader or None]
+            A task name ("process"), the image key, and the image's
+            header record
+        """
+        while pending and (len(pending) > limit or pending[0][1].done()):
+            partial, future = pending.popleft()
+            try:
+                header = future.result()
+            except Exception as e:  # noqa: E722
+                logger.error(
+                    f"Couldn't download image header {partial.key}: {e}"
+                )
+                if watermarks is not None:
+                    watermarks.retry(partial.key)
+                continue
+            headerstats.record(partial.key, partial.header_length)
+            yield "process", partial.key, header
+
+    def __call__(
+        self,
+        executor,
+        pending,
+        *args,
+        s3client,
+        headerstats,
+        headercache,
+        watermarks,
+        shard,
+    ):
+        """Start the download of an image's header, and pass on any
+        previously started downloads that are finished.
+
+        Parameters
+        ----------
+        executor : concurrent.futures.ThreadPoolExecutor
+            The pool running the downloads
+        pending : collections.deque
+            The queue of downloads in flight
+        task, key, size : tuple[str, str, int or None]
+            A task name (only handling "process" tasks), an object to act on,
+            and its size if known.
+        s3client : S3Client
+            The service that handles S3 data access
+        headerstats : HeaderSizeStats
+            The header length statistics to choose the initial range with
+        headercache : HeaderCache or None
+            The header records of the images deferred in earlier runs
+        watermarks : RawWatermarks or None
+            To note the images whose downloads failed, to retry them later
+        shard : Shard or None
+            The part of the patients to process, all of them if not given
+
+        Yields
+        ------
+        tuple[str, str, ImageHeader or None]
+            A task name ("process"), the image key, and the image's
+            header record
+        """
+        task, key, size = args
+        if task == "copy":
+            # The clinical data files, already sent to the copy step by
+            # process_patient_data, so they are not copied twice
+            return
+        if task != "process" or Path(key).suffix.lower() != ".dcm":
+            yield bonobo.constants.NOT_MODIFIED
+            return
+
+        record = headercache.get(key) if headercache is not None else None
+        if shard is not None:
+            patient_id = _known_patient(key, record, watermarks)
+            if patient_id is not None and not shard.includes(patient_id):
+                # Processed by the task of another shard
+                return
+        if record is not None:
+            yield "process", key, ImageHeader(**record)
+            return
+
+        partial = PartialDicom(
+            s3client,
+            key,
+            initial_range_kb=headerstats.initial_range_kb(key),
+            size=size,
+        )
+        download = helpers.in_current_stage(partial.download_header)
+        pending.append((partial, executor.submit(download)))
+        yield from self._drain(pending, self.workers, headerstats, watermarks)
+
+
+def _known_patient(key, record, watermarks):
+    """The patient of a raw image taken again from an earlier run, if it
+    was recorded then.
+
+    Parameters
+    ----------
+    key : str
+        The object key of the raw image.
+    record : dict or None
+        The header record of the image kept in the header cache.
+    watermarks : RawWatermarks or None
+        The images to retry from earlier runs, with their patients
+
+    Returns
+    -------
+    str or None
+        The patient ID, None if not known before the header is downloaded.
+    """
+    if record is not None:
+        return record["patient_id"]
+    if watermarks is not None:
+        return watermarks.retries.get(key)
+    return None
+
+
+def _image_header(key, header, s3client, headercache, watermarks):
+    """The header record of an image, as passed on by ImageHeaderFetcher,
+    or else kept in the header cache, or else downloaded.
+
+    Parameters
+    ----------
+    key : str
+        The object key of the raw image.
+    header : ImageHeader or int or None
+        The header record downloaded upstream, or the object size.
+    s3client : S3Client
+        The service that handles S3 data access
+    headercache : HeaderCache or None
+        The header records of the images deferred in earlier runs
+    watermarks : RawWatermarks or None
+        To note the images that can't be read as resolved, as they are
+        not to be retried
+
+    Returns
+    -------
+    ImageHeader or None
+        The header record, None if the image couldn't be read.
+    """
+    if not isinstance(header, ImageHeader):
+        record = headercache.get(key) if headercache is not None else None
+        if record is not None:
+            header = ImageHeader(**record)
+        else:
+            header = PartialDicom(s3client, key, size=header).download_header()
+    if header is None:
+        # we couldn't read the image data correctly
+        logger.warning(
+            f"Object '{key}' couldn't be loaded as a DICOM file, skipping!"
+        )
+        if watermarks is not None:
+            watermarks.resolve(key)
+    return header
+
+
+def _patient_group(key, header, patientcache, headercache, watermarks):
+    """The group of an image's patient, deferring the image while its
+    patient is not known: noting it to retry in later runs, and keeping
+    its header record in the header cache (if given).
+
+    Parameters
+    ----------
+    key : str
+        The object key of the raw image.
+    header : ImageHeader
+        The header record of the image.
+    patientcache : PatientCache
+        The cache that stores the asignments of patients to groups
+    headercache : HeaderCache or None
+        The header records of the images whose patients are not known yet
+    watermarks : RawWatermarks or None
+        The images to retry in later runs
+
+    Returns
+    -------
+    str or None
+        "training" or "validation", None if the patient is not known.
+    """
+    group = patientcache.get_group(header.patient_id)
+    if group is not None:
+        # The image is resolved in the watermarks once its outputs are
+        # written (see process_image)
+        if headercache is not None:
+            headercache.resolve(key)
+        return group
+    message = (
+        f"Image without patient data: {key}; "
+        + f"included patient ID: {header.patient_id}; "
+    )
+    if watermarks is None and headercache is None:
+        logger.error(message + "skipping!")
+        return None
+    logger.warning(message + "deferred until the patient data arrives.")
+    if watermarks is not None:
+        watermarks.retry(key, header.patient_id)
+    if headercache is not None:
+        headercache.defer(key, header)
+    return None
 
 
 @use("s3client")
 @use("patientcache")
-def process_image(*args, s3client, patientcache):
+@use("existenceindex")
+@use("shard")
+@use("journal")
+@use("headercache")
+@use("watermarks")
+def process_image(
+    *args,
+    s3client,
+    patientcache,
+    existenceindex,
+    shard=None,
+    journal=None,
+    headercache=None,
+    watermarks=None,
+):
     """Processing images from the raw dump
 
     Takes a single image, downloads it into temporary storage
@@ -261,22 +819,37 @@ def process_image(*args, s3client, patientcache):
 
     Parameters
     ----------
-    task, key, _ : tuple[str, str, None]
-        A task name (only handling "process" tasks), and an object to act on.
+    task, key, header : tuple[str, str, ImageHeader or int or None]
+        A task name (only handling "process" tasks), an object to act on,
+        and the image's header record if it was already downloaded by
+        ImageHeaderFetcher (otherwise the object size, if known).
     s3client : S3Client
         The service that handles S3 data access
     patientcache:
         The cache that stores the asignments of patients to groups
+    existenceindex : ExistenceIndex
+        The index of objects already in the bucket
+    shard : Shard, default=None
+        The part of the patients to process, all of them if not given
+    journal : RunJournal, default=None
+        The journal to record the outputs to be written in
+    headercache : HeaderCache, default=None
+        The header records of the images whose patients are not known yet,
+        to keep the header of the image in until the patient data arrives
+    watermarks : RawWatermarks, default=None
+        The images to retry in later runs, to note the image in until the
+        patient data arrives (the image is skipped if neither this nor the
+        header cache is given), and its outputs are written
 
     Yields
     ------
-    tuple[str, str, str or pydicom.FileDataset]
+    tuple[str, str, str or ImageHeader]
         Tuple containing the task name("copy" or "metadata"), and other parameters
         depending on the task. "copy" passes on the original object and new location.
-        "metadata" passes on the target metadata location and the image data to extract from.
+        "metadata" passes on the target metadata location and the image's header record.
     """
     # check file type
-    task, key, _ = args
+    task, key, header = args
     image_path = Path(key)
     if task != "process" or image_path.suffix.lower() != ".dcm":
         # not an image, don't do anything with it
@@ -286,37 +859,27 @@ def process_image(*args, s3client, patientcache):
 
     image_uuid = image_path.stem
 
-    # download the image
-    image_data = PartialDicom(s3client, key).download()
-    if image_data is None:
-        # we couldn't read the image data correctly
-        logger.warning(
-            f"Object '{key}' couldn't be loaded as a DICOM file, skipping!"
-        )
+    # download the image, unless it was already fetched upstream
+    header = _image_header(key, header, s3client, headercache, watermarks)
+    if header is None:
         return
 
     # extract the required data from the image
-    patient_id = image_data.PatientID
-    study_id = image_data.StudyInstanceUID
-    series_id = image_data.SeriesInstanceUID
-    group = patientcache.get_group(patient_id)
-    if group is not None:
-        training_set = group == "training"
-    else:
-        logger.error(
-            f"Image without patient data: {key}; "
-            + f"included patient ID: {patient_id}; "
-            + "skipping!"
-        )
+    patient_id = header.patient_id
+    if shard is not None and not shard.includes(patient_id):
+        # Processed by the task of another shard
+        return
+    study_id = header.study_id
+    series_id = header.series_id
+    group = _patient_group(key, header, patientcache, headercache, watermarks)
+    if group is None:
         return
     prefix = (
         constants.TRAINING_PREFIX
-        if training_set
+        if group == "training"
         else constants.VALIDATION_PREFIX
     )
-    image_type = constants.MODALITY.get(
-        image_data["Modality"].value, "unknown"
-    )
+    image_type = constants.MODALITY.get(header.modality, "unknown")
 
     date = helpers.get_date_from_key(key)
     if date:
@@ -337,50 +900,81 @@ def process_image(*args, s3client, patientcache):
             series_id,
             f"{image_uuid}.json",
         )
+        outputs = dict()
+        if not existenceindex.exists(new_key):
+            existenceindex.add(new_key)
+            outputs[new_key] = "copy"
+        if not existenceindex.exists(metadata_key):
+            existenceindex.add(metadata_key)
+            outputs[metadata_key] = "metadata"
+        if journal is not None:
+            journal.expect(key, outputs)
+        if watermarks is not None:
+            watermarks.expect(key, outputs)
         # send off to copy or upload steps
-        if not s3client.object_exists(new_key):
+        if new_key in outputs:
             yield "copy", key, new_key
-        if not s3client.object_exists(metadata_key):
-            yield "metadata", metadata_key, image_data
+        if metadata_key in outputs:
+            yield "metadata", metadata_key, header
 
 
 def process_dicom_data(*args):
-    """Process DICOM images, by scrubbing the image data
+    """Process DICOM images, by taking their scrubbed image data
 
     Parameters
     ----------
-    task, metadata_key, image_data : tuple[str, str, pydicom.FileDataset]
+    task, metadata_key, header : tuple[str, str, ImageHeader]
         A task name (only handling "metadata" tasks), the location where
-        to create the metadata file further down the chain, and the image
-        data to scrub and extract.
+        to create the metadata file further down the chain, and the header
+        record of the image, with its data already scrubbed.
 
     Yields
     ------
-    tuple[str, str, str]
+    tuple[str, str, bytes]
         A task name ("upload"), the key of the metadata file to create,
         and the JSON content to in the file.
     """
     (
         task,
         metadata_key,
-        image_data,
+        header,
     ) = args
     if task == "metadata":
-        scrubbed_image_data = scrub_dicom(image_data)
-        yield "upload", metadata_key, json.dumps(scrubbed_image_data)
+        yield "upload", metadata_key, header.metadata
 
 
 @use("s3client")
-def upload_text_data(*args, s3client):
+@use("journal")
+@use("seriesmetadata")
+@use("forecast")
+@use("watermarks")
+def upload_text_data(
+    *args,
+    s3client,
+    journal=None,
+    seriesmetadata=None,
+    forecast=None,
+    watermarks=None,
+):
     """Upload the text data to the correct bucket location.
 
     Parameters
     ----------
-    task, outgoing_key, outgoing_data : tuple[str, str, str]
+    task, outgoing_key, outgoing_data : tuple[str, str, str or bytes]
         Task name (only processing "upload" tasks), the key and contents
         of the text file to handle
     s3client : S3Client
         The service that handles S3 data access
+    journal : RunJournal, default=None
+        The journal to record the uploaded file in
+    seriesmetadata : SeriesMetadataWriter, default=None
+        If given, the image metadata are collected into per-series files
+        instead of uploaded one by one
+    forecast : RunForecast, default=None
+        The forecast of a dry run, to count the upload in
+    watermarks : RawWatermarks, default=None
+        To note the uploaded file in, or its raw file to retry if the
+        upload fails
 
     Returns
     -------
@@ -399,16 +993,57 @@ def upload_text_data(*args, s3client):
     ):
         if DRY_RUN:
             logger.info(f"Would upload to key: {outgoing_key}")
-        else:
-            s3client.put_object(key=outgoing_key, content=outgoing_data)
+            if forecast is not None:
+                forecast.upload(outgoing_key, len(outgoing_data))
+        elif _upload(
+            outgoing_key, outgoing_data, s3client, seriesmetadata, watermarks
+        ):
+            # Recorded in the journal once the series file is written
+            return bonobo.constants.NOT_MODIFIED
+        if journal is not None:
+            journal.written(outgoing_key)
+        if watermarks is not None:
+            watermarks.written(outgoing_key)
 
     return bonobo.constants.NOT_MODIFIED
 
 
+def _upload(key, content, s3client, seriesmetadata, watermarks):
+    """Upload a text file, or collect it into its series file.
+
+    Returns
+    -------
+    bool
+        True if the file is collected, to be written with its series.
+    """
+    try:
+        if seriesmetadata is not None and seriesmetadata.add(key, content):
+            return True
+        s3client.put_object(key=key, content=content)
+    except Exception:  # noqa: E722
+        if watermarks is not None:
+            watermarks.failed(key)
+        raise
+    return False
+
+
 @use("config")
 @use("patientcache")
-@use("s3client")
-def process_patient_data(*args, config, patientcache, s3client):
+@use("existenceindex")
+@use("centrelookup")
+@use("shard")
+@use("journal")
+@use("watermarks")
+def process_patient_data(
+    *args,
+    config,
+    patientcache,
+    existenceindex,
+    centrelookup,
+    shard=None,
+    journal=None,
+    watermarks=None,
+):
     """Processing patient data from the raw dump
 
     Get the patient ID from the filename, do a training/validation
@@ -423,8 +1058,17 @@ def process_patient_data(*args, config, patientcache, s3client):
         A configuration store.
     patientcache : PatientCache
         A cache of patient assignments to training/validation groups
-    s3client : S3Client
-        The service that handles S3 data access
+    existenceindex : ExistenceIndex
+        The index of objects already in the bucket
+    centrelookup : SubmittingCentreLookup
+        The lookup of the patients' submitting centres
+    shard : Shard, default=None
+        The part of the patients to process, all of them if not given
+    journal : RunJournal, default=None
+        The journal to record the file to be copied in
+    watermarks : RawWatermarks, default=None
+        To note the file to be copied in, or to retry it in later runs if
+        it's skipped (e.g. its site is not in the configuration yet)
 
     Yields
     ------
@@ -439,61 +1083,98 @@ def process_patient_data(*args, config, patientcache, s3client):
         # Stop here with processing as well
         return
 
-    m = re.match(
-        r"^.+/(?P<date>\d{4}-\d{2}-\d{2})/data/(?P<patient_id>.*)_(?P<outcome>data|status).json$",
-        key,
-    )
+    m = CLINICAL_DATA_PATTERN.match(key)
     if m is None:
         # Can't interpret this file based on name, skip
         return
 
     patient_id = m.group("patient_id")
+    if shard is not None and not shard.includes(patient_id):
+        # Processed by the task of another shard
+        return
     outcome = m.group("outcome")
     date = m.group("date")
 
-    group = patientcache.get_group(patient_id)
-    if group is not None:
-        training_set = group == "training"
-    else:
-        # patient group is not cached
-        submitting_centre = helpers.get_submitting_centre_from_key(
-            s3client, key
-        )
-        if submitting_centre is None:
-            logger.error(
-                f"{key} does not have 'SubmittingCentre' entry, skipping!"
-            )
-            return
-
-        config_group = config.get_site_group(submitting_centre)
-        if config_group is None:
-            logger.warning(
-                f"Site '{submitting_centre}' is not in configuration, skipping!"
-            )
-            return
-        if config_group == "split":
-            training_set = patient_in_training_set(
-                patient_id, config.get_training_percentage()
-            )
-        else:
-            # deciding between "training" and "validation" groups.
-            training_set = config_group == "training"
-        patientcache.add(
-            patient_id, "training" if training_set else "validation"
-        )
-
+    group = _data_group(key, patient_id, config, patientcache, centrelookup)
+    if group is None:
+        if watermarks is not None:
+            watermarks.retry(key)
+        return
     prefix = (
         constants.TRAINING_PREFIX
-        if training_set
+        if group == "training"
         else constants.VALIDATION_PREFIX
     )
     new_key = f"{prefix}data/{patient_id}/{outcome}_{date}.json"
-    if not s3client.object_exists(new_key):
+    outputs = dict()
+    if not existenceindex.exists(new_key):
+        existenceindex.add(new_key)
+        outputs[new_key] = "copy"
+    if journal is not None:
+        journal.expect(key, outputs)
+    if watermarks is not None:
+        watermarks.expect(key, outputs)
+    if new_key in outputs:
         yield "copy", key, new_key
 
 
+def _data_group(key, patient_id, config, patientcache, centrelookup):
+    """The group of the patient of a clinical data file, as cached, or
+    else from the configuration of the patient's submitting centre (and
+    then added to the cache).
+
+    Parameters
+    ----------
+    key : str
+        The object key of the clinical data file.
+    patient_id : str
+        The patient of the file.
+    config : PipelineConfig
+        A configuration store.
+    patientcache : PatientCache
+        A cache of patient assignments to training/validation groups
+    centrelookup : SubmittingCentreLookup
+        The lookup of the patients' submitting centres
+
+    Returns
+    -------
+    str or None
+        "training" or "validation", None if the file is to be skipped.
+    """
+    group = patientcache.get_group(patient_id)
+    if group is not None:
+        return group
+    # patient group is not cached
+    submitting_centre = centrelookup.get_centre(key)
+    if submitting_centre is None:
+        logger.error(
+            f"{key} does not have 'SubmittingCentre' entry, skipping!"
+        )
+        return None
+
+    config_group = config.get_site_group(submitting_centre)
+    if config_group is None:
+        logger.warning(
+            f"Site '{submitting_centre}' is not in configuration, skipping!"
+        )
+        return None
+    if config_group == "split":
+        training_set = patient_in_training_set(
+            patient_id, config.get_training_percentage()
+        )
+    else:
+        # deciding between "training" and "validation" groups.
+        training_set = config_group == "training"
+    group = "training" if training_set else "validation"
+    patientcache.add(patient_id, group)
+    return group
+
+
 @use("s3client")
-def data_copy(*args, s3client):
+@use("journal")
+@use("forecast")
+@use("watermarks")
+def data_copy(*args, s3client, journal=None, forecast=None, watermarks=None):
     """Copy objects within the bucket
 
     Only if both original object and new key is provided.
@@ -505,6 +1186,13 @@ def data_copy(*args, s3client):
         and the new key to copy the object to
     s3client : S3Client
         The service that handles S3 data access
+    journal : RunJournal, default=None
+        The journal to record the copied file in
+    forecast : RunForecast, default=None
+        The forecast of a dry run, to count the copy in
+    watermarks : RawWatermarks, default=None
+        To note the copied file in, or its raw file to retry if the copy
+        fails
 
     Returns
     -------
@@ -519,12 +1207,199 @@ def data_copy(*args, s3client):
     if task == "copy" and old_key is not None and new_key is not None:
         if DRY_RUN:
             logger.info(f"Would copy: {old_key} -> {new_key}")
+            if forecast is not None:
+                forecast.copy(old_key)
         else:
-            s3client.copy_object(old_key, new_key)
+            try:
+                s3client.copy_object(old_key, new_key)
+            except Exception:  # noqa: E722
+                if watermarks is not None:
+                    watermarks.failed(new_key)
+                raise
+        if journal is not None:
+            journal.written(new_key)
+        if watermarks is not None:
+            watermarks.written(new_key)
 
     return bonobo.constants.NOT_MODIFIED
 
 
+@use("patientcache")
+@use("existenceindex")
+@use("headerstats")
+@use("shard")
+@use("forecast")
+@use("headercache")
+def forecast_raw_file(
+    *args,
+    patientcache,
+    existenceindex,
+    headerstats,
+    forecast,
+    shard=None,
+    headercache=None,
+):
+    """Forecast the work on a raw file from the inventory alone, without
+    any request for the file itself.
+
+    Clinical data files are copied unless their processed copy is already
+    listed, and the submitting centre is looked up for the patients not
+    yet in a group. Images are downloaded in part (or whole if they are
+    small) for their header (unless deferred in an earlier run, with the
+    header kept), and copied with a metadata file, as their patients (so
+    their groups and shards) are only known from the header.
+    The metadata file sizes are not known without the headers, so they
+    are not counted in the bytes uploaded.
+
+    Parameters
+    ----------
+    task, key, size : tuple[str, str, int or None]
+        A task name (only handling "process" tasks), the raw file, and
+        its size from the inventory if known.
+    patientcache : PatientCache
+        A cache of patient assignments to training/validation groups
+    existenceindex : ExistenceIndex
+        The index of objects already in the bucket
+    headerstats : HeaderSizeStats
+        The header length statistics to choose the initial range with
+    forecast : RunForecast
+        The forecast to count the work in
+    shard : Shard, default=None
+        The part of the patients to process, all of them if not given
+    headercache : HeaderCache, default=None
+        The header records of the images deferred in earlier runs
+    """
+    task, key, size = args
+    if task != "process":
+        return
+    if Path(key).suffix.lower() == ".dcm":
+        if headercache is None or key not in headercache:
+            initial_range_kb = headerstats.initial_range_kb(key)
+            transferred = initial_range_kb * KB
+            if size:
+                if size <= max(SMALL_FILE_KB, initial_range_kb) * KB:
+                    transferred = size
+                transferred = min(transferred, size)
+            forecast.request("GET", transferred=transferred)
+        if existenceindex.verify_missing:
+            # Checked for both the image and the metadata file
+            forecast.request("HEAD")
+            forecast.request("HEAD")
+        forecast.copy(key, size)
+        forecast.upload(key, 0)
+        return
+
+    m = CLINICAL_DATA_PATTERN.match(key)
+    if m is None:
+        return
+    patient_id = m.group("patient_id")
+    if shard is not None and not shard.includes(patient_id):
+        return
+    group = patientcache.get_group(patient_id)
+    if group is None:
+        forecast.lookup(
+            patient_id, transferred=services.SUBMITTING_CENTRE_RANGE_KB * KB
+        )
+    else:
+        new_key = (
+            f"{group}/data/{patient_id}/"
+            f"{m.group('outcome')}_{m.group('date')}.json"
+        )
+        if existenceindex.listed(new_key):
+            return
+    if existenceindex.verify_missing:
+        forecast.request("HEAD")
+    forecast.copy(key)
+
+
+class RunFinisher(Configurable):
+    """The last step of the pipeline, receiving what the copy and upload
+    steps pass on, to record the state of the run once all the steps
+    before it are finished."""
+
+    watermarks = Service("watermarks")
+    s3client = Service("s3client")
+    shard = Service("shard")
+    journal = Service("journal")
+    seriesmetadata = Service("seriesmetadata")
+    headercache = Service("headercache")
+
+    @ContextProcessor
+    def finish(
+        self,
+        context,
+        *,
+        watermarks,
+        s3client,
+        shard,
+        journal,
+        seriesmetadata,
+        headercache,
+    ):
+        yield
+        if seriesmetadata is not None:
+            seriesmetadata.flush()
+            logger.info(f"Series metadata: {seriesmetadata.counters}")
+        # All the earlier steps are done (or failed) by now, but only in
+        # this task if the run is sharded, so the watermarks are kept, as
+        # they are when the run stopped early
+        interrupted = journal is not None and journal.interrupted
+        if (
+            not DRY_RUN
+            and watermarks is not None
+            and shard is None
+            and not interrupted
+        ):
+            watermarks.save()
+            logger.info(
+                f"Raw watermarks saved: {watermarks.watermarks}, "
+                + f"{len(watermarks.retries)} images to retry"
+            )
+            if headercache is not None:
+                # The headers of the images to retry, for the next run
+                headercache.save()
+        if journal is not None:
+            journal.close()
+        if headercache is not None:
+            logger.info(
+                f"Header cache: {headercache.counters}, "
+                + f"{len(headercache)} images deferred"
+            )
+        if s3client is not None:
+            logger.info(f"S3 requests: {s3client.counters}")
+
+    def __call__(
+        self,
+        *args,
+        watermarks,
+        s3client,
+        shard,
+        journal,
+        seriesmetadata,
+        headercache,
+    ):
+        """Take the results of the earlier steps, without passing them on.
+
+        Parameters
+        ----------
+        *args
+            The output of the copy and upload steps.
+        watermarks : RawWatermarks
+            The raw date folders taken in this run
+        s3client : S3Client
+            The client whose request counters are logged at the end
+        shard : Shard or None
+            The part of the patients processed in this task
+        journal : RunJournal or None
+            The journal of the run, removed if the run is complete
+        seriesmetadata : SeriesMetadataWriter or None
+            The collected series metadata, written at the end
+        headercache : HeaderCache or None
+            The deferred images, saved with the watermarks at the end
+        """
+        return None
+
+
 ###
 # Graph setup
 ###
@@ -544,12 +1419,22 @@ def get_graph(**options):
     """
     graph = bonobo.Graph()
 
+    if options.get("forecast_only", FORECAST_ONLY):
+        graph.add_chain(
+            load_config,
+            extract_raw_files_from_folder,
+            forecast_raw_file,
+        )
+        return graph
+
     graph.add_chain(
         load_config,
         extract_raw_files_from_folder,
     )
 
-    graph.add_chain(data_copy, _input=None, _name="copy")
+    graph.add_chain(RunFinisher(), _input=None, _name="finish")
+
+    graph.add_chain(data_copy, _input=None, _name="copy", _output="finish")
 
     graph.add_chain(
         # bonobo.Limit(30),
@@ -560,12 +1445,20 @@ def get_graph(**options):
 
     graph.add_chain(
         # bonobo.Limit(30),
+        ImageHeaderFetcher(
+            workers=options.get("header_fetch_workers", HEADER_FETCH_WORKERS)
+        ),
         process_image,
         _input=process_patient_data,
         _output="copy",
     )
 
-    graph.add_chain(process_dicom_data, upload_text_data, _input=process_image)
+    graph.add_chain(
+        process_dicom_data,
+        upload_text_data,
+        _input=process_image,
+        _output="finish",
+    )
 
     return graph
 
@@ -590,19 +1483,96 @@ def get_services(**options):
             "config": None,
             "patientcache": None,
             "filelist": None,
+            "headerstats": None,
+            "existenceindex": None,
+            "centrelookup": None,
+            "watermarks": None,
+            "shard": None,
+            "journal": None,
+            "seriesmetadata": None,
+            "forecast": None,
+            "headercache": None,
         }
 
     s3client = services.S3Client(bucket=BUCKET_NAME)
+    dry_run = DRY_RUN or options.get("forecast_only", FORECAST_ONLY)
+    shard = services.Shard.parse(options.get("shard", SHARD))
+    if shard is not None:
+        logger.info(f"Processing the patients of shard {shard}.")
+    # Started first, for the time budget to cover the whole run
+    budget = None
+    budget_minutes = options.get("budget_minutes", RUN_BUDGET_MINUTES)
+    if budget_minutes > 0:
+        budget = datetime.timedelta(minutes=budget_minutes)
+    sync_interval = None
+    if services.RUN_JOURNAL_SYNC_SECONDS > 0:
+        sync_interval = datetime.timedelta(
+            seconds=services.RUN_JOURNAL_SYNC_SECONDS
+        )
+    journal_name = f"journal-{BUCKET_NAME}"
+    if shard is not None:
+        journal_name += f"-shard{shard.index}of{shard.count}"
+    journal = services.RunJournal(
+        journal_name,
+        s3client,
+        journal_dir=services.RUN_JOURNAL_DIR,
+        sync_interval=sync_interval,
+        budget=budget,
+        track_writes=not dry_run,
+    )
     config = services.PipelineConfig()
     inv_downloader = services.InventoryDownloader(main_bucket=BUCKET_NAME)
-    patientcache = services.PatientCache(inv_downloader)
-    filelist = services.FileList(inv_downloader)
+    patientcache = services.PatientCache(
+        inv_downloader,
+        s3client,
+        snapshot_dir=services.PATIENT_CACHE_DIR,
+        track_writes=not dry_run,
+    )
+    manifests = services.MetadataManifests(
+        s3client, cache_dir=services.METADATA_MANIFEST_DIR
+    )
+    filelist = services.FileList(inv_downloader, manifests=manifests)
+    headerstats = services.HeaderSizeStats(s3client)
+    existenceindex = services.ExistenceIndex(
+        inv_downloader,
+        s3client,
+        track_writes=not dry_run,
+        manifests=manifests,
+    )
+    centrelookup = services.SubmittingCentreLookup(
+        s3client, store_path=services.SUBMITTING_CENTRE_STORE
+    )
+
+    watermarks = services.RawWatermarks(
+        s3client, full=options.get("full", FULL_RUN)
+    )
+    seriesmetadata = None
+    if options.get("metadata_layout", METADATA_LAYOUT) == "series":
+        seriesmetadata = services.SeriesMetadataWriter(
+            s3client,
+            manifests=manifests,
+            journal=journal,
+            watermarks=watermarks,
+        )
 
     return {
         "s3client": s3client,
         "config": config,
         "patientcache": patientcache,
         "filelist": filelist,
+        "headerstats": headerstats,
+        "existenceindex": existenceindex,
+        "centrelookup": centrelookup,
+        "watermarks": watermarks,
+        "shard": shard,
+        "journal": journal,
+        "seriesmetadata": seriesmetadata,
+        "forecast": services.RunForecast() if dry_run else None,
+        "headercache": services.HeaderCache(
+            store_path=services.HEADER_CACHE_STORE,
+            track_writes=not dry_run,
+            s3client=s3client,
+        ),
     }
 
 
@@ -615,8 +1585,73 @@ def main():
     # ch.setFormatter(formatter)
     # logger.addHandler(ch)
     parser = bonobo.get_argument_parser()
+    parser.add_argument(
+        "--header-fetch-workers",
+        type=int,
+        default=HEADER_FETCH_WORKERS,
+        help="Number of image header downloads to run concurrently",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        default=FULL_RUN,
+        help="Take all raw date folders, not only those since the last run",
+    )
+    parser.add_argument(
+        "--shard",
+        default=SHARD,
+        help="Only process the patients of this shard, given as index/count "
+        "(e.g. 0/4), to split the run across independent tasks",
+    )
+    parser.add_argument(
+        "--budget-minutes",
+        type=float,
+        default=RUN_BUDGET_MINUTES,
+        help="Stop taking new files after this many minutes, saving the "
+        "run journal to continue from (0 for no limit)",
+    )
+    parser.add_argument(
+        "--metadata-layout",
+        choices=["image", "series"],
+        default=METADATA_LAYOUT,
+        help="Write the image metadata into a file per image, or a file "
+        "per series",
+    )
+    parser.add_argument(
+        "--forecast-only",
+        action="store_true",
+        default=FORECAST_ONLY,
+        help="Only forecast the run from the inventory, without requests "
+        "for the raw files themselves",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=PIPELINE_QUEUE_SIZE,
+        help="Number of items that can wait at the input of each step",
+    )
+    metrics = services.StageMetrics("warehouseloader")
     with bonobo.parse_args(parser) as options:
-        bonobo.run(get_graph(**options), services=get_services(**options))
+        dry_run = DRY_RUN or options.get("forecast_only", FORECAST_ONLY)
+        pipeline_services = get_services(**options)
+        bonobo.run(
+            get_graph(**options),
+            services=pipeline_services,
+            strategy=helpers.pipeline_strategy(
+                options.get("queue_size", PIPELINE_QUEUE_SIZE),
+                metrics=metrics,
+            ),
+        )
+        forecast = pipeline_services["forecast"]
+        if forecast is not None:
+            forecast.report(
+                pipeline_services["s3client"],
+                download_workers=options.get(
+                    "header_fetch_workers", HEADER_FETCH_WORKERS
+                ),
+                forecast_file=services.FORECAST_FILE,
+            )
+    metrics.save(None if dry_run else pipeline_services["s3client"])
 
 
 if __name__ == "__main__":